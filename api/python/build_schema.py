@@ -0,0 +1,20 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# precompiles the attribute codecs of the bundled AD schema so workers don't parse it on startup
+import helpers.ad
+
+if __name__ == '__main__':
+    helpers.ad.write_snapshot()
+    print('wrote {}'.format(helpers.ad.SNAPSHOT_PATH))
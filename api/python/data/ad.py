@@ -12,60 +12,143 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import helpers.env
 import helpers.errors
 import helpers.ldap
+import helpers.pool
 from helpers.ldap import RESULT_KEY_DN, RESULT_KEY_ATTRIBUTES
+from helpers.attributes import NO_ATTRIBUTES
 import helpers.ad
+import helpers.extended_dn
+import helpers.json
+import data.schema
+import data.membership
 from helpers.dictionaries import CaseInsensitiveDict
 import uuid
 from ldap3.protocol.formatters import formatters
 from ldap import SCOPE_SUBTREE, SCOPE_BASE, SCOPE_ONELEVEL
 import ldap.modlist
+import ldap.dn
+from ldap.controls import LDAPControl
 import base64
+import binascii
+import hashlib
+import json
+import re
 from enum import Enum
+from collections import namedtuple
+from contextlib import contextmanager
+from collections.abc import Mapping, ItemsView
 
-def binding_args(connection):
-    return {
-            'url': connection['ldapUrl'],
-            'userId': connection['credentials']['user'],
-            'password': connection['credentials']['password']
-        }
+@contextmanager
+def session(connection, context=None):
+    # yields context when given, e.g. to run several operations of a batch on one bound session
+    if context:
+        yield context
+    else:
+        with helpers.pool.session(**helpers.pool.binding_args(connection)) as context:
+            yield context
+
+def connection_codecs(connection):
+    # module level, create and update shadow the data package with their data argument
+    return data.schema.codecs(connection)
+
+def membership_invalidate(connection, dns=None):
+    data.membership.invalidate(connection, dns)
+
+def membership_modified(connection, dn, modlist):
+    data.membership.modified(connection, dn, modlist)
+
+class FormattedAttributes(Mapping):
+    # read only view over raw ldap attribute values that formats values when accessed, so attributes
+    # that are never serialized are never formatted. exclude holds lowercase names of attributes to hide.
+    __slots__ = ('raw', 'codecs', 'exclude')
+
+    def __init__(self, raw, codecs=None, exclude=frozenset()):
+        self.raw = raw
+        self.codecs = codecs
+        self.exclude = exclude
+
+    def visible(self, k):
+        return not self.exclude or not k.split(';')[0].lower() in self.exclude
+
+    def __getitem__(self, k):
+        if not self.visible(k):
+            raise KeyError(k)
+        return helpers.ad.format_attribute(k, self.raw[k], codecs=self.codecs)
+
+    def __contains__(self, k):
+        return k in self.raw and self.visible(k)
+
+    def __iter__(self):
+        return (k for k in self.raw if self.visible(k))
+
+    def __len__(self):
+        return len(self.raw) if not self.exclude else sum(1 for k in self)
+
+    def items(self):
+        return FormattedItems(self)
+
+    def formatted(self):
+        # the dict serializers write, formatted straight from the raw values without an intermediate view
+        codecs = self.codecs
+        if not self.exclude:
+            return {k: helpers.ad.format_attribute(k, v, codecs=codecs) for k, v in self.raw.items()}
+        return {k: helpers.ad.format_attribute(k, v, codecs=codecs) for k, v in self.raw.items() if self.visible(k)}
 
-def externalize(o):
-    d = o.get(RESULT_KEY_ATTRIBUTES, {})
+class FormattedItems(ItemsView):
+    # single pass over the raw values for serializers instead of a lookup per key
+    def __iter__(self):
+        m = self._mapping
+        return ((k, helpers.ad.format_attribute(k, v, codecs=m.codecs)) for k, v in m.raw.items() if m.visible(k))
+
+helpers.json.register(FormattedAttributes, FormattedAttributes.formatted)
+
+def externalize(o, codecs=None, exclude=frozenset()):
     return {
         RESULT_KEY_DN: o.get(RESULT_KEY_DN, ''),
-        RESULT_KEY_ATTRIBUTES: {
-            k: helpers.ad.format_attribute(k, d[k]) for k in d.keys()
-        }
+        RESULT_KEY_ATTRIBUTES: FormattedAttributes(o.get(RESULT_KEY_ATTRIBUTES, {}), codecs, exclude)
     }
 
-def validate_attributes(d, raise_exception=True):
+# values to add to and remove from a multi-valued attribute, from {"add": [...], "remove": [...]} in a patch
+ValueDelta = namedtuple('ValueDelta', ['add', 'remove'])
+
+def validate_values(k, values, codecs=None):
+    # returns the values encoded for ldap or None if invalid
+    v = helpers.ad.validate_attribute(k, values, codecs=codecs)
+    if type(v) is bool:
+        if not v:
+            return None
+        v = values
+        if not isinstance(v, list):
+            v = [v]
+        return [str(s).encode('utf-8') for s in v]
+    if not isinstance(v, list):
+        v = [v]
+    return [s if isinstance(s, bytes) else str(s).encode('utf-8') for s in v]
+
+def validate_attributes(d, raise_exception=True, codecs=None, deltas=False):
+    # deltas allows ValueDelta values
     valid = {}
     notok = []
     for k in d.keys():
-        v = helpers.ad.validate_attribute(k, d[k])
-#        print('{}: ({}) {} -> ({}) {}'.format(k, type(d[k]), d[k], type(v), str(v)))
-        if type(v) is bool:
-            if v:
-                v = d[k]
-                if not isinstance(v, list):
-                    v = [v]
-                valid[k] = [str(s).encode('utf-8') for s in v]
-            else:
-                notok.append(k)
+        if isinstance(d[k], ValueDelta):
+            if not deltas:
+                raise helpers.errors.BadRequestException('add/remove syntax is only supported by patch: {}'.format(k))
+            add = validate_values(k, d[k].add, codecs) if d[k].add else []
+            remove = validate_values(k, d[k].remove, codecs) if d[k].remove else []
+            v = ValueDelta(add, remove) if add is not None and remove is not None else None
+        else:
+            v = validate_values(k, d[k], codecs)
+        if v is None:
+            notok.append(k)
         else:
-            if not isinstance(v, list):
-                v = [v]
-#            for x in v:
-#                print('{}: {} ({})'.format(k, x, type(x)))
-            valid[k] = [s if isinstance(s, bytes) else str(s).encode('utf-8') for s in v]
+            valid[k] = v
     if raise_exception and len(notok) > 0:
         raise helpers.errors.ValidationError(notok)
     return valid
 
 SearchBehavior = Enum('SearchBehavior', 'EXPECT_ONE EXPECT_ZERO_OR_MORE')
-NO_ATTRIBUTES = ['']
 
 class EmptyResultsError(helpers.errors.Error):
     def __init__(self, message = 'zero results'):
@@ -79,7 +162,39 @@ class NonUniqueResultsError(helpers.errors.Error):
     def __init__(self, message = 'non-unique results'):
         super(NonUniqueResultsError, self).__init__(message)
 
-def search(context, base, scope=None, filter=None, attributes=None, behavior=SearchBehavior.EXPECT_ZERO_OR_MORE, empty_results_error=EmptyResultsError, non_unique_results_error=NonUniqueResultsError):
+class InvalidPageTokenError(helpers.errors.Error):
+    def __init__(self, message = 'invalid page token'):
+        super(InvalidPageTokenError, self).__init__(message)
+
+# errors returned by AD and OpenLDAP for expired or foreign paged results cookies
+STALE_COOKIE_ERRORS = (ldap.UNWILLING_TO_PERFORM, ldap.OPERATIONS_ERROR, ldap.PROTOCOL_ERROR)
+
+def page_sort():
+    # paged searches are sorted by the server on a unique key so that another session can run the search
+    # again and skip to the same place
+    return [helpers.env.get('PAGE_SORT_KEY', 'objectGUID')]
+
+def page_token_params(connection, base, scope, filter, attributes):
+    # a token may only continue the search it was issued for
+    return hashlib.sha256(json.dumps([connection['name'], connection['ldapUrl'], base.lower(), scope, filter, attributes]).encode('utf-8')).hexdigest()[0:32]
+
+def encode_page_token(params, cookie, session_id, offset):
+    # the cookie continues the search on the session that issued it, the offset anywhere else
+    return base64.urlsafe_b64encode(json.dumps({'p': params, 'c': base64.b64encode(cookie).decode('ascii'), 's': session_id, 'o': offset}).encode('utf-8')).decode('ascii')
+
+def decode_page_token(token, params):
+    try:
+        d = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        cookie = base64.b64decode(d['c'])
+        session_id = d.get('s')
+        offset = int(d['o']) if d.get('o') is not None else None
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        raise InvalidPageTokenError()
+    if d.get('p') != params:
+        raise InvalidPageTokenError('page token does not match request')
+    return cookie, session_id, offset
+
+def search_args(base, scope=None, filter=None, attributes=None):
     args = {'base': base}
     if not scope is None:
         args['scope'] = scope
@@ -87,7 +202,52 @@ def search(context, base, scope=None, filter=None, attributes=None, behavior=Sea
         args['filter'] = filter
     if not attributes is None:
         args['attributes'] = attributes
-    entries = context.search(**args)
+    return args
+
+# AD returns at most MaxValRange (1500) values of an attribute per search, as e.g. member;range=0-1499
+RANGE_PATTERN = re.compile(r'^(.+);range=(\d+)-(\d+|\*)$', re.IGNORECASE)
+
+def parse_range(k):
+    # (attribute, low, high or None for the last range) or None if k isn't ranged
+    m = RANGE_PATTERN.match(k)
+    return (m.group(1), int(m.group(2)), None if m.group(3) == '*' else int(m.group(3))) if m else None
+
+def range_attribute(attribute, low, high=None):
+    return '{};range={}-{}'.format(attribute, low, '*' if high is None else high)
+
+def requested_ranges(attributes):
+    # lowercase names of attributes requested with an explicit range, e.g. member;range=0-99
+    return frozenset(r[0].lower() for r in map(parse_range, attributes or []) if r)
+
+def merge_ranges(context, entries, attributes=None, exclude=frozenset()):
+    # fetches the remaining ranges of attributes the server truncated and merges them into plain attribute
+    # names in place, ranges requested explicitly are left as returned. Entries needing more ranges are
+    # fetched in parallel with one round trip per range
+    skipped = requested_ranges(attributes) | exclude
+    pending = {}
+    for i, o in enumerate(entries):
+        attrs = o[RESULT_KEY_ATTRIBUTES]
+        for k in [k for k in attrs if ';' in k]:
+            r = parse_range(k)
+            if r and not r[0].lower() in skipped:
+                attrs[r[0]] = attrs.pop(k)
+                if r[2] is not None:
+                    pending[(i, r[0])] = r[2] + 1
+    while pending:
+        keys = list(pending)
+        found = search_many(context, [search_args(entries[i][RESULT_KEY_DN], SCOPE_BASE, None, [range_attribute(attribute, pending[(i, attribute)])]) for (i, attribute) in keys])
+        pending = {}
+        for (i, attribute), result in zip(keys, found):
+            for k, v in (result[0][RESULT_KEY_ATTRIBUTES].items() if result else []):
+                r = parse_range(k)
+                if r and r[0].lower() == attribute.lower():
+                    entries[i][RESULT_KEY_ATTRIBUTES][attribute] += v
+                    if r[2] is not None:
+                        pending[(i, attribute)] = r[2] + 1
+    return entries
+
+def search(context, base, scope=None, filter=None, attributes=None, behavior=SearchBehavior.EXPECT_ZERO_OR_MORE, empty_results_error=EmptyResultsError, non_unique_results_error=NonUniqueResultsError, exclude=frozenset()):
+    entries = merge_ranges(context, context.search(**search_args(base, scope, filter, attributes)), attributes, exclude)
     if behavior == SearchBehavior.EXPECT_ONE:
         if len(entries) == 0 and empty_results_error:
             raise empty_results_error()
@@ -95,71 +255,253 @@ def search(context, base, scope=None, filter=None, attributes=None, behavior=Sea
             raise non_unique_results_error()
     return entries
 
-def get(connection, base, scope=None, filter=None, attributes=None):
-    with helpers.ldap.SaslBindingContext(**binding_args(connection)) as context:
-        return [externalize(o) for o in search(context, base, scope, filter, attributes)]
+def search_many(context, searches):
+    # independent searches outstanding at once on the session, searches are dicts of search_args,
+    # returns their raw entries in the same order
+    with helpers.ldap.Pipeline(context) as pipeline:
+        for i, args in enumerate(searches):
+            pipeline.search(i, **args)
+        found = pipeline.collect()
+    return [found[i] for i in range(len(searches))]
+
+def get(connection, base, scope=None, filter=None, attributes=None, exclude=frozenset()):
+    codecs = connection_codecs(connection)
+    with helpers.pool.session(**helpers.pool.binding_args(connection)) as context:
+        found = search(context, base, scope, filter, attributes, exclude=exclude)
+        if scope == SCOPE_BASE and len(found) == 1:
+            helpers.extended_dn.remember_base(connection, base, found[0][RESULT_KEY_DN])
+        return [externalize(o, codecs, exclude) for o in found]
+
+def get_page(connection, base, scope=None, filter=None, attributes=None, page_size=helpers.ldap.DEFAULT_PAGE_SIZE, page_token=None, exclude=frozenset()):
+    # returns (entries, next page token) with one search round trip per page while the issuing session
+    # is available. Elsewhere the search is run again up to where the previous page ended, which takes a
+    # round trip per DEFAULT_PAGE_SIZE entries skipped and is only possible if the server sorted the results
+    params = page_token_params(connection, base, scope, filter, attributes)
+    codecs = connection_codecs(connection)
+    args = dict(search_args(base, scope, filter, attributes), sort=page_sort())
+    (cookie, session_id, offset) = decode_page_token(page_token, params) if page_token else (b'', None, 0)
+    with helpers.pool.session(**helpers.pool.binding_args(connection), prefer=session_id) as context:
+        if page_token and context.session_id == session_id:
+            try:
+                (entries, cookie, ordered) = context.search_sorted_page(**args, page_size=page_size, cookie=cookie)
+            except STALE_COOKIE_ERRORS:
+                raise InvalidPageTokenError('page token expired')
+        elif page_token:
+            if offset is None:
+                # the server didn't sort the results, skipping entries could repeat or miss some
+                raise InvalidPageTokenError('page token expired')
+            (entries, cookie, ordered) = skip_page(context, args, offset, page_size)
+        else:
+            (entries, cookie, ordered) = context.search_sorted_page(**args, page_size=page_size)
+        merge_ranges(context, entries, attributes, exclude)
+        offset = offset + len(entries) if ordered and offset is not None else None
+        return [externalize(o, codecs, exclude) for o in entries], encode_page_token(params, cookie, context.session_id, offset) if cookie else None
+
+def skip_page(context, args, offset, page_size):
+    # the page at offset of a new sorted search on context, skipped entries are read in pages sized to end
+    # at offset so that the returned cookie continues right after the page
+    cookie = b''
+    while offset > 0:
+        (skipped, cookie, ordered) = context.search_sorted_page(**args, page_size=min(offset, helpers.ldap.DEFAULT_PAGE_SIZE), cookie=cookie)
+        offset -= len(skipped)
+        if not ordered:
+            raise InvalidPageTokenError('page token expired')
+        if not cookie or not skipped:
+            return [], b'', True
+    return context.search_sorted_page(**args, page_size=page_size, cookie=cookie)
+
+def iterate(connection, base, scope=None, filter=None, attributes=None, exclude=frozenset()):
+    # yields entries page by page while holding the session, memory stays bounded by the page size
+    codecs = connection_codecs(connection)
+    with helpers.pool.session(**helpers.pool.binding_args(connection)) as context:
+        for page in context.search_pages(**search_args(base, scope, filter, attributes)):
+            for o in merge_ranges(context, page, attributes, exclude):
+                yield externalize(o, codecs, exclude)
+
+def fetch_range(context, dn, attribute, low, high=None):
+    # one range of an attribute's values as (values, high) where high is None after the last range
+    found = context.search(dn, SCOPE_BASE, attributes=[range_attribute(attribute, low, high)])
+    if not found:
+        raise EmptyResultsError()
+    values = None
+    for k, v in found[0][RESULT_KEY_ATTRIBUTES].items():
+        r = parse_range(k)
+        if r and r[0].lower() == attribute.lower():
+            return v, r[2]
+        elif k.lower() == attribute.lower():
+            values = v
+    if values is None:
+        # servers without ranged retrieval return nothing for the unknown range option, nor does AD for
+        # an attribute without values
+        found = context.search(dn, SCOPE_BASE, attributes=[attribute])
+        values = next((v for k, v in found[0][RESULT_KEY_ATTRIBUTES].items() if k.lower() == attribute.lower()), []) if found else []
+    # all values, the range is taken from them
+    end = len(values) if high is None else min(high + 1, len(values))
+    return values[low:end], high if end < len(values) else None
+
+def format_values(attribute, values, codecs=None):
+    formatted = helpers.ad.format_attribute(attribute, values, codecs=codecs)
+    return formatted if isinstance(formatted, list) else [formatted]
 
-def delete(connection, base, scope=None,  filter=None):
-    with helpers.ldap.SaslBindingContext(**binding_args(connection)) as context:
-        context.delete(search(context, base, scope, filter, NO_ATTRIBUTES, behavior=SearchBehavior.EXPECT_ONE)[0][RESULT_KEY_DN])
+def encode_range_token(params, low):
+    return base64.urlsafe_b64encode(json.dumps({'p': params, 'r': low}).encode('utf-8')).decode('ascii')
 
-def new_object_dn(container, attributes):
+def decode_range_token(token, params):
+    try:
+        d = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        low = int(d['r'])
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        raise InvalidPageTokenError()
+    if d.get('p') != params:
+        raise InvalidPageTokenError('page token does not match request')
+    return low
+
+def get_values_page(connection, base, attribute, page_size=helpers.ldap.DEFAULT_PAGE_SIZE, page_token=None):
+    # returns (values, next page token) of an attribute of the entry at dn base, one range per page
+    params = page_token_params(connection, base, SCOPE_BASE, None, [attribute])
+    low = decode_range_token(page_token, params) if page_token else 0
+    codecs = connection_codecs(connection)
+    with helpers.pool.session(**helpers.pool.binding_args(connection)) as context:
+        (values, high) = fetch_range(context, base, attribute, low, low + page_size - 1)
+        return format_values(attribute, values, codecs), encode_range_token(params, high + 1) if high is not None else None
+
+def iterate_values(connection, base, attribute):
+    # yields the values of an attribute of the entry at dn base range by range while holding the session
+    codecs = connection_codecs(connection)
+    with helpers.pool.session(**helpers.pool.binding_args(connection)) as context:
+        low = 0
+        while True:
+            (values, high) = fetch_range(context, base, attribute, low)
+            for v in format_values(attribute, values, codecs):
+                yield v
+            if high is None:
+                break
+            low = high + 1
+
+def delete(connection, base, scope=None,  filter=None, context=None):
+    with session(connection, context) as context:
+        dn = search(context, base, scope, filter, NO_ATTRIBUTES, behavior=SearchBehavior.EXPECT_ONE)[0][RESULT_KEY_DN]
+        context.delete(dn)
+    helpers.extended_dn.deleted(connection, dn)
+    membership_invalidate(connection)
+
+def new_object_dn(container, attributes, codecs=None):
     ci = CaseInsensitiveDict(attributes)
-    object_classes = [s.lower() for s in helpers.ad.format_attribute('objectClass', ci['objectClass'])]
+    object_classes = [s.lower() for s in helpers.ad.format_attribute('objectClass', ci['objectClass'], codecs=codecs)]
     if 'organizationalunit' in object_classes:
         attr = 'ou'
     else:
         attr = 'cn'
     if attr in ci:
-        val = helpers.ad.format_attribute(attr, ci[attr])
+        val = helpers.ad.format_attribute(attr, ci[attr], codecs=codecs)
     elif 'name' in ci:
-        val = helpers.ad.format_attribute('name', ci['name'])
+        val = helpers.ad.format_attribute('name', ci['name'], codecs=codecs)
     else:
         raise helpers.errors.MissingAttributeError(attr)
     return '{}={},{}'.format(attr, val[0] if isinstance(val, list) else val, container[RESULT_KEY_DN])
 
-def create(connection, base, data, scope=None, filter=None, attributes=None):
-    with helpers.ldap.SaslBindingContext(**binding_args(connection)) as context:
+def create(connection, base, data, scope=None, filter=None, attributes=None, exclude=frozenset(), context=None, minimal=False):
+    # minimal skips reloading the created entry and returns None
+    codecs = connection_codecs(connection)
+    with session(connection, context) as context:
         container = search(context, base, scope, filter, NO_ATTRIBUTES, behavior=SearchBehavior.EXPECT_ONE)[0]
-        validated = validate_attributes(data)
-        dn = new_object_dn(container, validated)
-        context.add(dn, ldap.modlist.addModlist(validated))
-        return externalize(search(context, dn, scope=SCOPE_BASE, attributes=attributes, behavior=SearchBehavior.EXPECT_ONE, empty_results_error=ReloadAfterModError)[0])
-
-def update(connection, base, data, scope=None, filter=None, attributes=None, partial=True):
-    with helpers.ldap.SaslBindingContext(**binding_args(connection)) as context:
-        old = search(context, base, scope, filter, attributes=None, behavior=SearchBehavior.EXPECT_ONE)[0]
-        old_dn = old[RESULT_KEY_DN]
+        validated = validate_attributes(data, codecs=codecs)
+        dn = new_object_dn(container, validated, codecs)
+        modlist = ldap.modlist.addModlist(validated)
+        context.add(dn, modlist)
+        membership_modified(connection, dn, [(ldap.MOD_ADD, k, v) for (k, v) in modlist])
+        if minimal:
+            return None
+        created = search(context, dn, scope=SCOPE_BASE, attributes=attributes, behavior=SearchBehavior.EXPECT_ONE, empty_results_error=ReloadAfterModError)[0]
+        helpers.extended_dn.remember_entry(connection, created)
+        return externalize(created, codecs, exclude)
+
+PERMISSIVE_MODIFY_CONTROL = LDAPControl('1.2.840.113556.1.4.1413', False)
+
+def value_key(v, dn_valued):
+    return v.decode('utf-8', 'replace').lower() if dn_valued else v
+
+def modifications(k, old, new, codec):
+    # value level changes of a multi-valued attribute from its old values (None if unknown), replace otherwise
+    if old is None or not old or not new or codec.single_value:
+        return [(ldap.MOD_REPLACE, k, new)] if old != new else []
+    dn_valued = codec.syntax in helpers.ad.DN_SYNTAXES
+    old_keys = {value_key(v, dn_valued) for v in old}
+    new_keys = {value_key(v, dn_valued) for v in new}
+    add = [v for v in new if not value_key(v, dn_valued) in old_keys]
+    remove = [v for v in old if not value_key(v, dn_valued) in new_keys]
+    if len(add) + len(remove) > len(new):
+        # mostly new values, replacing is less to send
+        return [(ldap.MOD_REPLACE, k, new)]
+    return delta_modifications(k, ValueDelta(add, remove))
+
+def delta_modifications(k, delta):
+    # removes first so that a value both removed and added ends up present
+    return ([(ldap.MOD_DELETE, k, delta.remove)] if delta.remove else []) + ([(ldap.MOD_ADD, k, delta.add)] if delta.add else [])
+
+def update(connection, base, data, scope=None, filter=None, attributes=None, partial=True, exclude=frozenset(), context=None, minimal=False):
+    # minimal skips reloading the updated entry and returns None
+    attempt = lambda: update_entry(connection, base, data, scope, filter, attributes, partial, exclude, context, minimal)
+    try:
+        return attempt()
+    except ldap.NO_SUCH_OBJECT:
+        # the cached dn of a <GUID=...> or <SID=...> base is stale after a rename outside of the service
+        if not helpers.extended_dn.forget(connection, base):
+            raise
+        return attempt()
+
+def update_entry(connection, base, data, scope=None, filter=None, attributes=None, partial=True, exclude=frozenset(), context=None, minimal=False):
+    codecs = connection_codecs(connection)
+    new_attrs = validate_attributes(data, codecs=codecs, deltas=partial)
+    new_attrs_ci = CaseInsensitiveDict(new_attrs)
+    if len(new_attrs) != len(new_attrs_ci):
+        raise helpers.errors.BadRequestException('Case collision in attribute keys')
+    # patch only compares the attributes it replaces, the rdn is taken from the dn
+    compared = [k for k, v in new_attrs.items() if not isinstance(v, ValueDelta)]
+    with session(connection, context) as context:
+        if partial and scope == SCOPE_BASE and filter is None and all(helpers.ad.attribute_codec(k, codecs=codecs).single_value for k in compared):
+            # patching a dn needs no search when values are only replaced in single-valued attributes (whether
+            # changed or not) or given as add/remove, multi-valued attributes are diffed against their old values
+            old_dn = helpers.extended_dn.resolve(connection, context, base)
+            old_attrs_ci = None
+        else:
+            old = search(context, base, scope, filter, attributes=(compared or NO_ATTRIBUTES) if partial else None, behavior=SearchBehavior.EXPECT_ONE)[0]
+            old_dn = old[RESULT_KEY_DN]
+            if scope == SCOPE_BASE:
+                helpers.extended_dn.remember_base(connection, base, old_dn)
+            old_attrs_ci = CaseInsensitiveDict(old[RESULT_KEY_ATTRIBUTES])
         new_dn = old_dn
-        old_attrs = old[RESULT_KEY_ATTRIBUTES]
-        new_attrs = validate_attributes(data)
-        old_attrs_ci = CaseInsensitiveDict(old_attrs)
-        new_attrs_ci = CaseInsensitiveDict(new_attrs)
-        if len(new_attrs) != len(new_attrs_ci):
-            raise helpers.errors.BadRequestException('Case collision in attribute keys')
-        rdn_attr_key = old_dn.split(',')[0].split('=')[0]
+        old_rdns = ldap.dn.str2dn(old_dn)
+        (rdn_attr_key, old_rdn, flags) = old_rdns[0][0]
+        # the rdn attribute can't be modified, only renamed
+        if old_attrs_ci and rdn_attr_key in old_attrs_ci:
+            del old_attrs_ci[rdn_attr_key]
         # check for rename
-        if rdn_attr_key in old_attrs_ci and rdn_attr_key in new_attrs_ci:
-            old_rdn = helpers.ad.format_attribute(rdn_attr_key, old_attrs_ci[rdn_attr_key])
-            new_rdn = helpers.ad.format_attribute(rdn_attr_key, new_attrs_ci[rdn_attr_key])
+        if rdn_attr_key in new_attrs_ci:
+            if isinstance(new_attrs_ci[rdn_attr_key], ValueDelta):
+                raise helpers.errors.BadRequestException('add/remove syntax is not supported for the rdn attribute: {}'.format(rdn_attr_key))
+            new_rdn = helpers.ad.format_attribute(rdn_attr_key, new_attrs_ci[rdn_attr_key], codecs=codecs)
+            new_rdn = str(new_rdn[0] if isinstance(new_rdn, list) else new_rdn)
+            del new_attrs_ci[rdn_attr_key]
             if old_rdn != new_rdn:
-                new_rdn_formatted = '{}={}'.format(rdn_attr_key, new_rdn)
-                new_dn = ','.join([new_rdn_formatted if i == 0 else s for i, s in enumerate(old_dn.split(','))])
-                del old_attrs_ci[rdn_attr_key]
-                del new_attrs_ci[rdn_attr_key]
-                #print(new_dn)
-                context.rename(old_dn, new_rdn_formatted)
+                new_dn = ldap.dn.dn2str([[(rdn_attr_key, new_rdn, ldap.AVA_STRING)]] + old_rdns[1:])
+                context.rename(old_dn, ldap.dn.dn2str([[(rdn_attr_key, new_rdn, ldap.AVA_STRING)]]))
+                helpers.extended_dn.renamed(connection, old_dn, new_dn)
+                membership_invalidate(connection)
         # build mod list - only delete attributes if not partial (patch)
         modlist = []
         for k in list(new_attrs_ci) if partial else list(old_attrs_ci):
             if (not partial) and k in old_attrs_ci and k not in new_attrs_ci:
                 # delete
                 modlist.append((ldap.MOD_DELETE, k, None))
-            elif k not in old_attrs_ci or old_attrs_ci[k] != new_attrs_ci[k]:
-                # update / replace
-                modlist.append((ldap.MOD_REPLACE, k, new_attrs_ci[k]))
-        #print(modlist)
+            elif isinstance(new_attrs_ci[k], ValueDelta):
+                modlist += delta_modifications(k, new_attrs_ci[k])
+            else:
+                modlist += modifications(k, old_attrs_ci.get(k) if old_attrs_ci is not None else None, new_attrs_ci[k], helpers.ad.attribute_codec(k, codecs=codecs))
         if len(modlist) > 0:
-            context.modify(new_dn, modlist)
-        return externalize(search(context, new_dn, scope=SCOPE_BASE, attributes=attributes, behavior=SearchBehavior.EXPECT_ONE, empty_results_error=ReloadAfterModError)[0])
-
+            # adding present or removing absent values is not an error with AD's permissive modify control
+            context.modify(new_dn, modlist, serverctrls=[PERMISSIVE_MODIFY_CONTROL])
+            membership_modified(connection, new_dn, modlist)
+        if minimal:
+            return None
+        return externalize(search(context, new_dn, scope=SCOPE_BASE, attributes=attributes, behavior=SearchBehavior.EXPECT_ONE, empty_results_error=ReloadAfterModError)[0], codecs, exclude)
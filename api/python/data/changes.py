@@ -0,0 +1,183 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# entries created, modified or deleted under a base since an opaque watermark. DirSync is used where the
+# bound account has the rights for it, otherwise entries are selected by uSNChanged up to the domain
+# controller's highestCommittedUSN and deletions are read from the Deleted Objects container.
+
+import base64
+import binascii
+import json
+import uuid
+import ldap
+from ldap import SCOPE_BASE, SCOPE_SUBTREE
+from ldap.controls import LDAPControl
+import helpers.attributes
+import helpers.env
+import helpers.errors
+import helpers.extended_dn
+import helpers.ldap
+import helpers.metrics
+import helpers.pool
+from helpers.ldap import RESULT_KEY_DN, RESULT_KEY_ATTRIBUTES
+import data.ad
+import data.membership
+
+CREATED = 'created'
+MODIFIED = 'modified'
+DELETED = 'deleted'
+
+DIRSYNC = 'dirsync'
+USN = 'usn'
+METHODS = ('auto', DIRSYNC, USN)
+
+SHOW_DELETED_CONTROL = LDAPControl('1.2.840.113556.1.4.417', True)
+DELETED_OBJECTS_WKGUID = '18e2ea80684f11d2b9aa00c04f79f805'
+DIRSYNC_ANCESTORS_FIRST_ORDER = 0x800
+
+# the bound account lacks the replicating directory changes right or the server doesn't support dirsync
+DIRSYNC_ERRORS = (ldap.INSUFFICIENT_ACCESS, ldap.UNWILLING_TO_PERFORM, ldap.UNAVAILABLE_CRITICAL_EXTENSION)
+
+# attributes of deleted objects, most others are removed when an object is deleted
+DELETED_ATTRIBUTES = ['objectGUID', 'objectSid', 'name', 'lastKnownParent', 'isDeleted', 'uSNChanged']
+
+# attributes telling created, modified and deleted objects apart, hidden from results unless requested
+TRACKING_ATTRIBUTES = ['uSNCreated', 'whenCreated', 'isDeleted', 'lastKnownParent']
+
+class InvalidWatermarkError(helpers.errors.Error):
+    def __init__(self, message = 'invalid watermark'):
+        super(InvalidWatermarkError, self).__init__(message)
+
+class InvalidMethodError(helpers.errors.BadRequestException):
+    def __init__(self, method):
+        super(InvalidMethodError, self).__init__('Invalid method: {}, expected one of {}'.format(method, ', '.join(METHODS)))
+
+def encode_watermark(params, d):
+    return base64.urlsafe_b64encode(json.dumps(dict(d, p=params)).encode('utf-8')).decode('ascii')
+
+def decode_watermark(watermark, params):
+    try:
+        d = json.loads(base64.urlsafe_b64decode(watermark.encode('ascii')))
+        if not d.get('m') in (DIRSYNC, USN):
+            raise ValueError()
+    except (ValueError, TypeError, AttributeError, binascii.Error):
+        raise InvalidWatermarkError()
+    if d.get('p') != params:
+        raise InvalidWatermarkError('watermark does not match request')
+    return d
+
+def under(dn, base):
+    dn = dn.lower()
+    base = base.lower()
+    return dn == base or dn.endswith(',' + base)
+
+def parenthesized(filter):
+    filter = (filter or '(objectClass=*)').strip()
+    return filter if filter.startswith('(') else '({})'.format(filter)
+
+def first_value(attrs, k, default=None):
+    values = attrs.get(k)
+    return values[0].decode('utf-8') if values else default
+
+def tracked(attributes, exclude):
+    # (attributes to fetch, attributes to hide) with the tracking attributes added to a named attribute list
+    if not attributes or '*' in attributes:
+        return attributes, exclude
+    requested = [a.lower() for a in attributes]
+    missing = [a for a in TRACKING_ATTRIBUTES if not a.lower() in requested]
+    return [a for a in attributes if a not in helpers.attributes.NO_ATTRIBUTES] + missing, exclude | {a.lower() for a in missing}
+
+def dirsync_search(context, root, filter, attributes, cookie):
+    return context.search_dirsync(root, parenthesized(filter), attributes, cookie, DIRSYNC_ANCESTORS_FIRST_ORDER)
+
+def record(change, o, codecs, exclude=frozenset()):
+    return dict({'change': change}, **data.ad.externalize(o, codecs, exclude))
+
+def iterate(connection, base, filter=None, attributes=None, exclude=frozenset(), watermark=None, method=None):
+    # yields change records while holding the session and lastly {"watermark": ...} for the next call
+    params = data.ad.page_token_params(connection, base, SCOPE_SUBTREE, filter, attributes)
+    previous = decode_watermark(watermark, params) if watermark else None
+    method = previous['m'] if previous else method or helpers.env.get('CHANGES_METHOD', 'auto')
+    if not method in METHODS:
+        raise InvalidMethodError(method)
+    codecs = data.ad.connection_codecs(connection)
+    (fetched, exclude) = tracked(attributes, exclude)
+    with helpers.pool.session(**helpers.pool.binding_args(connection)) as context:
+        base_dn = helpers.extended_dn.resolve(connection, context, base)
+        root = data.membership.naming_context(context, data.membership.connection_key(connection))
+        if method == 'auto':
+            try:
+                # the first round decides, nothing has been yielded if it is refused
+                first = dirsync_search(context, root, filter, fetched, b'')
+                method = DIRSYNC
+            except DIRSYNC_ERRORS:
+                first = None
+                method = USN
+        else:
+            first = None
+        helpers.metrics.increment('changes.{}'.format(method))
+        if method == DIRSYNC:
+            (d, resync) = yield from dirsync(context, root, base_dn, filter, fetched, exclude, codecs, previous, first)
+        else:
+            (d, resync) = yield from usn(context, root, base_dn, filter, fetched, exclude, codecs, previous)
+        yield dict({'watermark': encode_watermark(params, d)}, **({'resync': True} if resync else {}))
+
+def dirsync(context, root, base, filter, attributes, exclude, codecs, previous, first=None):
+    # dirsync only searches whole naming contexts and returns the attributes that changed, objects
+    # outside of base are skipped and whenCreated is only returned for new objects
+    cookie = base64.b64decode(previous['c']) if previous else b''
+    while True:
+        (entries, cookie, more) = first or dirsync_search(context, root, filter, attributes, cookie)
+        first = None
+        for o in entries:
+            attrs = o[RESULT_KEY_ATTRIBUTES]
+            if first_value(attrs, 'isDeleted', 'FALSE').upper() == 'TRUE':
+                if under(first_value(attrs, 'lastKnownParent', ''), base):
+                    yield record(DELETED, o, codecs)
+            elif under(o[RESULT_KEY_DN], base):
+                yield record(CREATED if 'whenCreated' in attrs else MODIFIED, o, codecs, exclude)
+        if not more:
+            break
+    return {'m': DIRSYNC, 'c': base64.b64encode(cookie).decode('ascii')}, False
+
+def invocation_id(context, server):
+    # identifies the domain controller's database, which changes when it is restored and usns are reused
+    found = context.search(server, SCOPE_BASE, attributes=['invocationId'])
+    values = found[0][RESULT_KEY_ATTRIBUTES].get('invocationId') if found else None
+    return str(uuid.UUID(bytes_le=values[0])) if values else server
+
+def usn(context, root, base, filter, attributes, exclude, codecs, previous):
+    # usns are local to a domain controller's database, a watermark issued by another one (or before a
+    # restore) restarts from scratch, reporting every entry as created
+    dse = context.search('', SCOPE_BASE, attributes=['highestCommittedUSN', 'dsServiceName'])[0][RESULT_KEY_ATTRIBUTES]
+    high = int(first_value(dse, 'highestCommittedUSN'))
+    invocation = invocation_id(context, first_value(dse, 'dsServiceName'))
+    resync = bool(previous) and previous.get('i') != invocation
+    if resync:
+        helpers.metrics.increment('changes.usn.resync')
+        previous = None
+    low = int(previous['u']) if previous else 0
+    changed = '(&{}(uSNChanged>={})(uSNChanged<={}))'.format(parenthesized(filter), low + 1, high)
+    for page in context.search_pages(base, SCOPE_SUBTREE, changed, attributes):
+        for o in data.ad.merge_ranges(context, page, attributes, exclude):
+            created = int(first_value(o[RESULT_KEY_ATTRIBUTES], 'uSNCreated', '0')) > low
+            yield record(CREATED if created or not previous else MODIFIED, o, codecs, exclude)
+    if previous:
+        deleted = '(&(isDeleted=TRUE)(uSNChanged>={})(uSNChanged<={}))'.format(low + 1, high)
+        container = '<WKGUID={},{}>'.format(DELETED_OBJECTS_WKGUID, root)
+        for page in context.search_pages(container, SCOPE_SUBTREE, deleted, DELETED_ATTRIBUTES, serverctrls=[SHOW_DELETED_CONTROL]):
+            for o in page:
+                if under(first_value(o[RESULT_KEY_ATTRIBUTES], 'lastKnownParent', ''), base):
+                    yield record(DELETED, o, codecs)
+    return {'m': USN, 'u': high, 'i': invocation}, resync
@@ -13,14 +13,25 @@
 # limitations under the License.
 
 import os
+import copy
 import helpers.kms
 import helpers.env
 import helpers.metadata
 import helpers.errors
+import helpers.pool
+import helpers.cache
+import helpers.attributes
 from google.cloud import datastore
+from google.api_core.exceptions import BadRequest
 
 ds = datastore.Client()
 
+# decrypted connections are held in memory only
+cache = helpers.cache.TTLCache('connections',
+        ttl=helpers.env.get_int('CONNECTION_CACHE_TTL_SECONDS', 60),
+        max_size=helpers.env.get_int('CONNECTION_CACHE_MAX_SIZE', 128),
+        refresh_ahead=helpers.env.get_int('CONNECTION_CACHE_REFRESH_SECONDS', None))
+
 def get_kms_tuple():
     return (
             helpers.env.get("KMS_PROJECT", helpers.metadata.get("project/project-id")),
@@ -29,11 +40,31 @@ def get_kms_tuple():
             helpers.env.get("KMS_KEY")
             )
 
+# unwrapped data keys keyed by their wrapped form, so KMS is only called on cold start or key rotation
+data_keys = helpers.cache.TTLCache('data-keys',
+        ttl=helpers.env.get_int('DATA_KEY_CACHE_TTL_SECONDS', 3600),
+        max_size=helpers.env.get_int('CONNECTION_CACHE_MAX_SIZE', 128))
+
+def envelope():
+    return helpers.env.get('ENCRYPTION_MODE', 'envelope') == 'envelope'
+
 def encrypt(s):
-    return helpers.kms.encrypt_symmetric(*get_kms_tuple(), s)
+    if envelope():
+        key = helpers.kms.generate_data_key()
+        wrapped = helpers.kms.encrypt_symmetric(*get_kms_tuple(), key)
+        data_keys.put(wrapped, key)
+        return {'bind-password': helpers.kms.encrypt_local(key, s), 'bind-password-key': wrapped}
+    else:
+        return {'bind-password': helpers.kms.encrypt_symmetric(*get_kms_tuple(), s), 'bind-password-key': None}
 
-def decrypt(s):
-    return helpers.kms.decrypt_symmetric(*get_kms_tuple(), s)
+def decrypt(o):
+    wrapped = o.get('bind-password-key')
+    if wrapped:
+        key = data_keys.get(wrapped, lambda: helpers.kms.decrypt_symmetric(*get_kms_tuple(), wrapped, encoding=None))
+        return helpers.kms.decrypt_local(key, o['bind-password'])
+    else:
+        # written before envelope encryption or with ENCRYPTION_MODE=kms
+        return helpers.kms.decrypt_symmetric(*get_kms_tuple(), o['bind-password'])
 
 _kind = 'active-directory-user-management-api:connection'
 
@@ -54,72 +85,170 @@ def internalize(o, partial=False):
     else:
         missing.append('credentials.user')
     if 'password' in creds:
-        d['bind-password'] = encrypt(creds['password'])
+        d.update(encrypt(creds['password']))
     else:
         missing.append('credentials.password')
+    if 'attributeProfiles' in o:
+        d['attribute-profiles'] = helpers.attributes.validate_profiles(o['attributeProfiles'])
+    if 'defaultAttributeProfile' in o:
+        d['default-attribute-profile'] = o['defaultAttributeProfile']
     if len(missing) > 0 and not partial:
         raise helpers.errors.MissingAttributeError(missing)
     else:
         return d
 
-def externalize(o):
-    return {
+def externalize(o, secrets=True):
+    d = {
         'name': o['name'],
         'ldapUrl': o['ldap-url'],
         'credentials': {
-            'user': o['bind-user'],
-            'password': decrypt(o['bind-password'])
+            'user': o['bind-user']
         }}
+    if o.get('attribute-profiles'):
+        d['attributeProfiles'] = dict(o['attribute-profiles'])
+    if o.get('default-attribute-profile'):
+        d['defaultAttributeProfile'] = o['default-attribute-profile']
+    if secrets:
+        d['credentials']['password'] = decrypt(o)
+    return d
+
+# listings never decrypt passwords since responses mask them anyway
 
 def get_all():
     q = ds.query(kind=_kind)
-    return [externalize(x) for x in list(q.fetch())]
+    return [externalize(x, secrets=False) for x in list(q.fetch())]
 
-def get(name):
+def get_page(page_size, page_token=None):
+    q = ds.query(kind=_kind)
+    try:
+        # iterating follows short batches until the limit or the end of the results
+        it = q.fetch(limit=page_size, start_cursor=page_token)
+        page = [externalize(x, secrets=False) for x in it]
+    except (ValueError, BadRequest):
+        raise helpers.errors.BadRequestException('Invalid page token')
+    # no token once datastore reports no more results, a limit reached exactly at the end is checked
+    # with a keys only lookup so that the last page doesn't link to an empty one
+    token = it.next_page_token
+    if token and not has_more(token):
+        token = None
+    return page, token.decode('ascii') if isinstance(token, bytes) else token
+
+def has_more(cursor):
+    q = ds.query(kind=_kind)
+    q.keys_only()
+    return len(list(q.fetch(limit=1, start_cursor=cursor))) > 0
+
+def key(name):
+    return ds.key(_kind, name)
+
+def find(name):
+    # connections are keyed by name, entities created before that are found by query until migrated
+    entity = ds.get(key(name))
+    return entity if entity is not None else find_unmigrated(name)
+
+def find_unmigrated(name):
     q = ds.query(kind=_kind)
     q.add_filter('name', '=', name)
     l = list(q.fetch(limit=1))
-    if len(l) < 1:
+    return l[0] if len(l) > 0 else None
+
+def get(name):
+    # callers (e.g. mask_pwd) may modify the result so never hand out the cached object
+    return copy.deepcopy(cache.get(name, lambda: load(name)))
+
+def get_multi(names):
+    # connections by name, those not cached read with one batched lookup, missing names are omitted
+    loaded = {name: cache.get(name) for name in names}
+    missing = [name for name, o in loaded.items() if o is None]
+    if missing:
+        found = {x.key.name: x for x in ds.get_multi([key(name) for name in missing])}
+        for name in missing:
+            entity = found[name] if name in found else find_unmigrated(name)
+            if entity is not None:
+                loaded[name] = externalize(entity)
+                cache.put(name, loaded[name])
+    return [copy.deepcopy(loaded[name]) for name in names if loaded[name] is not None]
+
+def load(name):
+    entity = find(name)
+    if entity is None:
         raise helpers.errors.NotFoundException('Resource not found: {}'.format(name))
     else:
-        return externalize(l[0])
+        return externalize(entity)
 
 def delete(name):
     with ds.transaction() as t:
-        q = ds.query(kind=_kind)
-        q.add_filter('name', '=', name)
-        l = list(q.fetch(limit=1))
-        if len(l) < 1:
+        entity = find(name)
+        if entity is None:
             raise helpers.errors.NotFoundException('Resource not found: {}'.format(name))
         else:
-            entity = l[0]
             t.delete(entity.key)
+    cache.invalidate(name)
+    helpers.pool.invalidate(name)
 
 def create(data):
     with ds.transaction() as t:
-        q = ds.query(kind=_kind)
-        q.add_filter('name', '=', data['name'])
-        l = list(q.fetch(limit=1))
-        if len(l) > 0:
+        if find(data['name']) is not None:
             raise helpers.errors.AlreadyExistsException('Resource already exists: {}'.format(data['name']))
         else:
-            entity = datastore.Entity(ds.key(_kind))
+            entity = datastore.Entity(key(data['name']))
             entity.update(internalize(data))
             t.put(entity)
-            return externalize(entity)
+    cache.invalidate(data['name'])
+    return externalize(entity)
 
 def update(name, data, partial=False):
     if name != data.get('name', name):
         raise helpers.errors.BadRequestException('Resource name mismatch: {}'.format(data['name']))
     with ds.transaction() as t:
-        q = ds.query(kind=_kind)
-        q.add_filter('name', '=', name)
-        l = list(q.fetch(limit=1))
-        if len(l) < 1:
+        entity = find(name)
+        if entity is None:
             raise helpers.errors.NotFoundException('Resource not found: {}'.format(name))
         else:
-            entity = l[0]
+            if entity.key.name != name:
+                entity = rekey(t, entity)
             entity.update(internalize(data, partial=partial))
             t.put(entity)
-            return externalize(entity)
+    cache.invalidate(name)
+    helpers.pool.invalidate(name)
+    return externalize(entity)
+
+def rekey(t, entity):
+    # move a query-keyed entity to its name key within transaction t
+    keyed = datastore.Entity(key(entity['name']))
+    keyed.update(entity)
+    t.delete(entity.key)
+    return keyed
+
+def migrate_keys():
+    # one-time move of query-keyed entities to name keys, returns the names of migrated connections
+    migrated = []
+    for x in list(ds.query(kind=_kind).fetch()):
+        if x.key.name == x['name']:
+            continue
+        with ds.transaction() as t:
+            # the entity and its name key in one lookup
+            found = {e.key: e for e in ds.get_multi([x.key, key(x['name'])])}
+            entity = found.get(x.key)
+            if entity and entity['name'] == x['name'] and not key(x['name']) in found:
+                t.put(rekey(t, entity))
+                migrated.append(entity['name'])
+    for name in migrated:
+        cache.invalidate(name)
+    return migrated
 
+def migrate_encryption():
+    # re-encrypt passwords stored before envelope encryption, returns the names of migrated connections
+    migrated = []
+    for x in list(ds.query(kind=_kind).fetch()):
+        if x.get('bind-password-key'):
+            continue
+        with ds.transaction() as t:
+            entity = ds.get(x.key)
+            if entity and not entity.get('bind-password-key'):
+                entity.update(encrypt(decrypt(entity)))
+                t.put(entity)
+                migrated.append(entity['name'])
+    for name in migrated:
+        cache.invalidate(name)
+    return migrated
@@ -0,0 +1,181 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# transitive group membership, resolved either by AD's LDAP_MATCHING_RULE_IN_CHAIN in a single search
+# or by a breadth first walk of a per connection graph of direct memberships, loading the edges missing
+# from each level with batched OR filters. Edges and resolved results expire after MEMBERSHIP_CACHE_SECONDS
+# and are invalidated early by the service's own writes.
+
+import ldap
+import ldap.dn
+import ldap.filter
+from ldap import SCOPE_BASE, SCOPE_SUBTREE
+import helpers.attributes
+import helpers.cache
+import helpers.env
+import helpers.errors
+import helpers.metrics
+import helpers.pool
+from helpers.ldap import RESULT_KEY_DN, RESULT_KEY_ATTRIBUTES
+import data.ad
+
+IN_CHAIN = '1.2.840.113556.1.4.1941'
+
+# groups an object is effectively in (following memberOf) and objects effectively in a group (following member)
+GROUPS = 'groups'
+MEMBERS = 'members'
+
+METHODS = ('auto', 'chain', 'graph')
+
+# direct memberships keyed by (connection, direction, dn) holding tuples of (dn, is group)
+edges = helpers.cache.TTLCache('membership-edges',
+        ttl=helpers.env.get_int('MEMBERSHIP_CACHE_SECONDS', 300),
+        max_size=helpers.env.get_int('MEMBERSHIP_CACHE_MAX_SIZE', 100000))
+
+# resolved transitive memberships keyed by (connection, direction, dn) holding lists of dns
+results = helpers.cache.TTLCache('membership-results',
+        ttl=helpers.env.get_int('MEMBERSHIP_CACHE_SECONDS', 300),
+        max_size=helpers.env.get_int('MEMBERSHIP_CACHE_MAX_SIZE', 100000))
+
+naming_contexts = helpers.cache.TTLCache('naming-contexts', ttl=3600)
+
+class InvalidMethodError(helpers.errors.BadRequestException):
+    def __init__(self, method):
+        super(InvalidMethodError, self).__init__('Invalid method: {}, expected one of {}'.format(method, ', '.join(METHODS)))
+
+def connection_key(connection):
+    return (connection['name'], connection['ldapUrl'])
+
+def normalize(dn):
+    try:
+        return ldap.dn.dn2str(ldap.dn.str2dn(dn)).lower()
+    except ldap.DECODING_ERROR:
+        return dn.lower()
+
+def naming_context(context, ck):
+    def load():
+        root = context.search('', scope=SCOPE_BASE, attributes=['defaultNamingContext'])
+        return root[0][RESULT_KEY_ATTRIBUTES]['defaultNamingContext'][0].decode('utf-8')
+    return naming_contexts.get(ck, load)
+
+def resolve(connection, base, direction, method=None):
+    # returns the dns of all groups base is effectively in, or all objects effectively in group base
+    method = method or helpers.env.get('MEMBERSHIP_METHOD', 'auto')
+    if not method in METHODS:
+        raise InvalidMethodError(method)
+    ck = connection_key(connection)
+    found = results.get((ck, direction, normalize(base))) if method == 'auto' else None
+    if found is not None:
+        return found
+    with helpers.pool.session(**helpers.pool.binding_args(connection)) as context:
+        # resolving the entry first gives a 404 for missing objects and the dn as the directory spells it
+        dn = data.ad.search(context, base, SCOPE_BASE, None, helpers.attributes.NO_ATTRIBUTES, behavior=data.ad.SearchBehavior.EXPECT_ONE)[0][RESULT_KEY_DN]
+        root = naming_context(context, ck)
+        if method == 'auto':
+            # walk the graph when the cache has a head start, otherwise one in chain search is cheaper
+            method = 'graph' if edges.get((ck, direction, normalize(dn))) is not None else 'chain'
+            try:
+                found = chain(context, root, dn, direction) if method == 'chain' else None
+            except (ldap.INAPPROPRIATE_MATCHING, ldap.UNWILLING_TO_PERFORM, ldap.TIMELIMIT_EXCEEDED):
+                # not AD or too expensive for the server
+                method = 'graph'
+        elif method == 'chain':
+            found = chain(context, root, dn, direction)
+        if method == 'graph':
+            found = walk(context, ck, root, dn, direction)
+    helpers.metrics.increment('membership.{}'.format(method))
+    results.put((ck, direction, normalize(base)), found)
+    if normalize(dn) != normalize(base):
+        results.put((ck, direction, normalize(dn)), found)
+    return found
+
+def chain(context, root, dn, direction):
+    attribute = 'member' if direction == GROUPS else 'memberOf'
+    filter = '({}:{}:={})'.format(attribute, IN_CHAIN, ldap.filter.escape_filter_chars(dn))
+    return [o[RESULT_KEY_DN] for o in context.search(root, SCOPE_SUBTREE, filter, helpers.attributes.NO_ATTRIBUTES)]
+
+def walk(context, ck, root, dn, direction):
+    # breadth first over direct memberships, cycles are visited once and include dn if it is its own member
+    seen = set()
+    found = []
+    frontier = [dn]
+    while frontier:
+        level = load_edges(context, ck, root, frontier, direction)
+        frontier = []
+        for d in level:
+            for (n, is_group) in d:
+                k = normalize(n)
+                if not k in seen:
+                    seen.add(k)
+                    found.append(n)
+                    if is_group:
+                        frontier.append(n)
+    return found
+
+def batches(dns):
+    size = max(helpers.env.get_int('MEMBERSHIP_BATCH_SIZE', 50), 1)
+    return [dns[i:i + size] for i in range(0, len(dns), size)]
+
+def any_of(attribute, dns):
+    return '(|{})'.format(''.join('({}={})'.format(attribute, ldap.filter.escape_filter_chars(dn)) for dn in dns))
+
+def load_edges(context, ck, root, dns, direction):
+    # returns the direct memberships of dns in the same order, fetching those not cached
+    keys = [normalize(dn) for dn in dns]
+    level = [edges.get((ck, direction, k)) for k in keys]
+    missing = [dn for dn, d in zip(dns, level) if d is None]
+    if not missing:
+        return level
+    loaded = {k: [] for k, d in zip(keys, level) if d is None}
+    if direction == GROUPS:
+        # results are bounded by the batch size, so the batches can be outstanding at once
+        found = data.ad.search_many(context, [data.ad.search_args(root, SCOPE_SUBTREE, any_of('distinguishedName', b), ['memberOf']) for b in batches(missing)])
+        for o in data.ad.merge_ranges(context, [o for entries in found for o in entries]):
+            loaded[normalize(o[RESULT_KEY_DN])] = [(v.decode('utf-8'), True) for v in o[RESULT_KEY_ATTRIBUTES].get('memberOf', [])]
+    else:
+        # large groups need paging, one batch at a time
+        for b in batches(missing):
+            for o in data.ad.search(context, root, SCOPE_SUBTREE, any_of('memberOf', b), ['memberOf', 'objectClass']):
+                attrs = o[RESULT_KEY_ATTRIBUTES]
+                is_group = any(v.lower() == b'group' for v in attrs.get('objectClass', []))
+                for v in attrs.get('memberOf', []):
+                    d = loaded.get(normalize(v.decode('utf-8')))
+                    if d is not None:
+                        d.append((o[RESULT_KEY_DN], is_group))
+    for k, d in loaded.items():
+        edges.put((ck, direction, k), tuple(d))
+    return [d if d is not None else tuple(loaded[k]) for k, d in zip(keys, level)]
+
+def invalidate(connection, dns=None):
+    # drops cached memberships of dns or, if None, everything cached for the connection
+    ck = connection_key(connection)
+    results.invalidate_matching(lambda k: k[0] == ck)
+    if dns is None:
+        edges.invalidate_matching(lambda k: k[0] == ck)
+    else:
+        for dn in dns:
+            for direction in (GROUPS, MEMBERS):
+                edges.invalidate((ck, direction, normalize(dn)))
+
+def modified(connection, dn, modlist):
+    # invalidates after a write of modlist to dn, replacing members drops the whole connection as the
+    # previous members are unknown
+    dns = []
+    for (op, k, values) in modlist:
+        if k.lower() == 'member':
+            if op == ldap.MOD_REPLACE or values is None:
+                return invalidate(connection)
+            dns += [v.decode('utf-8') if isinstance(v, bytes) else v for v in values]
+    if dns:
+        invalidate(connection, [dn] + dns)
@@ -0,0 +1,144 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# per connection attribute codecs compiled from the directory's own schema, so schema extensions
+# (e.g. Exchange) are formatted correctly. Discovery and change checks run in the background and
+# requests use the bundled AD schema until a directory's schema is available. The attribute type
+# definitions are cached on disk as json and compiled again when loaded.
+
+import os
+import sys
+import json
+import time
+import stat
+import hashlib
+import tempfile
+import threading
+from ldap3.protocol.rfc4512 import SchemaInfo
+from ldap import SCOPE_BASE
+import helpers.ad
+import helpers.env
+import helpers.pool
+from helpers.ldap import RESULT_KEY_ATTRIBUTES
+
+CACHE_VERSION = 1
+
+class Entry:
+    def __init__(self, codecs=None, stamp=None, checked=None):
+        self.codecs = codecs # None until discovered, meaning the bundled defaults
+        self.stamp = stamp
+        self.checked = time.monotonic() if checked is None else checked
+        self.loaded = False # whether the disk cache was read
+
+entries = {}
+refreshing = set()
+lock = threading.Lock()
+
+def enabled():
+    return helpers.env.get('SCHEMA_DISCOVERY', 'true').lower() == 'true'
+
+def key(connection):
+    return (connection['name'], connection['ldapUrl'])
+
+def cache_dir():
+    # private to the service's user, None (no disk cache) if someone else could write to it
+    d = helpers.env.get('SCHEMA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ad-schema-{}'.format(os.getuid())))
+    os.makedirs(d, mode=0o700, exist_ok=True)
+    st = os.lstat(d)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        print('schema cache disabled, {} is not private to the service'.format(d), file=sys.stderr)
+        return None
+    return d
+
+def cache_path(k):
+    d = cache_dir()
+    return os.path.join(d, hashlib.sha256('{}\0{}'.format(*k).encode('utf-8')).hexdigest() + '.json') if d else None
+
+def codecs(connection):
+    # returns the connection's codecs or None for the bundled defaults, never waits on the directory
+    if not enabled():
+        return None
+    k = key(connection)
+    with lock:
+        entry = entries.setdefault(k, Entry(checked=float('-inf')))
+    if time.monotonic() - entry.checked > helpers.env.get_int('SCHEMA_CHECK_SECONDS', 3600):
+        schedule_refresh(connection, k)
+    return entry.codecs
+
+def schedule_refresh(connection, k):
+    with lock:
+        if k in refreshing:
+            return
+        refreshing.add(k)
+        entries[k].checked = time.monotonic() # don't reschedule while running or after failing
+    threading.Thread(target=refresh, args=(connection, k), daemon=True).start()
+
+def refresh(connection, k):
+    try:
+        with lock:
+            entry = entries[k]
+        if not entry.loaded:
+            # codecs from a previous process, still checked against the directory below
+            entry = read_cache(k)
+            with lock:
+                entries[k] = entry
+        with helpers.pool.session(**helpers.pool.binding_args(connection)) as context:
+            root = context.search('', scope=SCOPE_BASE, attributes=['subschemaSubentry'])
+            dn = root[0][RESULT_KEY_ATTRIBUTES]['subschemaSubentry'][0].decode('utf-8')
+            found = context.search(dn, scope=SCOPE_BASE, attributes=['modifyTimestamp'])
+            stamp = found[0][RESULT_KEY_ATTRIBUTES].get('modifyTimestamp', [b''])[0].decode('utf-8')
+            if entry.codecs is None or entry.stamp != stamp:
+                found = context.search(dn, scope=SCOPE_BASE, attributes=['attributeTypes'])
+                definitions = [x.decode('utf-8') for x in found[0][RESULT_KEY_ATTRIBUTES].get('attributeTypes', [])]
+                entry = Entry(compile_codecs(dn, definitions), stamp)
+                entry.loaded = True
+                write_cache(k, dn, definitions, stamp)
+                with lock:
+                    entries[k] = entry
+    except Exception as e:
+        print('schema discovery failed for {}: {}'.format(k[0], e), file=sys.stderr)
+    finally:
+        with lock:
+            refreshing.discard(k)
+
+def compile_codecs(dn, definitions):
+    attributes = {'attributeTypes': definitions}
+    schema = SchemaInfo(dn, attributes, {'attributeTypes': [x.encode('utf-8') for x in definitions]})
+    d = dict(helpers.ad.snapshot()['codecs'])
+    d.update(helpers.ad.compile_codecs(schema, custom_tuples=helpers.ad.snapshot()['custom_tuples']))
+    return d
+
+def read_cache(k):
+    # an entry that needs checking right away, with codecs compiled from definitions cached by a previous process
+    entry = Entry(checked=float('-inf'))
+    entry.loaded = True
+    try:
+        path = cache_path(k)
+        if path:
+            with open(path, 'r', encoding='utf-8') as f:
+                d = json.load(f)
+            if d.get('version') == CACHE_VERSION:
+                entry.codecs = compile_codecs(d['dn'], d['attributeTypes'])
+                entry.stamp = d['stamp']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return entry
+
+def write_cache(k, dn, definitions, stamp):
+    path = cache_path(k)
+    if not path:
+        return
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(path), delete=False) as f:
+        json.dump({'version': CACHE_VERSION, 'stamp': stamp, 'dn': dn, 'attributeTypes': definitions}, f)
+    os.replace(f.name, path)
@@ -20,4 +20,5 @@ export KMS_PROJECT=""
 export KMS_LOCATION="global"
 export KMS_KEYRING="active-directory-user-management-api"
 export KMS_KEY="ldap-bind-secrets"
+export ENCRYPTION_MODE="envelope"
 
@@ -12,16 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from ldap3.protocol.schemas.ad2012R2 import ad_2012_r2_schema, ad_2012_r2_dsa_info
 from ldap3.protocol.rfc4512 import SchemaInfo, DsaInfo
 from ldap3.protocol.formatters.standard import standard_formatter, format_attribute_values, find_attribute_validator, find_attribute_helpers, validate_generic_single_value
 from ldap3.protocol.formatters import standard, formatters, validators
 from ldap3 import SEQUENCE_TYPES, STRING_TYPES
 from ldap3.utils.conv import to_unicode
 from datetime import datetime, timezone
-
-schema = SchemaInfo.from_json(ad_2012_r2_schema)
-info = DsaInfo.from_json(ad_2012_r2_dsa_info, schema)
+from collections import namedtuple
+from functools import partial
+import base64
+import os
+import pickle
+import threading
+import ldap3
 
 def validate_attribute_unicodePwd(v):
     if isinstance(v, SEQUENCE_TYPES):
@@ -85,16 +88,19 @@ custom_validator = {
     '2.16.840.1.113719.1.1.5.1.19': validate_time_tenths,           # reformat with .0 to match AD format
     }
 
-def attribute_type(k):
-    return schema.attribute_types.get(k, None)
+def load_schema():
+    # parsing the bundled AD 2012 R2 schema is slow, only done to build a snapshot
+    from ldap3.protocol.schemas.ad2012R2 import ad_2012_r2_schema
+    return SchemaInfo.from_json(ad_2012_r2_schema)
 
-custom_tuples = { # build dictionary of custom formatter and validator tuples filling in missing values from defaults
-    k: (
-        custom_formatter.get(k, standard.find_attribute_helpers(attribute_type(k), k, None)[0]),
-        custom_validator.get(k, standard.find_attribute_helpers(attribute_type(k), k, None)[1])
-    )
-    for k in list(custom_formatter.keys()) + list(custom_validator.keys())
-}
+def build_custom_tuples(schema):
+    return { # build dictionary of custom formatter and validator tuples filling in missing values from defaults
+        k: (
+            custom_formatter.get(k, standard.find_attribute_helpers(schema.attribute_types.get(k, None), k, None)[0]),
+            custom_validator.get(k, standard.find_attribute_helpers(schema.attribute_types.get(k, None), k, None)[1])
+        )
+        for k in list(custom_formatter.keys()) + list(custom_validator.keys())
+    }
 
 def attribute_formatter(oid):
     return standard_formatter.get(oid, (None, None))[0]
@@ -102,11 +108,155 @@ def attribute_formatter(oid):
 def attribute_validator(oid):
     return standard_formatter.get(oid, (None, None))[1]
 
-def format_attribute(k, v, customize=True):
-    return format_attribute_values(schema, k, v, custom_formatter if customize else None)
+def deserialize_timestamp(v):
+    # return naive datetime adjusted to utc
+    return datetime.fromisoformat(v).astimezone(tz=timezone.utc).replace(tzinfo=None)
+
+def deserialize_timedelta(v):
+    return int(-10000000 * float(v))
+
+def deserialize_binary(v):
+    return base64.b64decode(v)
+
+def deserialize_identity(v):
+    return v
+
+def deserialize_each(f, v):
+    return f(v) if not isinstance(v, list) else [f(i) for i in v]
+
+def deserialize_values(f):
+    # apply f to a single value or to each value of a list, picklable for the schema snapshot
+    return partial(deserialize_each, f)
+
+def deserialize_accountExpires(v):
+    try:
+        return deserialize_values(deserialize_timestamp)(v)
+    except:
+        return v # can be literal "never" so allow through if doesn't parse
+
+ATTRS_SHORT_CIRCUIT = [x.lower() for x in ['unicodePwd', 'userPassword']]
+
+def find_deserializer(attr_type, k, custom_tuples):
+    # short-circuit deserialization for some known string attributes
+    if k.lower() in ATTRS_SHORT_CIRCUIT:
+        return deserialize_identity
+    attribute_helpers = find_attribute_helpers(attr_type, k, custom_tuples)
+    formatter = formatters.format_unicode if not attribute_helpers[0] else attribute_helpers[0]
+    validator = None if not attribute_helpers[1] else attribute_helpers[1]
+    if formatter is formatters.format_ad_timestamp:
+        if validator is validators.validate_zero_and_minus_one_and_positive_int:
+            return deserialize_identity # don't deserialize as timestamp b/c pwdLastSet should be literal 0 or -1, only system can set timestamp value
+        else:
+            return deserialize_values(deserialize_timestamp)
+    elif formatter is formatters.format_time:
+        return deserialize_values(deserialize_timestamp)
+    elif formatter is formatters.format_ad_timedelta:
+        return deserialize_values(deserialize_timedelta)
+    elif formatter is formatters.format_binary:
+        return deserialize_values(deserialize_binary)
+    elif formatter is format_attribute_accountExpires:
+        return deserialize_accountExpires
+    else:
+        return deserialize_identity
+
+# everything needed to format, validate and deserialize values of one attribute type
+AttributeCodec = namedtuple('AttributeCodec', ['formatter', 'validator', 'deserializer', 'single_value', 'is_binary', 'syntax'])
+
+def compile_codec(attr_type, k, customize=True, custom_tuples=None):
+    # same resolution as ldap3 format_attribute_values and find_attribute_validator, done once per attribute type
+    single_value = bool(attr_type and attr_type.single_value)
+    found = find_attribute_helpers(attr_type, k, custom_formatter if customize else None)
+    if not isinstance(found, tuple): # custom formatter
+        formatter = found
+    else:
+        formatter = formatters.format_unicode if not found[0] else found[0]
+    found = find_attribute_helpers(attr_type, k, custom_validator if customize else None)
+    if not isinstance(found, tuple): # custom validator
+        validator = found
+    elif found[1]:
+        validator = found[1]
+    else:
+        validator = validate_generic_single_value if single_value else validators.always_valid
+    return AttributeCodec(formatter, validator, find_deserializer(attr_type, k, custom_tuples or snapshot()['custom_tuples']), single_value, formatter is formatters.format_binary, attr_type.syntax if attr_type else None)
+
+def compile_codecs(schema, customize=True, oids=None, custom_tuples=None):
+    # maps lowercased names and oids to codecs, optionally only for attribute types with the given oids
+    codecs = {}
+    for attr_type in {id(x): x for x in schema.attribute_types.values()}.values():
+        if oids is not None and not attr_type.oid in oids:
+            continue
+        names = attr_type.name if isinstance(attr_type.name, SEQUENCE_TYPES) else [attr_type.name]
+        codec = compile_codec(attr_type, names[0], customize, custom_tuples)
+        for k in list(names) + [attr_type.oid]:
+            codecs[k.lower()] = codec
+    return codecs
+
+SNAPSHOT_VERSION = 2
+
+# syntaxes whose values are (or end with) distinguished names, compared case-insensitively
+DN_SYNTAXES = frozenset([
+    '1.3.6.1.4.1.1466.115.121.1.12', # DN
+    '1.2.840.113556.1.4.903', # Object(DN-Binary)
+    '1.2.840.113556.1.4.904' # Object(DN-String)
+])
+SNAPSHOT_PATH = os.path.join(os.path.dirname(__file__), 'ad_schema.pickle')
+
+def build_snapshot():
+    schema = load_schema()
+    custom_tuples = build_custom_tuples(schema)
+    return {
+        'version': (SNAPSHOT_VERSION, ldap3.__version__),
+        'custom_tuples': custom_tuples,
+        'codecs': compile_codecs(schema, custom_tuples=custom_tuples),
+        # the standard codecs behind custom overrides, which delegate to them
+        'standard_codecs': compile_codecs(schema, customize=False, oids=set(custom_tuples.keys()), custom_tuples=custom_tuples)
+        }
+
+def write_snapshot(path=SNAPSHOT_PATH):
+    with open(path, 'wb') as f:
+        pickle.dump(build_snapshot(), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+loaded = None
+loaded_lock = threading.Lock()
+
+def snapshot():
+    # compiled codecs, loaded on first use from the snapshot written at build time by build_schema.py
+    global loaded
+    if loaded is None:
+        with loaded_lock:
+            if loaded is None:
+                try:
+                    with open(SNAPSHOT_PATH, 'rb') as f:
+                        d = pickle.load(f)
+                    if d.get('version') != (SNAPSHOT_VERSION, ldap3.__version__):
+                        raise ValueError('stale schema snapshot')
+                except (OSError, EOFError, ValueError, AttributeError, ImportError, pickle.UnpicklingError):
+                    d = build_snapshot()
+                loaded = d
+    return loaded
+
+def attribute_codec(k, customize=True, codecs=None):
+    # codecs overrides the bundled customized codecs, e.g. with those compiled from a directory's schema
+    table = codecs if customize and codecs is not None else snapshot()['codecs' if customize else 'standard_codecs']
+    codec = table.get(k.lower())
+    if codec is None:
+        # not in schema, e.g. ranged or otherwise tagged attribute names, compiled once and kept with the others
+        codec = table.setdefault(k.lower(), compile_codec(None, k, customize))
+    return codec
+
+def format_values(codec, v):
+    if not v: # RFCs states that attributes must always have values, but a flaky server returns empty values too
+        return []
+    if not isinstance(v, SEQUENCE_TYPES):
+        v = [v]
+    formatted = [codec.formatter(x) for x in v]
+    return formatted[0] if codec.single_value else formatted
+
+def format_attribute(k, v, customize=True, codecs=None):
+    return format_values(attribute_codec(k, customize, codecs), v)
 
-def validate_attribute(k, v, customize=True):
-    f = find_attribute_validator(schema, k, custom_validator if customize else None)
-#    print('{} ({}): {} ({}) -> {} ({})'.format(k, f, v, type(v), f(v), type(f(v))))
-    return f(v)
+def validate_attribute(k, v, customize=True, codecs=None):
+    return attribute_codec(k, customize, codecs).validator(v)
 
+def deserialize_attribute(k, v, codecs=None):
+    return attribute_codec(k, codecs=codecs).deserializer(v)
@@ -0,0 +1,108 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# attribute projections, i.e. the attribute list sent to ldap plus exclusions. A spec is a list of
+# attribute names where "-name" excludes an attribute and "@profile" expands a named profile, e.g.
+# "*,-thumbnailPhoto,-member" or "@identity,manager". Profiles are specs themselves and come from
+# (in order of precedence) the connection, the ATTRIBUTE_PROFILES env variable (json) and BUILTIN_PROFILES.
+
+import json
+import helpers.env
+import helpers.errors
+
+BUILTIN_PROFILES = {
+    'identity': ['objectClass', 'objectGUID', 'objectSid', 'distinguishedName', 'name', 'displayName',
+            'sAMAccountName', 'userPrincipalName', 'mail'],
+    # everything except large binary and multi-valued attributes
+    'compact': ['*', '-thumbnailPhoto', '-jpegPhoto', '-userCertificate', '-member', '-memberOf',
+            '-msExchMailboxSecurityDescriptor', '-replPropertyMetaData', '-dSCorePropagationData']
+}
+
+# requests no attributes, see RFC 4511 section 4.5.1.8
+NO_ATTRIBUTES = ['1.1']
+
+def env_profiles():
+    # a malformed ATTRIBUTE_PROFILES is a deployment error, raised when the module is loaded
+    try:
+        d = json.loads(helpers.env.get('ATTRIBUTE_PROFILES', '{}'))
+    except ValueError as e:
+        raise ValueError('ATTRIBUTE_PROFILES is not valid json: {}'.format(e))
+    try:
+        return validate_profiles(d, dict(BUILTIN_PROFILES, **d) if isinstance(d, dict) else {})
+    except helpers.errors.BadRequestException as e:
+        raise ValueError('ATTRIBUTE_PROFILES: {}'.format(e.message))
+
+def profiles(connection=None):
+    d = dict(BUILTIN_PROFILES)
+    d.update(ENV_PROFILES)
+    if connection:
+        d.update(connection.get('attributeProfiles') or {})
+    return d
+
+def profile_spec(name, available, seen=()):
+    # the profile's attribute names with the profiles it refers to expanded
+    if not name in available:
+        raise helpers.errors.BadRequestException('Unknown attribute profile: {}'.format(name))
+    if name in seen:
+        raise helpers.errors.BadRequestException('Attribute profile refers to itself: {}'.format(' -> '.join(seen + (name,))))
+    return expand(split(available[name]), available, seen + (name,))
+
+def expand(tokens, available, seen=()):
+    expanded = []
+    for s in tokens:
+        expanded += profile_spec(s[1:], available, seen) if s.startswith('@') else [s]
+    return expanded
+
+def split(spec):
+    if spec is None:
+        return []
+    return [s.strip() for s in (spec.split(',') if isinstance(spec, str) else spec) if s.strip()]
+
+def projection(spec=None, profile=None, connection=None):
+    # returns (attribute list for the search or None for all, set of lowercase attribute names to drop from results)
+    available = profiles(connection)
+    tokens = []
+    if profile:
+        tokens += profile_spec(profile, available)
+    tokens += expand(split(spec), available)
+    if not tokens:
+        default = (connection or {}).get('defaultAttributeProfile') or helpers.env.get('DEFAULT_ATTRIBUTE_PROFILE')
+        if not default:
+            return None, frozenset()
+        tokens = profile_spec(default, available)
+    include = []
+    exclude = set()
+    for s in tokens:
+        if s.startswith('-'):
+            exclude.add(s[1:].lower())
+        elif not s.lower() in (x.lower() for x in include):
+            include.append(s)
+    if not include:
+        include = ['*']
+    attributes = [s for s in include if not s.lower() in exclude]
+    if not attributes:
+        return NO_ATTRIBUTES, frozenset()
+    # named attributes are excluded from the attribute list already, ldap has no way of excluding from "*"
+    return attributes, frozenset(exclude) if '*' in attributes else frozenset()
+
+def validate_profiles(d, available=None):
+    # available are the profiles d's profiles may refer to, including d's own, by default the connection's
+    if not isinstance(d, dict) or not all(isinstance(k, str) and isinstance(v, list) and all(isinstance(s, str) for s in v) for k, v in d.items()):
+        raise helpers.errors.BadRequestException('attributeProfiles must map profile names to lists of attribute names')
+    available = available if available is not None else dict(profiles(), **d)
+    for name in d:
+        profile_spec(name, available)
+    return d
+
+ENV_PROFILES = env_profiles()
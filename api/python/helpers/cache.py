@@ -0,0 +1,86 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import time
+import threading
+from collections import OrderedDict
+import helpers.metrics
+
+class TTLCache:
+    # bounded in-memory LRU cache with per-entry expiry and optional refresh-ahead
+
+    def __init__(self, name, ttl=60, max_size=128, refresh_ahead=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.refresh_ahead = refresh_ahead # seconds before expiry to reload in the background
+        self.entries = OrderedDict() # key -> (value, loaded at)
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        helpers.metrics.gauge('cache.{}.size'.format(name), lambda: len(self.entries))
+
+    def get(self, key, loader=None):
+        now = time.monotonic()
+        refresh = False
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and now - entry[1] < self.ttl:
+                self.entries.move_to_end(key)
+                if self.refresh_ahead and loader and now - entry[1] > self.ttl - self.refresh_ahead and not key in self.refreshing:
+                    self.refreshing.add(key)
+                    refresh = True
+            else:
+                entry = None
+        if entry:
+            helpers.metrics.increment('cache.{}.hits'.format(self.name))
+            if refresh:
+                threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+            return entry[0]
+        helpers.metrics.increment('cache.{}.misses'.format(self.name))
+        if not loader:
+            return None
+        value = loader()
+        self.put(key, value)
+        return value
+
+    def _refresh(self, key, loader):
+        try:
+            self.put(key, loader(), replace_only=True)
+        except Exception as e:
+            print('cache {} refresh failed for {}: {}'.format(self.name, key, e), file=sys.stderr)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def put(self, key, value, replace_only=False):
+        with self.lock:
+            if replace_only and not key in self.entries:
+                return # invalidated while refreshing
+            self.entries[key] = (value, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def invalidate_matching(self, predicate):
+        with self.lock:
+            for key in [k for k in self.entries if predicate(k)]:
+                del self.entries[key]
@@ -0,0 +1,122 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# response compression negotiated by Accept-Encoding, registered as an after_request handler.
+# Streamed responses are compressed incrementally and flushed every COMPRESSION_FLUSH_BYTES of input
+# so that clients receive entries while the search is still running.
+
+import time
+import zlib
+from flask import request
+import helpers.env
+import helpers.metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'application/msgpack', 'application/x-msgpack')
+
+class GzipCompressor:
+    def __init__(self):
+        self.z = zlib.compressobj(helpers.env.get_int('COMPRESSION_GZIP_LEVEL', 6), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.z.compress(data)
+
+    def flush(self):
+        return self.z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.z.flush()
+
+class BrotliCompressor:
+    def __init__(self):
+        self.c = brotli.Compressor(quality=helpers.env.get_int('COMPRESSION_BROTLI_QUALITY', 4))
+
+    def compress(self, data):
+        return self.c.process(data)
+
+    def flush(self):
+        return self.c.flush()
+
+    def finish(self):
+        return self.c.finish()
+
+def compressors():
+    # in order of preference when the client accepts several
+    available = {'gzip': GzipCompressor}
+    if brotli:
+        available['br'] = BrotliCompressor
+    names = [s.strip() for s in helpers.env.get('COMPRESSION_ENCODINGS', 'br,gzip').split(',')]
+    return [(name, available[name]) for name in names if name in available]
+
+def record(encoding, cpu_seconds, bytes_in, bytes_out):
+    helpers.metrics.increment('compression.{}.cpu_seconds'.format(encoding), cpu_seconds)
+    helpers.metrics.increment('compression.{}.bytes_in'.format(encoding), bytes_in)
+    helpers.metrics.increment('compression.{}.bytes_out'.format(encoding), bytes_out)
+
+def compress_all(encoding, compressor, data):
+    start = time.thread_time()
+    compressed = compressor.compress(data) + compressor.finish()
+    record(encoding, time.thread_time() - start, len(data), len(compressed))
+    return compressed
+
+def compress_stream(encoding, compressor, chunks):
+    flush_bytes = helpers.env.get_int('COMPRESSION_FLUSH_BYTES', 65536)
+    pending = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            start = time.thread_time()
+            compressed = compressor.compress(chunk)
+            pending += len(chunk)
+            if pending >= flush_bytes:
+                compressed += compressor.flush()
+                pending = 0
+            record(encoding, time.thread_time() - start, len(chunk), len(compressed))
+            if compressed:
+                yield compressed
+        start = time.thread_time()
+        compressed = compressor.finish()
+        record(encoding, time.thread_time() - start, 0, len(compressed))
+        yield compressed
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def compress(response):
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code < 200 or response.status_code in (204, 304) or 'Content-Encoding' in response.headers:
+        return response
+    available = compressors()
+    encoding = request.accept_encodings.best_match([name for name, c in available])
+    if not encoding:
+        return response
+    compressor = dict(available)[encoding]()
+    if response.is_streamed:
+        response.response = compress_stream(encoding, compressor, response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < helpers.env.get_int('COMPRESSION_MIN_SIZE', 1024):
+            return response
+        response.set_data(compress_all(encoding, compressor, data))
+    response.headers['Content-Encoding'] = encoding
+    helpers.metrics.increment('compression.{}.responses'.format(encoding))
+    return response
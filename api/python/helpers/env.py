@@ -29,3 +29,6 @@ def fetch(name, default=None):
     val = os.environ.get(name)
     return val if val else default
 
+def get_int(name, default=None, cache=True):
+    val = get(name, None, cache)
+    return int(val) if val else default
@@ -0,0 +1,121 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# objects addressed by AD's extended dn forms <GUID=...> and <SID=...>. AD resolves these itself wherever
+# a dn is accepted, so they are passed through unchanged except where the service needs the actual dn
+# (e.g. to find the rdn), which is then taken from a per connection cache kept current by the service's
+# own creates, renames and deletes.
+
+import re
+import uuid
+import binascii
+from ldap import SCOPE_BASE
+from ldap3.protocol.formatters.formatters import format_sid
+import helpers.cache
+import helpers.env
+from helpers.ldap import RESULT_KEY_DN, RESULT_KEY_ATTRIBUTES
+
+PATTERN = re.compile(r'^<(GUID|SID)=([^>]+)>$', re.IGNORECASE)
+
+ATTRIBUTES = ['objectGUID', 'objectSid']
+
+# (connection, key) -> dn and (connection, lowercase dn) -> keys
+dns = helpers.cache.TTLCache('extended-dns',
+        ttl=helpers.env.get_int('DN_CACHE_SECONDS', 3600),
+        max_size=helpers.env.get_int('DN_CACHE_MAX_SIZE', 10000))
+keys = helpers.cache.TTLCache('extended-dn-keys',
+        ttl=helpers.env.get_int('DN_CACHE_SECONDS', 3600),
+        max_size=helpers.env.get_int('DN_CACHE_MAX_SIZE', 10000))
+
+def connection_key(connection):
+    return (connection['name'], connection['ldapUrl'])
+
+def parse(base):
+    # returns a normalized key for an extended dn, e.g. ('GUID', '<uuid>'), or None for other dns
+    m = PATTERN.match(base or '')
+    if not m:
+        return None
+    kind, value = m.group(1).upper(), m.group(2).strip()
+    try:
+        if kind == 'GUID':
+            # AD takes the dashed string form or the hex of the raw (little endian) bytes
+            return (kind, str(uuid.UUID(value) if '-' in value else uuid.UUID(bytes_le=binascii.unhexlify(value))))
+        return (kind, value.upper() if value.upper().startswith('S-') else format_sid(binascii.unhexlify(value)))
+    except (ValueError, binascii.Error):
+        return None
+
+def object_keys(attributes):
+    # keys of an entry from its raw objectGUID and objectSid values, if present
+    found = []
+    for k, v in attributes.items():
+        if k.lower() == 'objectguid' and v:
+            found.append(('GUID', str(uuid.UUID(bytes_le=v[0]))))
+        elif k.lower() == 'objectsid' and v:
+            found.append(('SID', format_sid(v[0])))
+    return found
+
+def remember(connection, dn, known):
+    ck = connection_key(connection)
+    for k in known:
+        dns.put((ck, k), dn)
+    if known:
+        keys.put((ck, dn.lower()), tuple(known))
+
+def remember_entry(connection, o):
+    remember(connection, o[RESULT_KEY_DN], object_keys(o[RESULT_KEY_ATTRIBUTES]))
+
+def remember_base(connection, base, dn):
+    # base found to be dn by a search
+    k = parse(base)
+    if k:
+        known = list(keys.get((connection_key(connection), dn.lower())) or [])
+        remember(connection, dn, known if k in known else known + [k])
+
+def forget(connection, base):
+    # drops the cached dn of an extended dn, returns whether there was one
+    k = parse(base)
+    ck = connection_key(connection)
+    dn = dns.get((ck, k)) if k else None
+    if dn is None:
+        return False
+    deleted(connection, dn)
+    dns.invalidate((ck, k))
+    return True
+
+def renamed(connection, old_dn, new_dn):
+    ck = connection_key(connection)
+    known = keys.get((ck, old_dn.lower()))
+    deleted(connection, old_dn)
+    if known:
+        remember(connection, new_dn, list(known))
+
+def deleted(connection, dn):
+    ck = connection_key(connection)
+    for k in keys.get((ck, dn.lower())) or []:
+        dns.invalidate((ck, k))
+    keys.invalidate((ck, dn.lower()))
+
+def resolve(connection, context, base):
+    # the actual dn of base, searching only for extended dns not cached
+    k = parse(base)
+    if not k:
+        return base
+    dn = dns.get((connection_key(connection), k))
+    if dn is None:
+        found = context.search(base, SCOPE_BASE, attributes=ATTRIBUTES)
+        if not found:
+            return base
+        dn = found[0][RESULT_KEY_DN]
+        remember_entry(connection, found[0])
+    return dn
@@ -0,0 +1,215 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+import struct
+import hashlib
+import tempfile
+import threading
+import traceback
+import atexit
+import urllib.parse
+from subprocess import Popen, PIPE
+import helpers.env
+
+try:
+    import gssapi
+    import gssapi.raw
+except ImportError:
+    gssapi = None
+
+KINIT = '/usr/bin/kinit'
+
+def in_process():
+    # acquire tickets through the gssapi bindings unless unavailable or disabled
+    return gssapi is not None and helpers.env.get('KERBEROS_PROVIDER', 'gssapi') != 'subprocess'
+
+def acquire_tgt(userId, password, ccache):
+    name = gssapi.Name(userId, gssapi.NameType.kerberos_principal)
+    creds = gssapi.raw.acquire_cred_with_password(name, password.encode('utf-8'), usage='initiate').creds
+    gssapi.raw.store_cred_into({'ccache': ccache}, creds, usage='initiate', overwrite=True)
+
+def thread_ccache():
+    # per-thread default ccache lets concurrent binds use different credentials without touching os.environ
+    return in_process() and hasattr(gssapi.raw, 'krb5_ccache_name')
+
+def set_thread_ccache(ccache):
+    gssapi.raw.krb5_ccache_name(ccache.encode('utf-8'))
+
+def subprocess_env(ccache):
+    return dict(os.environ, KRB5CCNAME=ccache)
+
+def acquire_tgt_subprocess(userId, password, ccache):
+    kinit = Popen([KINIT, userId], stdin=PIPE, stdout=PIPE, stderr=PIPE, env=subprocess_env(ccache))
+    outs, errs = kinit.communicate(input=b'%s\n' % password.encode('UTF-8'))
+    if errs:
+        raise Exception(errs)
+
+def renew_tgt_subprocess(ccache):
+    kinit = Popen([KINIT, '-R'], stdout=PIPE, stderr=PIPE, env=subprocess_env(ccache))
+    outs, errs = kinit.communicate()
+    if kinit.returncode != 0:
+        raise Exception(errs)
+
+class CCacheReader:
+    # minimal reader for MIT FILE ccache formats 3 and 4, see
+    # https://web.mit.edu/kerberos/krb5-devel/doc/formats/ccache_file_format.html
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def octets(self):
+        (n,) = self.unpack('>I')
+        self.offset += n
+        return self.data[self.offset - n:self.offset]
+
+    def principal(self):
+        (name_type, count) = self.unpack('>II')
+        realm = self.octets()
+        return realm, [self.octets() for i in range(count)]
+
+    def times(self):
+        # returns (endtime, renew_till) of the tgt
+        (version,) = self.unpack('>H')
+        if version not in (0x0503, 0x0504):
+            raise ValueError('unsupported ccache version: {:x}'.format(version))
+        if version == 0x0504:
+            (header_len,) = self.unpack('>H')
+            self.offset += header_len
+        self.principal()
+        while self.offset < len(self.data):
+            self.principal()
+            realm, components = self.principal()
+            self.unpack('>HH' if version == 0x0503 else '>H')
+            self.octets()
+            (authtime, starttime, endtime, renew_till) = self.unpack('>IIII')
+            self.unpack('>BI')
+            for i in range(self.unpack('>I')[0]):
+                self.unpack('>H')
+                self.octets()
+            for i in range(self.unpack('>I')[0]):
+                self.unpack('>H')
+                self.octets()
+            self.octets()
+            self.octets()
+            if components and components[0] == b'krbtgt':
+                return endtime, renew_till
+        raise ValueError('no tgt in ccache')
+
+class Credential:
+
+    def __init__(self, userId, password):
+        self.userId = userId
+        self.password = password
+        self.file = tempfile.NamedTemporaryFile(prefix='krb5cc_')
+        self.ccache = self.file.name
+        self.endtime = 0
+        self.renew_till = 0
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+    def expires_within(self, seconds):
+        return self.endtime - seconds <= time.time()
+
+    def ensure(self):
+        # fast path needs no lock, concurrent callers wait on a single refresh
+        self.last_used = time.time()
+        if self.expires_within(helpers.env.get_int('KERBEROS_MIN_LIFETIME_SECONDS', 60)):
+            self.refresh(helpers.env.get_int('KERBEROS_MIN_LIFETIME_SECONDS', 60))
+        return self.ccache
+
+    def refresh(self, margin):
+        with self.lock:
+            if not self.expires_within(margin):
+                return # refreshed by another thread while waiting
+            if in_process():
+                # gssapi cannot renew, but acquiring with the password is a single in-process AS exchange
+                acquire_tgt(self.userId, self.password, self.ccache)
+            elif self.renew_till - margin > time.time() and not self.expires_within(0):
+                renew_tgt_subprocess(self.ccache)
+            else:
+                acquire_tgt_subprocess(self.userId, self.password, self.ccache)
+            self.read_times()
+
+    def read_times(self):
+        try:
+            with open(self.ccache, 'rb') as f:
+                (self.endtime, self.renew_till) = CCacheReader(f.read()).times()
+        except (OSError, ValueError, struct.error):
+            traceback.print_exc()
+            self.endtime = time.time() + helpers.env.get_int('KERBEROS_RENEW_MARGIN_SECONDS', 600) * 2
+            self.renew_till = 0
+
+    def close(self):
+        self.file.close()
+
+credentials = {}
+credentials_lock = threading.Lock()
+renewer = None
+
+def credential_key(userId, password):
+    return hashlib.md5("{}\0{}".format(urllib.parse.quote(userId), urllib.parse.quote(password)).encode('utf-8')).hexdigest()
+
+def get_credential(userId, password):
+    global renewer
+    key = credential_key(userId, password)
+    with credentials_lock:
+        if not key in credentials:
+            credentials[key] = Credential(userId, password)
+        credential = credentials[key]
+        credential.last_used = time.time()
+        if renewer is None or not renewer.is_alive():
+            # started lazily so that it runs in each (forked) worker process
+            renewer = threading.Thread(target=renew_loop, name='kerberos-renewer', daemon=True)
+            renewer.start()
+    return credential
+
+def get_ccache(userId, password):
+    return get_credential(userId, password).ensure()
+
+def renew_loop():
+    while True:
+        time.sleep(helpers.env.get_int('KERBEROS_RENEW_INTERVAL_SECONDS', 60))
+        renew_all()
+
+def renew_all():
+    idle_seconds = helpers.env.get_int('KERBEROS_IDLE_SECONDS', 3600)
+    margin = helpers.env.get_int('KERBEROS_RENEW_MARGIN_SECONDS', 600)
+    with credentials_lock:
+        idle = [k for k, c in credentials.items() if time.time() - c.last_used > idle_seconds]
+        evicted = [credentials.pop(k) for k in idle]
+        active = list(credentials.values())
+    for credential in evicted:
+        credential.close()
+    for credential in active:
+        if credential.expires_within(margin):
+            try:
+                credential.refresh(margin)
+            except Exception as e:
+                print('ticket renewal failed for {}: {}'.format(credential.userId, e), file=sys.stderr)
+
+@atexit.register
+def close_all():
+    with credentials_lock:
+        for credential in credentials.values():
+            credential.close()
+        credentials.clear()
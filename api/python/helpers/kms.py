@@ -15,8 +15,11 @@
 # modified from https://cloud.google.com/kms/docs/encrypt-decrypt
 
 from google.cloud import kms
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import os
 import base64
 import crcmod
+import crcmod.predefined
 import six
 
 # Create the client.
@@ -31,7 +34,7 @@ def encrypt_symmetric(project_id, location_id, key_ring_id, key_id, plaintext):
         location_id (string): Cloud KMS location (e.g. 'us-east1').
         key_ring_id (string): ID of the Cloud KMS key ring (e.g. 'my-key-ring').
         key_id (string): ID of the key to use (e.g. 'my-key').
-        plaintext (string): message to encrypt
+        plaintext (string or bytes): message to encrypt
 
     Returns:
         bytes: base 64 encoded cipher text
@@ -39,7 +42,7 @@ def encrypt_symmetric(project_id, location_id, key_ring_id, key_id, plaintext):
     """
 
     # Convert the plaintext to bytes.
-    plaintext_bytes = plaintext.encode('utf-8')
+    plaintext_bytes = six.ensure_binary(plaintext)
 
     # Optional, but recommended: compute plaintext's CRC32C.
     # See crc32c() function defined below.
@@ -65,6 +68,9 @@ def encrypt_symmetric(project_id, location_id, key_ring_id, key_id, plaintext):
 #    return encrypt_response
     return base64.b64encode(encrypt_response.ciphertext)
 
+# building the crc function is expensive so do it once
+crc32c_fun = crcmod.predefined.mkPredefinedCrcFun('crc-32c')
+
 def crc32c(data):
     """
     Calculates the CRC32C checksum of the provided data.
@@ -75,10 +81,9 @@ def crc32c(data):
     Returns:
         An int representing the CRC32C checksum of the provided bytes.
     """
-    crc32c_fun = crcmod.predefined.mkPredefinedCrcFun('crc-32c')
     return crc32c_fun(six.ensure_binary(data))
 
-def decrypt_symmetric(project_id, location_id, key_ring_id, key_id, ciphertext):
+def decrypt_symmetric(project_id, location_id, key_ring_id, key_id, ciphertext, encoding='utf-8'):
     """
     Decrypt the ciphertext using the symmetric key
 
@@ -88,6 +93,7 @@ def decrypt_symmetric(project_id, location_id, key_ring_id, key_id, ciphertext):
         key_ring_id (string): ID of the Cloud KMS key ring (e.g. 'my-key-ring').
         key_id (string): ID of the key to use (e.g. 'my-key').
         ciphertext (bytes): Encrypted bytes to decrypt.
+        encoding (string): Encoding of the plaintext or None to return bytes.
 
     Returns:
         DecryptResponse: Response including plaintext.
@@ -103,5 +109,45 @@ def decrypt_symmetric(project_id, location_id, key_ring_id, key_id, ciphertext):
     decrypt_response = client.decrypt(request={'name': key_name, 'ciphertext': data})
 #    print('Plaintext: {}'.format(decrypt_response.plaintext))
 #    return decrypt_response
-    return decrypt_response.plaintext.decode('utf-8')
+    return decrypt_response.plaintext.decode(encoding) if encoding else decrypt_response.plaintext
+
+def generate_data_key():
+    """
+    Generate a random key for local (envelope) encryption.
+
+    Returns:
+        bytes: 256 bit AES key, to be stored only after wrapping with encrypt_symmetric
+
+    """
+    return AESGCM.generate_key(bit_length=256)
+
+def encrypt_local(data_key, plaintext):
+    """
+    Encrypt plaintext locally with AES-GCM.
+
+    Args:
+        data_key (bytes): Unwrapped data key.
+        plaintext (string): message to encrypt
+
+    Returns:
+        bytes: base 64 encoded nonce followed by cipher text
+
+    """
+    nonce = os.urandom(12)
+    return base64.b64encode(nonce + AESGCM(data_key).encrypt(nonce, plaintext.encode('utf-8'), None))
+
+def decrypt_local(data_key, ciphertext):
+    """
+    Decrypt ciphertext produced by encrypt_local.
+
+    Args:
+        data_key (bytes): Unwrapped data key.
+        ciphertext (bytes): base 64 encoded nonce followed by cipher text
+
+    Returns:
+        string: plaintext
+
+    """
+    data = base64.b64decode(ciphertext)
+    return AESGCM(data_key).decrypt(data[:12], data[12:], None).decode('utf-8')
 
@@ -13,17 +13,59 @@
 # limitations under the License.
 
 import ldap, ldap.sasl, ldap.schema
+from ldap.controls import SimplePagedResultsControl, RequestControl, ResponseControl, KNOWN_RESPONSE_CONTROLS
+from ldap.controls.sss import SSSRequestControl, SSSResponseControl
+from pyasn1.type import univ, namedtype
+from pyasn1.codec.ber import encoder, decoder
 import os
-import tempfile
-from subprocess import Popen, PIPE
 import threading
+import uuid
 from enum import Enum
-import atexit
-import hashlib
-import urllib
+import helpers.kerberos
+import helpers.metrics
 
 RESULT_KEY_DN = 'dn'
 RESULT_KEY_ATTRIBUTES = 'attributes'
+DEFAULT_PAGE_SIZE = 1000 # AD MaxPageSize default
+DIRSYNC_MAX_BYTES = 1048576
+
+bind_lock = threading.Lock()
+
+def count(operation):
+    # ldap operations sent, exposed by /metrics so that added round trips show up
+    helpers.metrics.increment('ldap.{}'.format(operation))
+
+class DirSyncValue(univ.Sequence):
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('flags', univ.Integer()),
+        namedtype.NamedType('maxBytes', univ.Integer()),
+        namedtype.NamedType('cookie', univ.OctetString()))
+
+class DirSyncControl(RequestControl, ResponseControl):
+    # AD's directory synchronization control (MS-ADTS 3.1.1.3.4.1.3), the response flags are non-zero
+    # while more changes are available
+    controlType = '1.2.840.113556.1.4.841'
+
+    def __init__(self, criticality=True, flags=0, max_bytes=DIRSYNC_MAX_BYTES, cookie=b''):
+        self.criticality = criticality
+        self.flags = flags
+        self.max_bytes = max_bytes
+        self.cookie = cookie
+
+    def encodeControlValue(self):
+        value = DirSyncValue()
+        value.setComponentByName('flags', self.flags)
+        value.setComponentByName('maxBytes', self.max_bytes)
+        value.setComponentByName('cookie', self.cookie)
+        return encoder.encode(value)
+
+    def decodeControlValue(self, encoded):
+        (value, rest) = decoder.decode(encoded, asn1Spec=DirSyncValue())
+        self.flags = int(value.getComponentByName('flags'))
+        self.max_bytes = int(value.getComponentByName('maxBytes'))
+        self.cookie = bytes(value.getComponentByName('cookie'))
+
+KNOWN_RESPONSE_CONTROLS[DirSyncControl.controlType] = DirSyncControl
 
 class SaslMechanism(Enum):
     GSSAPI = 1
@@ -31,19 +73,9 @@ class SaslMechanism(Enum):
 
 class SaslBindingContext:
 
-    __ticket_dict__ = {}
-
-    def get_tgt_path(userId, password):
-        # dictionary of temp file keyed by unique cred combos
-        d = SaslBindingContext.__ticket_dict__
-        hash = hashlib.md5("{}\0{}".format(urllib.parse.quote(userId), urllib.parse.quote(password)).encode('utf-8')).hexdigest()
-        if not hash in d:
-            if not hash in d:
-                d[hash] = tempfile.NamedTemporaryFile()
-        return d[hash].name
-
     def __init__(self, url, userId, password, sasl_mechanism=SaslMechanism.GSSAPI, chase_referrals=False, min_ssf=56, trace_level=0):
         self.ldap = None
+        self.session_id = None
         self.url = url
         self.userId = userId
         self.password = password
@@ -63,22 +95,22 @@ class SaslBindingContext:
         if self.ldap:
             self.close()
         self.ldap = ldap.initialize(self.url, trace_level=self.trace_level)
+        self.session_id = uuid.uuid4().hex
+        count('bind')
         self.ldap.set_option(ldap.OPT_REFERRALS, 1 if self.chase_referrals else 0)
         self.ldap.set_option(ldap.OPT_X_SASL_SSF_MIN, self.min_ssf)
         self.ldap.set_option(ldap.OPT_X_SASL_NOCANON, 1)
         if self.sasl_mechanism == SaslMechanism.GSSAPI:
             sasl_auth = ldap.sasl.sasl({}, 'GSSAPI')
-            with threading.Lock():
-                f = SaslBindingContext.get_tgt_path(self.userId, self.password)
-                os.environ['KRB5CCNAME'] = f
-                # test TGT with klist - zero exit code means valid
-                klist = Popen(['/usr/bin/klist', '-s'])
-                if klist.wait() != 0:
-                    kinit = Popen(['/usr/bin/kinit', self.userId], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-                    outs, errs = kinit.communicate(input=b'%s\n' % self.password.encode('UTF-8'))
-                    if errs:
-                        raise Exception(errs)
+            ccache = helpers.kerberos.get_ccache(self.userId, self.password)
+            if helpers.kerberos.thread_ccache():
+                helpers.kerberos.set_thread_ccache(ccache)
                 self.ldap.sasl_interactive_bind_s("", sasl_auth)
+            else:
+                # KRB5CCNAME is process-wide so binds must take turns
+                with bind_lock:
+                    os.environ['KRB5CCNAME'] = ccache
+                    self.ldap.sasl_interactive_bind_s("", sasl_auth)
         elif self.sasl_mechanism == SaslMechanism.DIGEST_MD5:
             sasl_auth = ldap.sasl.sasl({
                 ldap.sasl.CB_AUTHNAME: self.userId,
@@ -93,33 +125,195 @@ class SaslBindingContext:
             self.ldap.unbind_s()
             self.ldap = None
 
-    def search(self, base, scope=ldap.SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, referrals=False, attrsonly=False):
+    def whoami(self):
         if not self.ldap:
             self.open()
-        results = self.ldap.search_s(base, scope, filterstr=filter, attrlist=attributes, attrsonly=1 if attrsonly else 0)
-        if results:
-            # results are tuples of (dn, attrs) except referrals (last 3?) with null dn
-            return [{RESULT_KEY_DN: x[0], RESULT_KEY_ATTRIBUTES:x[1]} for x in results if referrals or x[0]]
-        else:
-            return []
+        count('whoami')
+        return self.ldap.whoami_s()
+
+    def search(self, base, scope=ldap.SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, referrals=False, attrsonly=False, serverctrls=None):
+        return [x for page in self.search_pages(base, scope, filter, attributes, referrals, attrsonly, serverctrls=serverctrls) for x in page]
+
+    def search_pages(self, base, scope=ldap.SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, referrals=False, attrsonly=False, page_size=DEFAULT_PAGE_SIZE, serverctrls=None):
+        cookie = b''
+        while True:
+            (entries, cookie) = self.search_page(base, scope, filter, attributes, referrals, attrsonly, page_size, cookie, serverctrls)
+            yield entries
+            if not cookie:
+                break
+
+    def search_page(self, base, scope=ldap.SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, referrals=False, attrsonly=False, page_size=DEFAULT_PAGE_SIZE, cookie=b'', serverctrls=None):
+        # one page of simple paged results (RFC 2696), returns (entries, cookie) with an empty cookie after the last page
+        (entries, cookie, rctrls) = self.search_page_controls(base, scope, filter, attributes, referrals, attrsonly, page_size, cookie, serverctrls)
+        return entries, cookie
+
+    def search_sorted_page(self, base, scope=ldap.SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, referrals=False, attrsonly=False, page_size=DEFAULT_PAGE_SIZE, cookie=b'', sort=None):
+        # one page of results sorted by the server on the keys in sort (RFC 2891), returns (entries, cookie, ordered)
+        # where ordered is False if the server ignored the sort control
+        control = SSSRequestControl(False, ordering_rules=sort)
+        (entries, cookie, rctrls) = self.search_page_controls(base, scope, filter, attributes, referrals, attrsonly, page_size, cookie, [control])
+        response = next((c for c in rctrls if c.controlType == SSSResponseControl.controlType), None)
+        return entries, cookie, response is not None and response.sortResult == 0
+
+    def search_page_controls(self, base, scope, filter, attributes, referrals, attrsonly, page_size, cookie, serverctrls):
+        if not self.ldap:
+            self.open()
+        control = SimplePagedResultsControl(False, size=page_size, cookie=cookie)
+        count('search')
+        msgid = self.ldap.search_ext(base, scope, filterstr=filter, attrlist=attributes, attrsonly=1 if attrsonly else 0, serverctrls=[control] + (serverctrls or []))
+        (rtype, results, rmsgid, rctrls) = self.ldap.result3(msgid)
+        cookie = next((c.cookie for c in rctrls if c.controlType == SimplePagedResultsControl.controlType), b'')
+        # results are tuples of (dn, attrs) except referrals with null dn
+        return [{RESULT_KEY_DN: x[0], RESULT_KEY_ATTRIBUTES:x[1]} for x in results if referrals or x[0]] if results else [], cookie, rctrls
+
+    def search_dirsync(self, base, filter='(objectClass=*)', attributes=None, cookie=b'', flags=0, max_bytes=DIRSYNC_MAX_BYTES):
+        # changes under naming context base since cookie (all objects for an empty cookie), returns
+        # (entries, cookie, more) where more is set while the server has further changes to send
+        if not self.ldap:
+            self.open()
+        control = DirSyncControl(True, flags=flags, max_bytes=max_bytes, cookie=cookie)
+        count('search')
+        msgid = self.ldap.search_ext(base, ldap.SCOPE_SUBTREE, filterstr=filter, attrlist=attributes, serverctrls=[control])
+        (rtype, results, rmsgid, rctrls) = self.ldap.result3(msgid)
+        response = next((c for c in rctrls if c.controlType == DirSyncControl.controlType), None)
+        if not response:
+            return [], cookie, False
+        return [{RESULT_KEY_DN: x[0], RESULT_KEY_ATTRIBUTES:x[1]} for x in results if x[0]] if results else [], response.cookie, response.flags != 0
+
+    # asynchronous operations return a message id right away, results are collected with result()
+    # so that many operations can be outstanding on the connection, see Pipeline
+
+    def search_async(self, base, scope=ldap.SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, attrsonly=False, serverctrls=None):
+        if not self.ldap:
+            self.open()
+        count('search')
+        return self.ldap.search_ext(base, scope, filterstr=filter, attrlist=attributes, attrsonly=1 if attrsonly else 0, serverctrls=serverctrls)
+
+    def add_async(self, dn, modlist):
+        if not self.ldap:
+            self.open()
+        count('add')
+        return self.ldap.add_ext(dn, modlist)
+
+    def modify_async(self, dn, modlist, serverctrls=None):
+        if not self.ldap:
+            self.open()
+        count('modify')
+        return self.ldap.modify_ext(dn, modlist, serverctrls=serverctrls)
+
+    def delete_async(self, dn):
+        if not self.ldap:
+            self.open()
+        count('delete')
+        return self.ldap.delete_ext(dn)
+
+    def rename_async(self, dn, rdn):
+        if not self.ldap:
+            self.open()
+        count('rename')
+        return self.ldap.rename(dn, rdn)
+
+    def result(self, msgid=ldap.RES_ANY, referrals=False, timeout=None):
+        # waits for the complete result of msgid (or any operation), returns (msgid, entries, controls)
+        # where entries is None for operations other than search. LDAP errors carry the msgid in e.args[0].
+        (rtype, results, rmsgid, rctrls) = self.ldap.result3(msgid, all=1, timeout=timeout)
+        if rtype != ldap.RES_SEARCH_RESULT:
+            return rmsgid, None, rctrls
+        return rmsgid, [{RESULT_KEY_DN: x[0], RESULT_KEY_ATTRIBUTES:x[1]} for x in results if referrals or x[0]] if results else [], rctrls
+
+    def abandon(self, msgid):
+        if self.ldap:
+            self.ldap.abandon_ext(msgid)
 
     def delete(self, dn):
         if not self.ldap:
             self.open()
+        count('delete')
         self.ldap.delete_s(dn)
 
     def add(self, dn, modlist):
         if not self.ldap:
             self.open()
+        count('add')
         self.ldap.add_s(dn, modlist)
 
-    def modify(self, dn, modlist):
+    def modify(self, dn, modlist, serverctrls=None):
         if not self.ldap:
             self.open()
-        self.ldap.modify_s(dn, modlist)
+        count('modify')
+        self.ldap.modify_ext_s(dn, modlist, serverctrls=serverctrls)
 
     def rename(self, dn, rdn):
         if not self.ldap:
             self.open()
+        count('rename')
         self.ldap.rename_s(dn, rdn)
 
+
+class Pipeline:
+    # many operations outstanding on one connection with results collected as they complete, e.g.
+    #   with Pipeline(context) as p:
+    #       p.search('a', base_a, SCOPE_BASE)
+    #       p.search('b', base_b, SCOPE_BASE)
+    #       d = p.collect()
+    # operations in a pipeline must not depend on each other since the server may process them in any order
+
+    def __init__(self, context):
+        self.context = context
+        self.pending = {} # msgid -> (key, referrals)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def search(self, key, base, scope=ldap.SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, referrals=False, attrsonly=False):
+        self.pending[self.context.search_async(base, scope, filter, attributes, attrsonly)] = (key, referrals)
+
+    def add(self, key, dn, modlist):
+        self.pending[self.context.add_async(dn, modlist)] = (key, False)
+
+    def modify(self, key, dn, modlist, serverctrls=None):
+        self.pending[self.context.modify_async(dn, modlist, serverctrls)] = (key, False)
+
+    def delete(self, key, dn):
+        self.pending[self.context.delete_async(dn)] = (key, False)
+
+    def rename(self, key, dn, rdn):
+        self.pending[self.context.rename_async(dn, rdn)] = (key, False)
+
+    def as_completed(self):
+        # yields (key, entries, error) in order of completion, entries is None for operations other than search
+        while self.pending:
+            try:
+                (msgid, entries, ctrls) = self.context.result(referrals=True)
+                (key, referrals) = self.pending.pop(msgid)
+                if entries and not referrals:
+                    entries = [x for x in entries if x[RESULT_KEY_DN]]
+                yield key, entries, None
+            except ldap.LDAPError as e:
+                msgid = e.args[0].get('msgid') if e.args and isinstance(e.args[0], dict) else None
+                if not msgid in self.pending:
+                    raise # not the result of an operation, e.g. the connection was lost
+                yield self.pending.pop(msgid)[0], None, e
+
+    def collect(self):
+        # waits for all operations and returns {key: entries}, raises the first error once all completed
+        d = {}
+        error = None
+        for (key, entries, e) in self.as_completed():
+            d[key] = entries
+            error = error or e
+        if error:
+            raise error
+        return d
+
+    def close(self):
+        # abandon what was not collected so that stale results are not read by the next user of the connection
+        for msgid in list(self.pending):
+            try:
+                self.context.abandon(msgid)
+            except ldap.LDAPError:
+                pass
+        self.pending.clear()
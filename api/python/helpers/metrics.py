@@ -0,0 +1,34 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+counters = {}
+gauges = {}
+lock = threading.Lock()
+
+def increment(name, value=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+def gauge(name, f):
+    # f is evaluated when a snapshot is taken
+    gauges[name] = f
+
+def snapshot():
+    with lock:
+        d = dict(counters)
+    for name, f in list(gauges.items()):
+        d[name] = f()
+    return d
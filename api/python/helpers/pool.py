@@ -0,0 +1,186 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ldap
+import threading
+import time
+import hashlib
+import urllib.parse
+from contextlib import contextmanager
+import helpers.env
+import helpers.errors
+import helpers.ldap
+
+# errors after which a session is assumed unusable and is dropped instead of returned to the pool
+CONNECTION_ERRORS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT, ldap.UNAVAILABLE)
+
+class PoolExhaustedError(helpers.errors.Error):
+    def __init__(self, message = 'timed out waiting for an ldap connection'):
+        super(PoolExhaustedError, self).__init__(message)
+
+def fingerprint(url, userId, password):
+    return hashlib.sha256("{}\0{}\0{}".format(url, urllib.parse.quote(userId), urllib.parse.quote(password)).encode('utf-8')).hexdigest()
+
+class Pool:
+
+    def __init__(self, factory, min_size=0, max_size=4, idle_seconds=300, check_seconds=30, timeout=30):
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.check_seconds = check_seconds
+        self.timeout = timeout
+        self.idle = [] # (context, released at) with the most recently released last
+        self.size = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def _evict(self):
+        # called with condition held, returns idle contexts to close outside of the lock
+        now = time.monotonic()
+        evicted = []
+        while self.idle and self.size > self.min_size and now - self.idle[0][1] > self.idle_seconds:
+            evicted.append(self.idle.pop(0)[0])
+            self.size -= 1
+        return evicted
+
+    def acquire(self, prefer=None):
+        # prefer is the session id of an idle session to reuse if available, e.g. to continue a paged search
+        deadline = time.monotonic() + self.timeout
+        context = None
+        evicted = []
+        with self.condition:
+            while True:
+                evicted += self._evict()
+                if self.idle:
+                    i = next((i for i, x in enumerate(self.idle) if x[0].session_id == prefer), -1) if prefer else -1
+                    context, released = self.idle.pop(i)
+                    break
+                elif self.size < self.max_size:
+                    self.size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.condition.wait(remaining):
+                    raise PoolExhaustedError()
+        close_all(evicted)
+        if context and time.monotonic() - released > self.check_seconds and not healthy(context):
+            close_all([context])
+            context = None
+        if not context:
+            try:
+                context = self.factory()
+                context.open()
+            except:
+                self.discard()
+                raise
+        return context
+
+    def release(self, context):
+        with self.condition:
+            if self.closed:
+                self.size -= 1
+                evicted = [context]
+            else:
+                self.idle.append((context, time.monotonic()))
+                evicted = self._evict()
+            self.condition.notify()
+        close_all(evicted)
+
+    def discard(self, context=None):
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+        if context:
+            close_all([context])
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            evicted = [x[0] for x in self.idle]
+            self.size -= len(evicted)
+            self.idle = []
+            self.condition.notify_all()
+        close_all(evicted)
+
+def healthy(context):
+    try:
+        context.whoami()
+        return True
+    except ldap.LDAPError:
+        return False
+
+def close_all(contexts):
+    for context in contexts:
+        try:
+            context.close()
+        except ldap.LDAPError:
+            pass
+
+def binding_args(connection):
+    # session arguments for a connection resource
+    return {
+            'name': connection['name'],
+            'url': connection['ldapUrl'],
+            'userId': connection['credentials']['user'],
+            'password': connection['credentials']['password']
+        }
+
+pools = {}
+pools_lock = threading.Lock()
+
+def get_pool(name, url, userId, password, **kwargs):
+    key = (name, fingerprint(url, userId, password))
+    with pools_lock:
+        pool = pools.get(key)
+        if not pool:
+            # credentials or url changed (possibly by another process), retire pools for the old ones
+            stale = [pools.pop(k) for k in list(pools) if k[0] == name]
+            pool = Pool(lambda: helpers.ldap.SaslBindingContext(url, userId, password, **kwargs),
+                    min_size=helpers.env.get_int('LDAP_POOL_MIN_SIZE', 0),
+                    max_size=helpers.env.get_int('LDAP_POOL_MAX_SIZE', 4),
+                    idle_seconds=helpers.env.get_int('LDAP_POOL_IDLE_SECONDS', 300),
+                    check_seconds=helpers.env.get_int('LDAP_POOL_CHECK_SECONDS', 30),
+                    timeout=helpers.env.get_int('LDAP_POOL_TIMEOUT', 30))
+            pools[key] = pool
+        else:
+            stale = []
+    for p in stale:
+        p.close()
+    return pool
+
+def invalidate(name):
+    with pools_lock:
+        stale = [pools.pop(k) for k in list(pools) if k[0] == name]
+    for p in stale:
+        p.close()
+
+@contextmanager
+def session(name, url, userId, password, prefer=None, **kwargs):
+    if helpers.env.get_int('LDAP_POOL_MAX_SIZE', 4) < 1:
+        # pooling disabled, bind per request
+        with helpers.ldap.SaslBindingContext(url, userId, password, **kwargs) as context:
+            yield context
+        return
+    pool = get_pool(name, url, userId, password, **kwargs)
+    context = pool.acquire(prefer)
+    try:
+        yield context
+    except CONNECTION_ERRORS:
+        pool.discard(context)
+        raise
+    except:
+        pool.release(context)
+        raise
+    else:
+        pool.release(context)
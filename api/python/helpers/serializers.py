@@ -0,0 +1,83 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# response serializers chosen by the Accept header. JSON is compact unless prettyPrint=true is
+# requested, datetime, timedelta and bytes values are serialized by helpers.json.default in all formats
+# except that msgpack keeps bytes as binary.
+
+import json
+from collections import namedtuple
+from flask import Response, request
+import helpers.json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MIMETYPE_JSON = 'application/json'
+MIMETYPE_NDJSON = 'application/x-ndjson'
+MIMETYPE_MSGPACK = 'application/msgpack'
+MIMETYPE_X_MSGPACK = 'application/x-msgpack'
+
+Serializer = namedtuple('Serializer', ['mimetype', 'dumps'])
+
+def dumps_json(o, pretty=False):
+    if orjson:
+        # datetimes passed through so they are formatted exactly like the stdlib encoder does
+        option = orjson.OPT_PASSTHROUGH_DATETIME | (orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS if pretty else 0)
+        return orjson.dumps(o, default=helpers.json.default, option=option)
+    if pretty:
+        return json.dumps(o, cls=helpers.json.CustomJSONEncoder, indent=2, sort_keys=True).encode('utf-8')
+    return json.dumps(o, cls=helpers.json.CustomJSONEncoder, separators=(',', ':')).encode('utf-8')
+
+def dumps_msgpack(o):
+    # bytes are packed natively as bin and never reach default
+    return msgpack.packb(o, default=helpers.json.default, use_bin_type=True, datetime=False)
+
+def offered():
+    # in order of preference when the client accepts several
+    serializers = [Serializer(MIMETYPE_JSON, dumps_json)]
+    if msgpack:
+        serializers += [Serializer(MIMETYPE_MSGPACK, dumps_msgpack), Serializer(MIMETYPE_X_MSGPACK, dumps_msgpack)]
+    return serializers
+
+def pretty():
+    return request.args.get('prettyPrint', 'false').lower() == 'true'
+
+def negotiate():
+    serializers = offered()
+    best = request.accept_mimetypes.best_match([s.mimetype for s in serializers], default=MIMETYPE_JSON)
+    serializer = next(s for s in serializers if s.mimetype == best)
+    if serializer.dumps is dumps_json and pretty():
+        return Serializer(MIMETYPE_JSON, lambda o: dumps_json(o, pretty=True) + b'\n')
+    return serializer
+
+def serialize(o, status_code=200):
+    # replaces flask's jsonify
+    serializer = negotiate()
+    return Response(serializer.dumps(o), status=status_code, mimetype=serializer.mimetype)
+
+def accepts_ndjson():
+    return request.accept_mimetypes.best_match([s.mimetype for s in offered()] + [MIMETYPE_NDJSON]) == MIMETYPE_NDJSON
+
+def ndjson(objects):
+    # newline delimited json, one compact line per object
+    for o in objects:
+        yield dumps_json(o) + b'\n'
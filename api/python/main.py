@@ -18,13 +18,14 @@ import helpers.flask
 import helpers.metadata
 import helpers.iap
 import helpers.json
+import helpers.compression
 
 app = Flask(__name__)
-app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
 app.json_encoder = helpers.json.CustomJSONEncoder
 
 from versions.alpha import bp as alpha
 app.register_blueprint(alpha)
+app.after_request(helpers.compression.compress)
 
 @app.before_request
 def validate_iap_authn():
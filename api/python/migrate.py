@@ -0,0 +1,22 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# one-time migration of stored connections, run with the environment from env.sh
+import data.connections
+
+if __name__ == '__main__':
+    for name in data.connections.migrate_keys():
+        print('keyed by name: {}'.format(name))
+    for name in data.connections.migrate_encryption():
+        print('re-encrypted with envelope key: {}'.format(name))
@@ -0,0 +1,238 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# stand-ins for a bound helpers.ldap.SaslBindingContext over an in-memory directory, recording the
+# operations sent so that tests can assert round trips
+
+import itertools
+import re
+import ldap
+from ldap import SCOPE_BASE, SCOPE_ONELEVEL, SCOPE_SUBTREE
+from helpers.ldap import RESULT_KEY_DN, RESULT_KEY_ATTRIBUTES
+
+CONNECTION = {'name': 'test', 'ldapUrl': 'ldap://test', 'credentials': {'user': 'test@EXAMPLE.COM', 'password': 'secret'}}
+
+RANGE = re.compile(r'^(.+);range=(\d+)-(\d+|\*)$', re.IGNORECASE)
+EQUALITY = re.compile(r'^\(([^=()]+)=([^()]*)\)$')
+
+def error(cls, desc, msgid=None):
+    d = {'desc': desc}
+    if msgid is not None:
+        d['msgid'] = msgid
+    return cls(d)
+
+class Context:
+    # entries maps dns to {attribute: [bytes]}. max_values > 0 returns larger attributes in ranges like AD,
+    # ranged=False returns nothing for ranged requests like a server without ranged retrieval and
+    # sorting=False ignores sort controls
+    session_ids = itertools.count()
+
+    def __init__(self, entries=None, max_values=0, ranged=True, sorting=True):
+        self.entries = {dn.lower(): (dn, {k: list(v) for k, v in attrs.items()}) for dn, attrs in (entries or {}).items()}
+        self.max_values = max_values
+        self.ranged = ranged
+        self.sorting = sorting
+        self.session_id = 'session-{}'.format(next(Context.session_ids))
+        self.operations = []
+        self.pending = [] # (msgid, entries or None, error) of asynchronous operations
+        self.msgids = itertools.count(1)
+        self.stale = False # paged results cookies of this session expired
+
+    def another(self):
+        # a new session over the same directory
+        context = Context(max_values=self.max_values, ranged=self.ranged, sorting=self.sorting)
+        context.entries = self.entries
+        return context
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        self.operations.append(('bind',))
+
+    def close(self):
+        self.operations.append(('unbind',))
+
+    def whoami(self):
+        self.operations.append(('whoami',))
+        return 'u:test'
+
+    def names(self):
+        # the operation names sent, in order
+        return [o[0] for o in self.operations]
+
+    def entry(self, dn):
+        found = self.entries.get(dn.lower())
+        if found is None:
+            raise error(ldap.NO_SUCH_OBJECT, 'No such object')
+        return found
+
+    def matches(self, attrs, filter):
+        if filter is None or filter.lower() == '(objectclass=*)':
+            return True
+        m = EQUALITY.match(filter)
+        if not m:
+            raise error(ldap.FILTER_ERROR, 'Bad search filter')
+        values = next((v for k, v in attrs.items() if k.lower() == m.group(1).lower()), [])
+        return m.group(2).lower().encode('utf-8') in [v.lower() for v in values]
+
+    def project(self, attrs, attributes):
+        # attributes as a server returns them for the requested attribute list
+        if attributes == ['1.1'] or attributes == ['']:
+            return {}
+        everything = attributes is None or '*' in attributes
+        requested = {} # lowercase name -> (low, high) of explicitly ranged requests or None
+        for a in attributes or []:
+            m = RANGE.match(a)
+            if m:
+                requested[m.group(1).lower()] = (int(m.group(2)), None if m.group(3) == '*' else int(m.group(3)))
+            else:
+                requested.setdefault(a.lower(), None)
+        projected = {}
+        for k, v in attrs.items():
+            if not everything and not k.lower() in requested:
+                continue
+            r = requested.get(k.lower())
+            if r is not None and not self.ranged:
+                continue # unknown attribute option
+            elif r is not None:
+                (low, high) = r
+                high = len(v) - 1 if high is None else high
+                if self.max_values:
+                    high = min(high, low + self.max_values - 1)
+                last = high >= len(v) - 1
+                projected['{};range={}-{}'.format(k, low, '*' if last else high)] = v[low:high + 1]
+            elif self.max_values and len(v) > self.max_values and self.ranged:
+                projected['{};range=0-{}'.format(k, self.max_values - 1)] = v[:self.max_values]
+            else:
+                projected[k] = list(v)
+        return projected
+
+    def find(self, base, scope, filter, attributes):
+        (dn, attrs) = self.entry(base) if scope == SCOPE_BASE or base else (None, None)
+        if scope == SCOPE_BASE:
+            candidates = [(dn, attrs)]
+        else:
+            suffix = ',' + base.lower()
+            candidates = [(d, a) for k, (d, a) in sorted(self.entries.items()) if (k == base.lower() and scope == SCOPE_SUBTREE) or (k.endswith(suffix) and (scope == SCOPE_SUBTREE or not ',' in k[:-len(suffix)]))]
+        return [{RESULT_KEY_DN: d, RESULT_KEY_ATTRIBUTES: self.project(a, attributes)} for d, a in candidates if self.matches(a, filter)]
+
+    def search(self, base, scope=SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, referrals=False, attrsonly=False, serverctrls=None):
+        self.operations.append(('search', base, scope, filter, attributes))
+        return self.find(base, scope, filter, attributes)
+
+    def search_pages(self, base, scope=SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, referrals=False, attrsonly=False, page_size=1000, serverctrls=None):
+        cookie = b''
+        while True:
+            (entries, cookie) = self.search_page(base, scope, filter, attributes, referrals, attrsonly, page_size, cookie, serverctrls)
+            yield entries
+            if not cookie:
+                break
+
+    def search_page(self, base, scope=SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, referrals=False, attrsonly=False, page_size=1000, cookie=b'', serverctrls=None):
+        (entries, cookie, ordered) = self.search_sorted_page(base, scope, filter, attributes, referrals, attrsonly, page_size, cookie)
+        return entries, cookie
+
+    def search_sorted_page(self, base, scope=SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, referrals=False, attrsonly=False, page_size=1000, cookie=b'', sort=None):
+        # cookies hold the offset of the next page and are only valid on the session that issued them
+        self.operations.append(('search', base, scope, filter, attributes))
+        if cookie:
+            (session_id, offset) = cookie.decode('ascii').split(':')
+            if session_id != self.session_id or self.stale:
+                raise error(ldap.UNWILLING_TO_PERFORM, 'Unwilling to perform')
+            offset = int(offset)
+        else:
+            offset = 0
+        found = self.find(base, scope, filter, attributes)
+        page = found[offset:offset + page_size]
+        more = offset + page_size < len(found)
+        return page, '{}:{}'.format(self.session_id, offset + page_size).encode('ascii') if more else b'', self.sorting
+
+    def add(self, dn, modlist):
+        self.operations.append(('add', dn, modlist))
+        if dn.lower() in self.entries:
+            raise error(ldap.ALREADY_EXISTS, 'Already exists')
+        self.entries[dn.lower()] = (dn, {k: list(v) for k, v in modlist})
+
+    def modify(self, dn, modlist, serverctrls=None):
+        self.operations.append(('modify', dn, modlist))
+        attrs = self.entry(dn)[1]
+        for (op, k, values) in modlist:
+            name = next((a for a in attrs if a.lower() == k.lower()), k)
+            if op == ldap.MOD_REPLACE:
+                attrs[name] = list(values)
+            elif op == ldap.MOD_ADD:
+                attrs.setdefault(name, []).extend(v for v in values if not v in attrs.get(name, []))
+            elif values is None:
+                attrs.pop(name, None)
+            else:
+                attrs[name] = [v for v in attrs.get(name, []) if not v in values]
+            if not attrs.get(name, True):
+                del attrs[name]
+
+    def delete(self, dn):
+        self.operations.append(('delete', dn))
+        self.entry(dn)
+        del self.entries[dn.lower()]
+
+    def rename(self, dn, rdn):
+        self.operations.append(('rename', dn, rdn))
+        (old, attrs) = self.entry(dn)
+        new = '{},{}'.format(rdn, old.split(',', 1)[1])
+        del self.entries[dn.lower()]
+        (k, v) = rdn.split('=', 1)
+        attrs[next((a for a in attrs if a.lower() == k.lower()), k)] = [v.encode('utf-8')]
+        self.entries[new.lower()] = (new, attrs)
+
+    # asynchronous operations complete when collected, in reverse order of sending so that callers can't
+    # rely on the order
+
+    def queue(self, f):
+        msgid = next(self.msgids)
+        try:
+            self.pending.append((msgid, f(), None))
+        except ldap.LDAPError as e:
+            e.args[0]['msgid'] = msgid
+            self.pending.append((msgid, None, e))
+        return msgid
+
+    def search_async(self, base, scope=SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, attrsonly=False, serverctrls=None):
+        return self.queue(lambda: self.search(base, scope, filter, attributes))
+
+    def add_async(self, dn, modlist):
+        return self.queue(lambda: self.add(dn, modlist))
+
+    def modify_async(self, dn, modlist, serverctrls=None):
+        return self.queue(lambda: self.modify(dn, modlist, serverctrls))
+
+    def delete_async(self, dn):
+        return self.queue(lambda: self.delete(dn))
+
+    def rename_async(self, dn, rdn):
+        return self.queue(lambda: self.rename(dn, rdn))
+
+    def result(self, msgid=ldap.RES_ANY, referrals=False, timeout=None):
+        i = len(self.pending) - 1 if msgid == ldap.RES_ANY else next(i for i, x in enumerate(self.pending) if x[0] == msgid)
+        (msgid, entries, e) = self.pending.pop(i)
+        if e:
+            raise e
+        return msgid, entries, []
+
+    def abandon(self, msgid):
+        self.operations.append(('abandon', msgid))
+        self.pending = [x for x in self.pending if x[0] != msgid]
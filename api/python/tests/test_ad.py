@@ -0,0 +1,232 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import pytest
+import helpers.ad
+import helpers.json
+import helpers.ldap
+import helpers.pool
+import data.ad
+from helpers.ldap import RESULT_KEY_DN, RESULT_KEY_ATTRIBUTES
+from tests.stubs import Context, CONNECTION
+
+BASE = 'OU=users,DC=example,DC=com'
+
+GROUP = 'CN=group,{}'.format(BASE)
+
+def users(n):
+    # n users and a group of all of them
+    entries = {BASE: {'objectClass': [b'organizationalUnit'], 'ou': [b'users']}}
+    for i in range(n):
+        entries['CN=user{:03},{}'.format(i, BASE)] = {'objectClass': [b'user'], 'cn': ['user{:03}'.format(i).encode('utf-8')]}
+    entries[GROUP] = {'objectClass': [b'group'], 'cn': [b'group'], 'member': [dn.encode('utf-8') for dn in entries if dn != BASE]}
+    return entries
+
+@pytest.fixture(autouse=True)
+def bundled_schema(monkeypatch):
+    monkeypatch.setattr(data.ad, 'connection_codecs', lambda connection: None)
+
+@pytest.fixture
+def directory(monkeypatch):
+    # every session the pool opens is a stub over the same directory, sessions are kept in order of opening
+    root = Context(users(23))
+    sessions = []
+    def factory(*args, **kwargs):
+        sessions.append(root.another())
+        return sessions[-1]
+    monkeypatch.setattr(helpers.ldap, 'SaslBindingContext', factory)
+    helpers.pool.invalidate(CONNECTION['name'])
+    yield root, sessions
+    helpers.pool.invalidate(CONNECTION['name'])
+
+def page_through(page_size, between=None):
+    dns = []
+    token = None
+    while True:
+        (entries, token) = data.ad.get_page(CONNECTION, BASE, filter='(objectClass=user)', page_size=page_size, page_token=token)
+        dns += [o[RESULT_KEY_DN] for o in entries]
+        if not token:
+            return dns
+        if between:
+            between()
+
+def test_get_page_continues_on_the_issuing_session(directory):
+    (root, sessions) = directory
+    dns = page_through(5)
+    assert dns == sorted(dns) and len(set(dns)) == 23
+    assert len(sessions) == 1
+    assert sessions[0].names() == ['bind'] + ['search'] * 5
+
+def test_get_page_replays_sorted_search_on_another_session(directory):
+    (root, sessions) = directory
+    dns = page_through(5, between=lambda: helpers.pool.invalidate(CONNECTION['name']))
+    assert dns == sorted(dns) and len(set(dns)) == 23
+    assert len(sessions) == 5
+
+def test_get_page_rejects_expired_cookie(directory):
+    (root, sessions) = directory
+    (entries, token) = data.ad.get_page(CONNECTION, BASE, page_size=5)
+    sessions[0].stale = True
+    with pytest.raises(data.ad.InvalidPageTokenError):
+        data.ad.get_page(CONNECTION, BASE, page_size=5, page_token=token)
+
+def test_get_page_rejects_unsorted_token_on_another_session(directory):
+    (root, sessions) = directory
+    root.sorting = False
+    (entries, token) = data.ad.get_page(CONNECTION, BASE, page_size=5)
+    helpers.pool.invalidate(CONNECTION['name'])
+    with pytest.raises(data.ad.InvalidPageTokenError):
+        data.ad.get_page(CONNECTION, BASE, page_size=5, page_token=token)
+
+def test_get_page_rejects_token_of_another_search(directory):
+    (entries, token) = data.ad.get_page(CONNECTION, BASE, page_size=5)
+    with pytest.raises(data.ad.InvalidPageTokenError):
+        data.ad.get_page(CONNECTION, BASE, filter='(cn=user001)', page_size=5, page_token=token)
+
+def members():
+    return ['CN=user{:03},{}'.format(i, BASE) for i in range(23)]
+
+@pytest.mark.parametrize('ranged', [True, False])
+def test_iterate_values(directory, ranged):
+    (root, sessions) = directory
+    root.ranged = ranged
+    root.max_values = 10
+    assert list(data.ad.iterate_values(CONNECTION, GROUP, 'member')) == members()
+
+@pytest.mark.parametrize('ranged', [True, False])
+def test_get_values_page(directory, ranged):
+    (root, sessions) = directory
+    root.ranged = ranged
+    values = []
+    token = None
+    while True:
+        (page, token) = data.ad.get_values_page(CONNECTION, GROUP, 'member', page_size=10, page_token=token)
+        values += page
+        if not token:
+            break
+    assert values == members()
+
+def test_get_merges_truncated_ranges(directory):
+    (root, sessions) = directory
+    root.max_values = 10
+    found = data.ad.get(CONNECTION, GROUP, scope=data.ad.SCOPE_BASE, attributes=['member'])
+    assert dict(found[0]['attributes']) == {'member': members()}
+
+def test_get_leaves_explicit_ranges(directory):
+    (root, sessions) = directory
+    found = data.ad.get(CONNECTION, GROUP, scope=data.ad.SCOPE_BASE, attributes=['member;range=0-4'])
+    assert dict(found[0]['attributes']) == {'member;range=0-4': members()[0:5]}
+
+def modify_operations(context):
+    return [o for o in context.operations if o[0] == 'modify']
+
+def test_patch_base_diffs_multi_valued_attributes_like_search():
+    added = 'CN=new,{}'.format(BASE)
+    patch = {'member': members() + [added]}
+    by_base = Context(users(23))
+    data.ad.update(CONNECTION, GROUP, dict(patch), scope=data.ad.SCOPE_BASE, context=by_base, minimal=True)
+    by_search = Context(users(23))
+    data.ad.update(CONNECTION, BASE, dict(patch), scope=data.ad.SCOPE_SUBTREE, filter='(cn=group)', context=by_search, minimal=True)
+    assert modify_operations(by_base) == modify_operations(by_search) == [('modify', GROUP, [(data.ad.ldap.MOD_ADD, 'member', [added.encode('utf-8')])])]
+
+def test_patch_base_replaces_single_valued_attributes_without_search():
+    context = Context(users(23))
+    data.ad.update(CONNECTION, GROUP, {'displayName': 'Group'}, scope=data.ad.SCOPE_BASE, context=context, minimal=True)
+    assert context.operations == [('modify', GROUP, [(data.ad.ldap.MOD_REPLACE, 'displayname', [b'Group'])])]
+
+USER = 'CN=user001,{}'.format(BASE)
+
+def test_create_operations():
+    context = Context(users(23))
+    created = data.ad.create(CONNECTION, BASE, {'objectClass': 'user', 'cn': 'created', 'sAMAccountName': 'created'}, scope=data.ad.SCOPE_BASE, context=context)
+    assert created['dn'] == 'cn=created,{}'.format(BASE)
+    assert context.names() == ['search', 'add', 'search']
+    (name, base, scope, filter, attributes) = context.operations[0]
+    assert (base, scope, attributes) == (BASE, data.ad.SCOPE_BASE, data.ad.NO_ATTRIBUTES)
+
+def test_create_minimal_operations():
+    context = Context(users(23))
+    data.ad.create(CONNECTION, BASE, {'objectClass': 'user', 'cn': 'created'}, scope=data.ad.SCOPE_BASE, context=context, minimal=True)
+    assert context.names() == ['search', 'add']
+
+def test_update_with_rename_operations():
+    context = Context(users(23))
+    updated = data.ad.update(CONNECTION, BASE, {'cn': 'renamed', 'displayName': 'Renamed'}, scope=data.ad.SCOPE_SUBTREE, filter='(cn=user001)', context=context)
+    assert updated['dn'].lower() == 'cn=renamed,{}'.format(BASE).lower()
+    assert context.names() == ['search', 'rename', 'modify', 'search']
+    # only the replaced attributes are read
+    assert context.operations[0][4] == ['cn', 'displayName']
+    assert context.operations[1][1] == USER and context.operations[1][2].lower() == 'cn=renamed'
+
+def test_update_base_with_rename_minimal_operations():
+    context = Context(users(23))
+    data.ad.update(CONNECTION, USER, {'cn': 'renamed', 'displayName': 'Renamed'}, scope=data.ad.SCOPE_BASE, context=context, minimal=True)
+    assert context.names() == ['rename', 'modify']
+
+def test_update_unchanged_operations():
+    context = Context(users(23))
+    data.ad.update(CONNECTION, BASE, {'cn': 'user001'}, scope=data.ad.SCOPE_SUBTREE, filter='(cn=user001)', context=context, minimal=True)
+    assert context.names() == ['search']
+
+def test_delete_operations():
+    context = Context(users(23))
+    data.ad.delete(CONNECTION, USER, scope=data.ad.SCOPE_BASE, context=context)
+    assert context.names() == ['search', 'delete']
+    assert not USER.lower() in context.entries
+
+RAW = {
+    'cn': [b'user001'],
+    'objectGUID': [bytes.fromhex('6e8c4f3ab4128e4c9f3a0b6d2c1e5f7a')],
+    'whenCreated': [b'20210101120000.0Z'],
+    'accountExpires': [b'9223372036854775807'],
+    'userAccountControl': [b'512'],
+    'member': [b'CN=a,DC=example,DC=com', b'CN=b,DC=example,DC=com'],
+    'member;range=0-1': [b'CN=a,DC=example,DC=com', b'CN=b,DC=example,DC=com'],
+    'unicodePwd': [b'secret']
+}
+
+def eager(raw, exclude=frozenset()):
+    # the attributes as they were formatted before serializing
+    return {k: helpers.ad.format_attribute(k, v) for k, v in raw.items() if not k.split(';')[0].lower() in exclude}
+
+def dumps(o):
+    return json.dumps(o, cls=helpers.json.CustomJSONEncoder, sort_keys=True)
+
+@pytest.mark.parametrize('exclude', [frozenset(), frozenset(['unicodepwd', 'member'])])
+def test_externalize_serializes_like_formatted_attributes(exclude):
+    o = data.ad.externalize({RESULT_KEY_DN: USER, RESULT_KEY_ATTRIBUTES: RAW}, exclude=exclude)
+    assert dumps(o) == dumps({RESULT_KEY_DN: USER, RESULT_KEY_ATTRIBUTES: eager(RAW, exclude)})
+    assert dict(o[RESULT_KEY_ATTRIBUTES]) == dict(o[RESULT_KEY_ATTRIBUTES].items()) == o[RESULT_KEY_ATTRIBUTES].formatted() == eager(RAW, exclude)
+
+def test_formatted_attributes_hide_excluded():
+    attrs = data.ad.FormattedAttributes(RAW, exclude=frozenset(['unicodepwd', 'member']))
+    assert len(attrs) == len(list(attrs)) == 5
+    assert not 'unicodePwd' in attrs and not 'member;range=0-1' in attrs and 'cn' in attrs
+    with pytest.raises(KeyError):
+        attrs['unicodePwd']
+
+def test_formatted_attributes_format_only_what_is_read(monkeypatch):
+    formatted = []
+    format_attribute = helpers.ad.format_attribute
+    def recording(k, v, customize=True, codecs=None):
+        if customize: # custom formatters format with the standard ones
+            formatted.append(k)
+        return format_attribute(k, v, customize, codecs)
+    monkeypatch.setattr(helpers.ad, 'format_attribute', recording)
+    attrs = data.ad.externalize({RESULT_KEY_DN: USER, RESULT_KEY_ATTRIBUTES: RAW})[RESULT_KEY_ATTRIBUTES]
+    assert formatted == []
+    assert attrs['cn'] == 'user001' and formatted == ['cn']
+    dumps(attrs)
+    assert formatted == ['cn'] + list(RAW)
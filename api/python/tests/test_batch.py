@@ -0,0 +1,79 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from flask import Flask
+import helpers.ldap
+import helpers.pool
+import data.ad
+import data.connections
+import versions.alpha
+from tests.stubs import Context, CONNECTION
+
+BASE = 'OU=users,DC=example,DC=com'
+
+def dn(name):
+    return 'CN={},{}'.format(name, BASE)
+
+@pytest.fixture
+def directory(monkeypatch):
+    # the batch route over a stub directory, sessions are kept in order of opening
+    root = Context({BASE: {'objectClass': [b'organizationalUnit']}, dn('existing'): {'objectClass': [b'user'], 'cn': [b'existing']}})
+    sessions = []
+    def factory(*args, **kwargs):
+        sessions.append(root.another())
+        return sessions[-1]
+    monkeypatch.setattr(helpers.ldap, 'SaslBindingContext', factory)
+    monkeypatch.setattr(data.connections, 'get', lambda name: CONNECTION)
+    monkeypatch.setattr(data.ad, 'connection_codecs', lambda connection: None)
+    helpers.pool.invalidate(CONNECTION['name'])
+    app = Flask(__name__)
+    app.register_blueprint(versions.alpha.bp)
+    yield app.test_client(), root, sessions
+    helpers.pool.invalidate(CONNECTION['name'])
+
+OPERATIONS = [
+    {'method': 'create', 'base': BASE, 'scope': 'base', 'body': {'attributes': {'objectClass': 'user', 'cn': 'first'}}, 'return': 'minimal'},
+    {'method': 'patch', 'base': dn('missing'), 'body': {'attributes': {'displayName': 'Missing'}}},
+    {'method': 'create', 'base': BASE, 'scope': 'base', 'body': {'attributes': {'objectClass': 'user', 'cn': 'existing'}}},
+    {'method': 'delete', 'base': dn('existing')}
+]
+
+def batch(client, **kwargs):
+    response = client.post('/alpha/connections/test/ldap:batch', json=dict(operations=OPERATIONS, **kwargs))
+    assert response.status_code == 200
+    return [r['status'] for r in response.get_json()['results']]
+
+def test_batch_continues_after_failures(directory):
+    (client, root, sessions) = directory
+    assert batch(client) == [204, 404, 400, 200]
+    assert dn('first').lower() in root.entries and not dn('existing').lower() in root.entries
+    # all operations ran on one bound session
+    assert len(sessions) == 1 and sessions[0].names().count('bind') == 1
+
+def test_batch_stops_on_error(directory):
+    (client, root, sessions) = directory
+    assert batch(client, stopOnError=True) == [204, 404, 424, 424]
+    assert dn('first').lower() in root.entries and dn('existing').lower() in root.entries
+
+def test_batch_reports_invalid_operations(directory):
+    (client, root, sessions) = directory
+    response = client.post('/alpha/connections/test/ldap:batch', json={'operations': [{'method': 'get', 'base': BASE}, OPERATIONS[0]]})
+    results = response.get_json()['results']
+    assert [r['status'] for r in results] == [400, 204] and results[0]['message'].startswith('method expected')
+
+def test_batch_rejects_too_many_operations(directory):
+    (client, root, sessions) = directory
+    response = client.post('/alpha/connections/test/ldap:batch', json={'operations': [OPERATIONS[3]] * (versions.alpha.MAX_BATCH_SIZE + 1)})
+    assert response.status_code == 400 and sessions == []
@@ -0,0 +1,104 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import pytest
+import helpers.cache
+
+class Clock:
+    # stands in for the time module in helpers.cache
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(helpers.cache, 'time', clock)
+    return clock
+
+class Loader:
+    # returns how often it was called, blocking while released is cleared
+    def __init__(self):
+        self.calls = 0
+        self.released = threading.Event()
+        self.released.set()
+
+    def __call__(self):
+        self.released.wait(5)
+        self.calls += 1
+        return self.calls
+
+def test_hits_until_expiry(clock):
+    cache = helpers.cache.TTLCache('test', ttl=60)
+    load = Loader()
+    assert cache.get('a', load) == 1
+    clock.now += 59
+    assert cache.get('a', load) == 1 and cache.get('a') == 1
+    clock.now += 1
+    assert cache.get('a') is None
+    assert cache.get('a', load) == 2
+
+def test_least_recently_used_is_evicted(clock):
+    cache = helpers.cache.TTLCache('test', max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+
+def test_invalidate(clock):
+    cache = helpers.cache.TTLCache('test')
+    for k in [('x', 1), ('x', 2), ('y', 1)]:
+        cache.put(k, k)
+    cache.invalidate(('x', 1))
+    assert cache.get(('x', 1)) is None and cache.get(('x', 2)) == ('x', 2)
+    cache.invalidate_matching(lambda k: k[0] == 'x')
+    assert cache.get(('x', 2)) is None and cache.get(('y', 1)) == ('y', 1)
+    cache.invalidate()
+    assert cache.entries == {}
+
+def wait_refreshed(cache, key):
+    for i in range(500):
+        with cache.lock:
+            if not key in cache.refreshing:
+                return
+        threading.Event().wait(0.01)
+    raise AssertionError('refresh did not finish')
+
+def test_refresh_ahead_reloads_in_background(clock):
+    cache = helpers.cache.TTLCache('test', ttl=60, refresh_ahead=10)
+    load = Loader()
+    cache.get('a', load)
+    clock.now += 55
+    # the cached value is returned while it is reloaded
+    assert cache.get('a', load) == 1
+    wait_refreshed(cache, 'a')
+    assert cache.get('a') == 2
+    clock.now += 59
+    assert cache.get('a') == 2
+
+def test_refresh_ahead_does_not_restore_invalidated(clock):
+    cache = helpers.cache.TTLCache('test', ttl=60, refresh_ahead=10)
+    load = Loader()
+    cache.get('a', load)
+    load.released.clear()
+    clock.now += 55
+    cache.get('a', load)
+    cache.invalidate('a')
+    load.released.set()
+    wait_refreshed(cache, 'a')
+    assert cache.get('a') is None
@@ -0,0 +1,147 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import uuid
+import ldap
+import pytest
+import helpers.ldap
+import helpers.pool
+import data.ad
+import data.changes
+from helpers.ldap import RESULT_KEY_DN, RESULT_KEY_ATTRIBUTES
+from tests.stubs import Context, CONNECTION, error
+
+ROOT = 'DC=example,DC=com'
+BASE = 'OU=users,{}'.format(ROOT)
+SERVER = 'CN=NTDS Settings,CN=DC1,CN=Servers,CN=Site,CN=Sites,CN=Configuration,{}'.format(ROOT)
+
+USN_RANGE = re.compile(r'\(uSNChanged>=(\d+)\)\(uSNChanged<=(\d+)\)')
+
+class Directory(Context):
+    # a domain controller's database where every write takes the next usn, dirsync cookies hold the
+    # highest usn returned and dirsync=False refuses dirsync like an account without the right for it
+    def __init__(self):
+        super(Directory, self).__init__()
+        self.high = 0
+        self.invocation = uuid.uuid4()
+        self.deleted = {}
+        self.dirsync = True
+
+    def another(self):
+        return self
+
+    def write(self, name, attrs=None):
+        self.high += 1
+        dn = 'CN={},{}'.format(name, BASE)
+        previous = self.entries.get(dn.lower())
+        created = previous[1]['uSNCreated'] if previous else [str(self.high).encode('ascii')]
+        self.entries[dn.lower()] = (dn, dict(attrs or {}, cn=[name.encode('utf-8')], uSNCreated=created, uSNChanged=[str(self.high).encode('ascii')]))
+
+    def remove(self, name):
+        self.high += 1
+        (dn, attrs) = self.entries.pop('CN={},{}'.format(name, BASE).lower())
+        self.deleted[dn] = {'name': attrs['cn'], 'isDeleted': [b'TRUE'], 'lastKnownParent': [BASE.encode('utf-8')], 'uSNChanged': [str(self.high).encode('ascii')]}
+
+    def search(self, base, scope=ldap.SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, referrals=False, attrsonly=False, serverctrls=None):
+        self.operations.append(('search', base, scope, filter, attributes))
+        if base == '':
+            return [{RESULT_KEY_DN: '', RESULT_KEY_ATTRIBUTES: {'highestCommittedUSN': [str(self.high).encode('ascii')], 'dsServiceName': [SERVER.encode('utf-8')], 'defaultNamingContext': [ROOT.encode('utf-8')]}}]
+        elif base == SERVER:
+            return [{RESULT_KEY_DN: SERVER, RESULT_KEY_ATTRIBUTES: {'invocationId': [self.invocation.bytes_le]}}]
+        return super(Directory, self).search(base, scope, filter, attributes)
+
+    def changed(self, low, high):
+        # (dn, attrs) of live entries with low <= uSNChanged <= high
+        return [(dn, attrs) for dn, attrs in sorted(self.entries.values()) if 'uSNChanged' in attrs and low <= int(attrs['uSNChanged'][0]) <= high]
+
+    def search_pages(self, base, scope=ldap.SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, referrals=False, attrsonly=False, page_size=1000, serverctrls=None):
+        self.operations.append(('search', base, scope, filter, attributes))
+        (low, high) = (int(x) for x in USN_RANGE.search(filter).groups())
+        if '(isDeleted=TRUE)' in filter:
+            yield [{RESULT_KEY_DN: dn, RESULT_KEY_ATTRIBUTES: attrs} for dn, attrs in self.deleted.items() if low <= int(attrs['uSNChanged'][0]) <= high]
+        else:
+            yield [{RESULT_KEY_DN: dn, RESULT_KEY_ATTRIBUTES: dict(attrs)} for dn, attrs in self.changed(low, high)]
+
+    def search_dirsync(self, base, filter, attributes, cookie, flags):
+        self.operations.append(('dirsync', base, cookie))
+        if not self.dirsync:
+            raise error(ldap.INSUFFICIENT_ACCESS, 'Insufficient access')
+        low = int(cookie.decode('ascii')) + 1 if cookie else 0
+        entries = [{RESULT_KEY_DN: dn, RESULT_KEY_ATTRIBUTES: dict(attrs, **({'whenCreated': [b'20210101120000.0Z']} if int(attrs['uSNCreated'][0]) >= low else {}))} for dn, attrs in self.changed(low, self.high)]
+        entries += [{RESULT_KEY_DN: dn, RESULT_KEY_ATTRIBUTES: attrs} for dn, attrs in self.deleted.items() if int(attrs['uSNChanged'][0]) >= low]
+        return entries, str(self.high).encode('ascii'), False
+
+@pytest.fixture
+def directory(monkeypatch):
+    directory = Directory()
+    directory.entries[BASE.lower()] = (BASE, {'objectClass': [b'organizationalUnit']})
+    for name in ('alice', 'bob', 'carol'):
+        directory.write(name)
+    monkeypatch.setattr(helpers.ldap, 'SaslBindingContext', lambda *args, **kwargs: directory)
+    monkeypatch.setattr(data.ad, 'connection_codecs', lambda connection: None)
+    helpers.pool.invalidate(CONNECTION['name'])
+    yield directory
+    helpers.pool.invalidate(CONNECTION['name'])
+
+def changes(watermark=None, method=None):
+    # ({cn: change}, last record) of one call
+    records = list(data.changes.iterate(CONNECTION, BASE, attributes=['cn'], watermark=watermark, method=method))
+    found = {}
+    for o in records[:-1]:
+        name = o['attributes']['cn'] if o['change'] != data.changes.DELETED else o['attributes']['name']
+        found[name if isinstance(name, str) else name[0]] = o['change']
+    return found, records[-1]
+
+def modify(directory):
+    directory.write('alice', {'displayName': [b'Alice']})
+    directory.write('dave')
+    directory.remove('bob')
+
+@pytest.mark.parametrize('method', [data.changes.DIRSYNC, data.changes.USN])
+def test_changes_continue_from_watermark(directory, method):
+    (found, last) = changes(method=method)
+    assert found == {'alice': 'created', 'bob': 'created', 'carol': 'created'} and not 'resync' in last
+    modify(directory)
+    (found, last) = changes(last['watermark'])
+    assert found == {'alice': 'modified', 'dave': 'created', 'bob': 'deleted'} and not 'resync' in last
+    (found, last) = changes(last['watermark'])
+    assert found == {} and not 'resync' in last
+
+def test_changes_fall_back_to_usn_without_dirsync(directory):
+    directory.dirsync = False
+    (found, last) = changes()
+    assert found == {'alice': 'created', 'bob': 'created', 'carol': 'created'}
+    assert data.changes.decode_watermark(last['watermark'], data.ad.page_token_params(CONNECTION, BASE, ldap.SCOPE_SUBTREE, None, ['cn']))['m'] == data.changes.USN
+
+def test_usn_watermark_of_another_database_resyncs(directory):
+    (found, last) = changes(method=data.changes.USN)
+    modify(directory)
+    # restored from backup or another domain controller, its usns don't continue the watermark's
+    directory.invocation = uuid.uuid4()
+    (found, last) = changes(last['watermark'])
+    assert found == {'alice': 'created', 'carol': 'created', 'dave': 'created'} and last['resync'] is True
+    deleted_searches = [o for o in directory.operations if o[0] == 'search' and 'isDeleted' in (o[3] or '')]
+    assert deleted_searches == []
+    # the new watermark continues on the new database
+    directory.write('erin')
+    (found, last) = changes(last['watermark'])
+    assert found == {'erin': 'created'} and not 'resync' in last
+
+def test_watermark_of_another_request_is_rejected(directory):
+    (found, last) = changes()
+    with pytest.raises(data.changes.InvalidWatermarkError):
+        list(data.changes.iterate(CONNECTION, ROOT, attributes=['cn'], watermark=last['watermark']))
+    with pytest.raises(data.changes.InvalidWatermarkError):
+        list(data.changes.iterate(CONNECTION, BASE, attributes=['cn'], watermark='not a watermark'))
@@ -0,0 +1,96 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# the compiled codecs must resolve exactly like ldap3's format_attribute_values and find_attribute_validator,
+# which formatted and validated every value before
+
+import uuid
+import pytest
+from ldap3 import SEQUENCE_TYPES
+from ldap3.protocol.formatters import formatters
+from ldap3.protocol.formatters.standard import format_attribute_values, find_attribute_validator, find_attribute_helpers
+import helpers.ad
+
+SAMPLES = [
+    b'hello',
+    b'CN=Someone,OU=users,DC=example,DC=com',
+    b'0', b'-1', b'512', b'132539328000000000', b'9223372036854775807', b'-36000000000',
+    b'TRUE', b'FALSE',
+    b'20210101120000.0Z',
+    uuid.UUID('3a4f8c6e-12b4-4c8e-9f3a-0b6d2c1e5f7a').bytes_le,
+    bytes.fromhex('010500000000000515000000a065cf7e784b9b5fe77c8770e8030000'),
+    b'\xff\xfe\x00',
+]
+
+@pytest.fixture(scope='module')
+def schema():
+    return helpers.ad.load_schema()
+
+def attribute_names(schema):
+    # every name and oid the schema knows an attribute type by
+    names = set()
+    for k, attr_type in schema.attribute_types.items():
+        names.add(k)
+        names.update(attr_type.name if isinstance(attr_type.name, SEQUENCE_TYPES) else [attr_type.name])
+        names.add(attr_type.oid)
+    return sorted(names)
+
+def ldap3_formatter(schema, k, custom):
+    attr_type = schema.attribute_types[k] if k in schema.attribute_types else None
+    found = find_attribute_helpers(attr_type, k, custom)
+    return found if not isinstance(found, tuple) else found[0] or formatters.format_unicode
+
+def outcome(f, *args):
+    try:
+        return f(*args)
+    except Exception as e:
+        return type(e)
+
+def mismatched_codecs(schema, names, customize):
+    custom_formatter = helpers.ad.custom_formatter if customize else None
+    custom_validator = helpers.ad.custom_validator if customize else None
+    mismatched = []
+    for k in names:
+        codec = helpers.ad.attribute_codec(k, customize)
+        attr_type = schema.attribute_types[k] if k in schema.attribute_types else None
+        if (codec.formatter is not ldap3_formatter(schema, k, custom_formatter)
+                or codec.validator is not find_attribute_validator(schema, k, custom_validator)
+                or codec.single_value != bool(attr_type and attr_type.single_value)):
+            mismatched.append(k)
+    return mismatched
+
+def test_codecs_resolve_like_ldap3(schema):
+    assert mismatched_codecs(schema, attribute_names(schema), True) == []
+
+def test_standard_codecs_of_customized_attributes_resolve_like_ldap3(schema):
+    # the uncustomized codecs are only bundled for the attributes that custom formatters and validators wrap
+    names = [k for k in attribute_names(schema) if schema.attribute_types[k].oid in helpers.ad.snapshot()['custom_tuples']]
+    assert names and mismatched_codecs(schema, names, False) == []
+
+def test_formatted_values_match_ldap3(schema):
+    mismatched = []
+    for k in attribute_names(schema):
+        for v in SAMPLES:
+            if outcome(helpers.ad.format_attribute, k, [v]) != outcome(format_attribute_values, schema, k, [v], helpers.ad.custom_formatter):
+                mismatched.append((k, v))
+    assert mismatched == []
+
+def test_unknown_attributes_format_as_unicode(schema):
+    assert helpers.ad.format_attribute('member;range=0-1499', [b'CN=a', b'CN=b']) == format_attribute_values(schema, 'member;range=0-1499', [b'CN=a', b'CN=b'], helpers.ad.custom_formatter)
+
+def test_unknown_attribute_codecs_are_compiled_once():
+    codec = helpers.ad.attribute_codec('notInSchema;range=0-9')
+    assert helpers.ad.attribute_codec('NOTINSCHEMA;range=0-9') is codec
+    codecs = {}
+    assert helpers.ad.attribute_codec('notInSchema', codecs=codecs) is codecs['notinschema']
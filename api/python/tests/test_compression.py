@@ -0,0 +1,106 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import json
+import zlib
+import brotli
+import pytest
+from flask import Flask, Response
+import helpers.compression
+import helpers.env
+import helpers.serializers
+
+ENTRIES = [{'dn': 'CN=user{:03},DC=example,DC=com'.format(i), 'attributes': {'cn': 'user{:03}'.format(i)}} for i in range(200)]
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.after_request(helpers.compression.compress)
+
+    @app.route('/entries')
+    def entries():
+        return helpers.serializers.serialize(ENTRIES)
+
+    @app.route('/small')
+    def small():
+        return helpers.serializers.serialize(ENTRIES[0])
+
+    @app.route('/stream')
+    def stream():
+        return Response(helpers.serializers.ndjson(ENTRIES), mimetype=helpers.serializers.MIMETYPE_NDJSON)
+
+    @app.route('/text')
+    def text():
+        return Response('x' * 4096, mimetype='text/plain')
+
+    return app.test_client()
+
+@pytest.fixture
+def env(monkeypatch):
+    # overrides configuration read through helpers.env
+    def set(name, value):
+        monkeypatch.setitem(helpers.env.name_cache, name, value)
+    return set
+
+def decompress(encoding, data):
+    return brotli.decompress(data) if encoding == 'br' else gzip.decompress(data)
+
+@pytest.mark.parametrize('accept,encoding', [
+    ('gzip, deflate, br', 'br'),
+    ('gzip', 'gzip'),
+    ('br', 'br'),
+    ('br;q=0.5, gzip', 'gzip'),
+    ('deflate', None),
+    ('identity', None),
+    (None, None)
+])
+def test_negotiates_encoding(client, accept, encoding):
+    response = client.get('/entries', headers={'Accept-Encoding': accept} if accept else {})
+    assert response.headers.get('Content-Encoding') == encoding
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    data = decompress(encoding, response.data) if encoding else response.data
+    assert json.loads(data) == ENTRIES
+
+def test_configured_encodings_are_preferred_in_order(client, env):
+    env('COMPRESSION_ENCODINGS', 'gzip,br')
+    assert client.get('/entries', headers={'Accept-Encoding': 'gzip, br'}).headers['Content-Encoding'] == 'gzip'
+    env('COMPRESSION_ENCODINGS', 'gzip')
+    assert client.get('/entries', headers={'Accept-Encoding': 'br'}).headers.get('Content-Encoding') is None
+
+def test_without_brotli_falls_back_to_gzip(client, monkeypatch):
+    monkeypatch.setattr(helpers.compression, 'brotli', None)
+    assert client.get('/entries', headers={'Accept-Encoding': 'gzip, br'}).headers['Content-Encoding'] == 'gzip'
+
+def test_small_responses_are_not_compressed(client):
+    response = client.get('/small', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers.get('Content-Encoding') is None and json.loads(response.data) == ENTRIES[0]
+
+def test_other_mimetypes_are_not_compressed(client):
+    response = client.get('/text', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers.get('Content-Encoding') is None and not 'Vary' in response.headers
+
+@pytest.mark.parametrize('encoding', ['gzip', 'br'])
+def test_streams_are_compressed_incrementally(client, env, encoding):
+    env('COMPRESSION_FLUSH_BYTES', '1024')
+    response = client.get('/stream', headers={'Accept-Encoding': encoding}, buffered=False)
+    assert response.headers['Content-Encoding'] == encoding and not 'Content-Length' in response.headers
+    chunks = list(response.response)
+    response.close()
+    # everything before the final chunk is flushed and decompresses to whole lines
+    d = brotli.Decompressor() if encoding == 'br' else zlib.decompressobj(16 + zlib.MAX_WBITS)
+    flushed = d.process(b''.join(chunks[:-1])) if encoding == 'br' else d.decompress(b''.join(chunks[:-1]))
+    assert len(chunks) > 2 and flushed.endswith(b'\n') and len(flushed) > len(ENTRIES) * 32
+    lines = decompress(encoding, b''.join(chunks)).decode('utf-8').split('\n')
+    assert [json.loads(line) for line in lines[:-1]] == ENTRIES
@@ -0,0 +1,197 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import struct
+import time
+import threading
+import types
+import pytest
+import helpers.kerberos
+import helpers.ldap
+
+class Krb5:
+    # stands in for gssapi, the default ccache is per thread like libkrb5's krb5_ccache_name
+    def __init__(self):
+        self.local = threading.local()
+        self.raw = types.SimpleNamespace(krb5_ccache_name=self.set_ccache)
+
+    def set_ccache(self, name):
+        self.local.ccache = name.decode('utf-8')
+
+    def ccache(self):
+        return getattr(self.local, 'ccache', None)
+
+class LDAPObject:
+    # records the ccache a GSSAPI bind would use, taking long enough for binds of other threads to interleave
+    def __init__(self, binds, ccache):
+        self.binds = binds
+        self.ccache = ccache
+
+    def set_option(self, option, value):
+        pass
+
+    def sasl_interactive_bind_s(self, who, auth):
+        before = self.ccache()
+        time.sleep(0.001)
+        self.binds.append((threading.current_thread().name, before, self.ccache()))
+
+    def unbind_s(self):
+        pass
+
+@pytest.fixture(params=['thread', 'environment'])
+def binds(request, monkeypatch):
+    # (thread name, ccache when the bind started, ccache when it ended) of every bind, with per-thread
+    # ccaches or, without them, KRB5CCNAME
+    krb5 = Krb5()
+    if request.param == 'thread':
+        ccache = krb5.ccache
+    else:
+        delattr(krb5.raw, 'krb5_ccache_name')
+        ccache = lambda: os.environ.get('KRB5CCNAME')
+    recorded = []
+    monkeypatch.setattr(helpers.kerberos, 'gssapi', krb5)
+    monkeypatch.setattr(helpers.kerberos, 'acquire_tgt', lambda userId, password, ccache: None)
+    monkeypatch.setattr(helpers.kerberos.Credential, 'read_times', lambda self: setattr(self, 'endtime', time.time() + 3600))
+    monkeypatch.setattr(helpers.ldap.ldap, 'initialize', lambda url, trace_level=0: LDAPObject(recorded, ccache))
+    monkeypatch.setitem(os.environ, 'KRB5CCNAME', '')
+    return recorded
+
+def bind_repeatedly(userId, password, n):
+    for i in range(n):
+        context = helpers.ldap.SaslBindingContext('ldap://dc.example.com', userId, password)
+        context.open()
+        context.close()
+
+def test_concurrent_binds_use_their_own_ccache(binds):
+    users = {'alice@EXAMPLE.COM': 'alice-password', 'bob@EXAMPLE.COM': 'bob-password'}
+    threads = [threading.Thread(target=bind_repeatedly, args=(userId, password, 50), name=userId) for userId, password in users.items()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    ccaches = {userId: helpers.kerberos.get_credential(userId, password).ccache for userId, password in users.items()}
+    assert len(set(ccaches.values())) == 2
+    assert len(binds) == 100
+    for (userId, before, after) in binds:
+        assert before == after == ccaches[userId]
+
+def octets(data):
+    return struct.pack('>I', len(data)) + data
+
+def principal(realm, *components):
+    return struct.pack('>II', 1, len(components)) + octets(realm) + b''.join(octets(c) for c in components)
+
+def ccache_file(endtime, renew_till, realm=b'EXAMPLE.COM'):
+    # a format 4 FILE ccache holding a service ticket and the tgt
+    def credential(*server):
+        return (principal(realm, b'user') + principal(realm, *server) + struct.pack('>H', 18) + octets(b'k' * 32)
+            + struct.pack('>IIII', endtime - 36000, endtime - 36000, endtime, renew_till) + struct.pack('>BI', 0, 0)
+            + struct.pack('>I', 0) + struct.pack('>I', 0) + octets(b'ticket') + octets(b''))
+    return struct.pack('>HH', 0x0504, 0) + principal(realm, b'user') + credential(b'ldap', b'dc.example.com') + credential(b'krbtgt', realm)
+
+def test_ccache_reader_finds_tgt_times():
+    assert helpers.kerberos.CCacheReader(ccache_file(2000000000, 2000600000)).times() == (2000000000, 2000600000)
+
+class Clock:
+    # stands in for the time module in helpers.kerberos
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def time(self):
+        return self.now
+
+class Renewer:
+    def is_alive(self):
+        return True
+
+@pytest.fixture
+def kdc(monkeypatch):
+    # a fresh credential cache whose tickets are valid for an hour and renewable for a day from when they
+    # are issued, returns the clock and what was requested of the kdc in order
+    clock = Clock()
+    requests = []
+    def issue(name, ccache, renewable=True):
+        requests.append(name)
+        with open(ccache, 'wb') as f:
+            f.write(ccache_file(int(clock.now) + 3600, int(clock.now) + 86400 if renewable else 0))
+    monkeypatch.setattr(helpers.kerberos, 'time', clock)
+    monkeypatch.setattr(helpers.kerberos, 'credentials', {})
+    monkeypatch.setattr(helpers.kerberos, 'renewer', Renewer())
+    monkeypatch.setattr(helpers.kerberos, 'gssapi', types.SimpleNamespace(raw=types.SimpleNamespace()))
+    monkeypatch.setattr(helpers.kerberos, 'acquire_tgt', lambda userId, password, ccache: issue('acquire', ccache))
+    monkeypatch.setattr(helpers.kerberos, 'acquire_tgt_subprocess', lambda userId, password, ccache: issue('kinit', ccache))
+    monkeypatch.setattr(helpers.kerberos, 'renew_tgt_subprocess', lambda ccache: issue('kinit -R', ccache))
+    yield clock, requests
+    helpers.kerberos.close_all()
+
+def test_credentials_are_cached_per_user_and_password(kdc):
+    credential = helpers.kerberos.get_credential('alice@EXAMPLE.COM', 'secret')
+    assert helpers.kerberos.get_credential('alice@EXAMPLE.COM', 'secret') is credential
+    assert helpers.kerberos.get_credential('alice@EXAMPLE.COM', 'changed') is not credential
+    assert helpers.kerberos.get_credential('bob@EXAMPLE.COM', 'secret') is not credential
+
+def test_tickets_are_reused_until_close_to_expiry(kdc):
+    (clock, requests) = kdc
+    ccache = helpers.kerberos.get_ccache('alice@EXAMPLE.COM', 'secret')
+    assert helpers.kerberos.get_ccache('alice@EXAMPLE.COM', 'secret') == ccache
+    clock.now += 3600 - 61
+    helpers.kerberos.get_ccache('alice@EXAMPLE.COM', 'secret')
+    assert requests == ['acquire']
+    clock.now += 2
+    assert helpers.kerberos.get_ccache('alice@EXAMPLE.COM', 'secret') == ccache
+    assert requests == ['acquire', 'acquire']
+
+def test_concurrent_callers_wait_on_one_acquisition(kdc):
+    (clock, requests) = kdc
+    credential = helpers.kerberos.get_credential('alice@EXAMPLE.COM', 'secret')
+    threads = [threading.Thread(target=credential.ensure) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert requests == ['acquire']
+
+def test_subprocess_renews_while_renewable(kdc, monkeypatch):
+    (clock, requests) = kdc
+    monkeypatch.setitem(helpers.env.name_cache, 'KERBEROS_PROVIDER', 'subprocess')
+    helpers.kerberos.get_ccache('alice@EXAMPLE.COM', 'secret')
+    clock.now += 3550
+    helpers.kerberos.get_ccache('alice@EXAMPLE.COM', 'secret')
+    # expired tickets can't be renewed
+    clock.now += 3700
+    helpers.kerberos.get_ccache('alice@EXAMPLE.COM', 'secret')
+    assert requests == ['kinit', 'kinit -R', 'kinit']
+
+def test_without_gssapi_tickets_are_acquired_by_subprocess(kdc, monkeypatch):
+    (clock, requests) = kdc
+    monkeypatch.setattr(helpers.kerberos, 'gssapi', None)
+    helpers.kerberos.get_ccache('alice@EXAMPLE.COM', 'secret')
+    assert requests == ['kinit']
+
+def test_renew_all_refreshes_expiring_and_evicts_idle(kdc):
+    (clock, requests) = kdc
+    helpers.kerberos.get_ccache('alice@EXAMPLE.COM', 'secret')
+    clock.now += 1800
+    bob = helpers.kerberos.get_credential('bob@EXAMPLE.COM', 'secret')
+    bob.ensure()
+    clock.now += 1300
+    # alice is within the renewal margin, bob isn't
+    helpers.kerberos.renew_all()
+    assert requests == ['acquire', 'acquire', 'acquire']
+    # renewing doesn't count as use, alice has been idle for over an hour
+    clock.now += 600
+    helpers.kerberos.renew_all()
+    assert list(helpers.kerberos.credentials.values()) == [bob]
+    assert len(requests) == 3
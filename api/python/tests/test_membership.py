@@ -0,0 +1,154 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import ldap
+import pytest
+import helpers.env
+import helpers.ldap
+import helpers.pool
+import data.ad
+import data.membership
+from data.membership import GROUPS, MEMBERS
+from helpers.ldap import RESULT_KEY_DN, RESULT_KEY_ATTRIBUTES
+from tests.stubs import Context, CONNECTION, error
+
+ROOT = 'DC=example,DC=com'
+
+IN_CHAIN = re.compile(r'^\((member|memberOf):1\.2\.840\.113556\.1\.4\.1941:=(.+)\)$')
+ANY_OF = re.compile(r'^\(\|((?:\([^=()]+=[^()]*\))+)\)$')
+TERM = re.compile(r'\(([^=()]+)=([^()]*)\)')
+
+def dn(name):
+    return 'CN={},{}'.format(name, ROOT)
+
+# g1 has u1 and g2, g2 has u2 and g1 (a cycle), g3 has g1, u3 is in no group
+GROUP_MEMBERS = {'g1': ['u1', 'g2'], 'g2': ['u2', 'g1'], 'g3': ['g1']}
+
+class Directory(Context):
+    # answers the in chain, distinguishedName and memberOf searches membership resolution sends, with
+    # chain=False refusing the in chain matching rule like a server other than AD
+    def __init__(self):
+        super(Directory, self).__init__()
+        self.chain = True
+        for name in ['u1', 'u2', 'u3'] + list(GROUP_MEMBERS):
+            self.entries[dn(name).lower()] = (dn(name), {'objectClass': [b'group' if name.startswith('g') else b'user'], 'memberOf': []})
+        for group, names in GROUP_MEMBERS.items():
+            for name in names:
+                self.add_member(group, name)
+
+    def another(self):
+        return self
+
+    def add_member(self, group, name):
+        self.entries[dn(group).lower()][1].setdefault('member', []).append(dn(name).encode('utf-8'))
+        self.entries[dn(name).lower()][1]['memberOf'].append(dn(group).encode('utf-8'))
+
+    def closure(self, start, attribute):
+        # dns reachable from start following attribute
+        found = []
+        frontier = [start]
+        while frontier:
+            for v in self.entries[frontier.pop().lower()][1].get(attribute, []):
+                if not v.decode('utf-8') in found:
+                    found.append(v.decode('utf-8'))
+                    frontier.append(v.decode('utf-8'))
+        return found
+
+    def entries_of(self, dns, attributes):
+        return [{RESULT_KEY_DN: self.entries[d.lower()][0], RESULT_KEY_ATTRIBUTES: self.project(self.entries[d.lower()][1], attributes)} for d in dns]
+
+    def any_of(self, terms, d, attrs):
+        for (k, v) in terms:
+            if k == 'distinguishedname' and d.lower() == v:
+                return True
+            if v.encode('utf-8') in [x.lower() for a, values in attrs.items() if a.lower() == k for x in values]:
+                return True
+        return False
+
+    def search(self, base, scope=ldap.SCOPE_SUBTREE, filter='(objectClass=*)', attributes=None, referrals=False, attrsonly=False, serverctrls=None):
+        if base == '':
+            self.operations.append(('search', base, scope, filter, attributes))
+            return [{RESULT_KEY_DN: '', RESULT_KEY_ATTRIBUTES: {'defaultNamingContext': [ROOT.encode('utf-8')]}}]
+        m = IN_CHAIN.match(filter or '')
+        if m:
+            self.operations.append(('search', base, scope, filter, attributes))
+            if not self.chain:
+                raise error(ldap.INAPPROPRIATE_MATCHING, 'Inappropriate matching')
+            # objects whose member chain reaches the dn are the groups it is in, and the reverse
+            return self.entries_of(self.closure(m.group(2), 'memberOf' if m.group(1) == 'member' else 'member'), attributes)
+        m = ANY_OF.match(filter or '')
+        if m:
+            self.operations.append(('search', base, scope, filter, attributes))
+            terms = [(k.lower(), v.lower()) for k, v in TERM.findall(m.group(1))]
+            return self.entries_of([d for d, attrs in sorted(self.entries.values()) if self.any_of(terms, d, attrs)], attributes)
+        return super(Directory, self).search(base, scope, filter, attributes)
+
+    def batched_searches(self):
+        return [o for o in self.operations if o[0] == 'search' and (o[3] or '').startswith('(|')]
+
+@pytest.fixture
+def directory(monkeypatch):
+    directory = Directory()
+    monkeypatch.setattr(helpers.ldap, 'SaslBindingContext', lambda *args, **kwargs: directory)
+    data.membership.invalidate(CONNECTION)
+    helpers.pool.invalidate(CONNECTION['name'])
+    yield directory
+    data.membership.invalidate(CONNECTION)
+    helpers.pool.invalidate(CONNECTION['name'])
+
+def names(dns):
+    return sorted(d.split(',')[0][3:].lower() for d in dns)
+
+@pytest.mark.parametrize('method', ['chain', 'graph'])
+@pytest.mark.parametrize('name,direction,expected', [
+    ('u1', GROUPS, ['g1', 'g2', 'g3']),
+    ('u3', GROUPS, []),
+    ('g2', GROUPS, ['g1', 'g2', 'g3']),
+    ('g3', MEMBERS, ['g1', 'g2', 'u1', 'u2']),
+    ('g1', MEMBERS, ['g1', 'g2', 'u1', 'u2'])
+])
+def test_resolve(directory, method, name, direction, expected):
+    assert names(data.membership.resolve(CONNECTION, dn(name), direction, method)) == expected
+
+@pytest.mark.parametrize('batch_size,searches', [('50', 3), ('1', 4)])
+def test_graph_walk_batches_each_level(directory, monkeypatch, batch_size, searches):
+    monkeypatch.setitem(helpers.env.name_cache, 'MEMBERSHIP_BATCH_SIZE', batch_size)
+    assert names(data.membership.resolve(CONNECTION, dn('u1'), GROUPS, 'graph')) == ['g1', 'g2', 'g3']
+    # levels u1, g1 and g2 with g3
+    assert len(directory.batched_searches()) == searches
+
+def test_graph_walk_reuses_cached_edges(directory):
+    data.membership.resolve(CONNECTION, dn('g3'), MEMBERS, 'graph')
+    directory.operations.clear()
+    assert names(data.membership.resolve(CONNECTION, dn('g1'), MEMBERS, 'graph')) == ['g1', 'g2', 'u1', 'u2']
+    assert directory.batched_searches() == []
+
+def test_auto_falls_back_to_graph_without_chain(directory):
+    directory.chain = False
+    assert names(data.membership.resolve(CONNECTION, dn('u1'), GROUPS)) == ['g1', 'g2', 'g3']
+    assert len(directory.batched_searches()) == 3
+
+def test_results_are_cached_until_membership_is_modified(directory):
+    data.membership.resolve(CONNECTION, dn('u3'), GROUPS)
+    directory.operations.clear()
+    assert data.membership.resolve(CONNECTION, dn('u3'), GROUPS) == []
+    assert directory.operations == []
+    directory.add_member('g2', 'u3')
+    data.membership.modified(CONNECTION, dn('g2'), [(ldap.MOD_ADD, 'member', [dn('u3').encode('utf-8')])])
+    assert names(data.membership.resolve(CONNECTION, dn('u3'), GROUPS)) == ['g1', 'g2', 'g3']
+
+def test_missing_object_is_not_found(directory):
+    with pytest.raises(ldap.NO_SUCH_OBJECT):
+        data.membership.resolve(CONNECTION, dn('missing'), GROUPS)
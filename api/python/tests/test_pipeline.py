@@ -0,0 +1,81 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ldap
+import pytest
+import helpers.ldap
+from helpers.ldap import RESULT_KEY_DN
+from tests.stubs import Context, error
+
+BASE = 'OU=users,DC=example,DC=com'
+
+def dn(i):
+    return 'CN=user{},{}'.format(i, BASE)
+
+@pytest.fixture
+def context():
+    entries = {BASE: {'objectClass': [b'organizationalUnit']}}
+    entries.update({dn(i): {'objectClass': [b'user'], 'cn': ['user{}'.format(i).encode('utf-8')]} for i in range(3)})
+    return Context(entries)
+
+def test_collect_returns_results_by_key(context):
+    with helpers.ldap.Pipeline(context) as pipeline:
+        for i in range(3):
+            pipeline.search(i, dn(i), ldap.SCOPE_BASE)
+        pipeline.modify('modify', dn(0), [(ldap.MOD_REPLACE, 'description', [b'changed'])])
+        found = pipeline.collect()
+    assert {k: [o[RESULT_KEY_DN] for o in v] for k, v in found.items() if k != 'modify'} == {i: [dn(i)] for i in range(3)}
+    assert found['modify'] is None
+    assert context.names() == ['search'] * 3 + ['modify']
+
+def test_collect_raises_first_error_after_all_completed(context):
+    pipeline = helpers.ldap.Pipeline(context)
+    pipeline.modify('first', dn(0), [(ldap.MOD_REPLACE, 'description', [b'first'])])
+    pipeline.delete('missing', dn(9))
+    pipeline.add('exists', dn(1), [('objectClass', [b'user'])])
+    pipeline.modify('last', dn(2), [(ldap.MOD_REPLACE, 'description', [b'last'])])
+    # the stub completes operations in reverse order of sending
+    with pytest.raises(ldap.ALREADY_EXISTS):
+        pipeline.collect()
+    # the operations around the failures were all applied and read
+    assert context.entries[dn(0).lower()][1]['description'] == [b'first']
+    assert context.entries[dn(2).lower()][1]['description'] == [b'last']
+    assert pipeline.pending == {} and context.pending == []
+
+def test_as_completed_attributes_errors_to_their_operation(context):
+    pipeline = helpers.ldap.Pipeline(context)
+    pipeline.search('found', dn(0), ldap.SCOPE_BASE)
+    pipeline.search('missing', dn(9), ldap.SCOPE_BASE)
+    pipeline.delete('deleted', dn(1))
+    completed = {key: (entries, e) for key, entries, e in pipeline.as_completed()}
+    assert [o[RESULT_KEY_DN] for o in completed['found'][0]] == [dn(0)] and completed['found'][1] is None
+    assert completed['missing'][0] is None and isinstance(completed['missing'][1], ldap.NO_SUCH_OBJECT)
+    assert completed['deleted'] == (None, None)
+
+def test_errors_of_no_operation_are_raised(context, monkeypatch):
+    pipeline = helpers.ldap.Pipeline(context)
+    pipeline.search('found', dn(0), ldap.SCOPE_BASE)
+    def lost(*args, **kwargs):
+        raise error(ldap.SERVER_DOWN, "Can't contact LDAP server")
+    monkeypatch.setattr(context, 'result', lost)
+    with pytest.raises(ldap.SERVER_DOWN):
+        pipeline.collect()
+
+def test_close_abandons_uncollected_operations(context):
+    with helpers.ldap.Pipeline(context) as pipeline:
+        for i in range(3):
+            pipeline.search(i, dn(i), ldap.SCOPE_BASE)
+        (key, entries, e) = next(pipeline.as_completed())
+    abandoned = [o[1] for o in context.operations if o[0] == 'abandon']
+    assert len(abandoned) == 2 and context.pending == [] and pipeline.pending == {}
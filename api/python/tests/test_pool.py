@@ -0,0 +1,189 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import ldap
+import pytest
+import helpers.env
+import helpers.ldap
+import helpers.pool
+from tests.stubs import Context, CONNECTION, error
+
+class Clock:
+    # stands in for the time module in helpers.pool
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(helpers.pool, 'time', clock)
+    return clock
+
+@pytest.fixture
+def opened():
+    # sessions opened by the factory, in order
+    return []
+
+def pool(opened, **kwargs):
+    def factory():
+        opened.append(Context())
+        return opened[-1]
+    return helpers.pool.Pool(factory, **kwargs)
+
+def test_released_session_is_reused(opened):
+    p = pool(opened)
+    first = p.acquire()
+    p.release(first)
+    assert p.acquire() is first
+    assert len(opened) == 1 and first.names() == ['bind']
+
+def test_most_recently_released_is_reused_unless_preferred(opened):
+    p = pool(opened)
+    (a, b) = (p.acquire(), p.acquire())
+    p.release(a)
+    p.release(b)
+    assert p.acquire(prefer=a.session_id) is a
+    p.release(a)
+    assert p.acquire() is a
+    assert p.acquire(prefer='session-gone') is b
+    assert len(opened) == 2
+
+def test_exhausted_pool_waits_for_release(opened):
+    p = pool(opened, max_size=1, timeout=5)
+    first = p.acquire()
+    acquired = []
+    waiting = threading.Thread(target=lambda: acquired.append(p.acquire()))
+    waiting.start()
+    p.release(first)
+    waiting.join(5)
+    assert acquired == [first] and len(opened) == 1
+
+def test_exhausted_pool_times_out(opened):
+    p = pool(opened, max_size=2, timeout=0)
+    p.acquire()
+    p.acquire()
+    with pytest.raises(helpers.pool.PoolExhaustedError):
+        p.acquire()
+
+def test_discarded_session_frees_its_slot(opened):
+    p = pool(opened, max_size=1, timeout=0)
+    p.discard(p.acquire())
+    assert p.acquire() is opened[1]
+    assert opened[0].names() == ['bind', 'unbind']
+
+def test_failed_bind_frees_its_slot(opened):
+    def factory():
+        raise error(ldap.SERVER_DOWN, "Can't contact LDAP server")
+    p = helpers.pool.Pool(factory, max_size=1, timeout=0)
+    for i in range(2):
+        with pytest.raises(ldap.SERVER_DOWN):
+            p.acquire()
+    assert p.size == 0
+
+def test_idle_sessions_are_closed(opened, clock):
+    p = pool(opened, min_size=1, idle_seconds=300)
+    (a, b) = (p.acquire(), p.acquire())
+    p.release(a)
+    clock.now += 200
+    p.release(b)
+    clock.now += 200
+    # a idled too long, b is kept as the minimum
+    assert p.acquire() is b
+    assert a.names() == ['bind', 'unbind'] and p.size == 1
+    p.release(b)
+    clock.now += 600
+    assert p.acquire() is b
+
+def test_sessions_idle_beyond_check_are_checked(opened, clock):
+    p = pool(opened, check_seconds=30)
+    first = p.acquire()
+    p.release(first)
+    clock.now += 10
+    assert p.acquire() is first and first.names() == ['bind']
+    p.release(first)
+    clock.now += 60
+    assert p.acquire() is first and first.names() == ['bind', 'whoami']
+    p.release(first)
+    clock.now += 60
+    def lost():
+        raise error(ldap.SERVER_DOWN, "Can't contact LDAP server")
+    first.whoami = lost
+    assert p.acquire() is opened[1]
+    assert first.names()[-1] == 'unbind' and p.size == 1
+
+def test_closed_pool_closes_released_sessions(opened):
+    p = pool(opened)
+    (a, b) = (p.acquire(), p.acquire())
+    p.release(a)
+    p.close()
+    assert a.names() == ['bind', 'unbind']
+    p.release(b)
+    assert b.names() == ['bind', 'unbind'] and p.size == 0
+
+@pytest.fixture
+def sessions(monkeypatch):
+    # sessions helpers.pool.session binds, in order
+    opened = []
+    def factory(url, userId, password, **kwargs):
+        opened.append(Context({'DC=example,DC=com': {'dc': [b'example']}}))
+        opened[-1].binding = (url, userId, password)
+        return opened[-1]
+    monkeypatch.setattr(helpers.ldap, 'SaslBindingContext', factory)
+    helpers.pool.invalidate(CONNECTION['name'])
+    yield opened
+    helpers.pool.invalidate(CONNECTION['name'])
+
+def test_session_reuses_bound_session(sessions):
+    for i in range(3):
+        with helpers.pool.session(**helpers.pool.binding_args(CONNECTION)) as context:
+            context.search('DC=example,DC=com')
+    assert len(sessions) == 1 and sessions[0].names() == ['bind'] + ['search'] * 3
+
+def test_session_discards_after_connection_error(sessions):
+    with pytest.raises(ldap.SERVER_DOWN):
+        with helpers.pool.session(**helpers.pool.binding_args(CONNECTION)):
+            raise error(ldap.SERVER_DOWN, "Can't contact LDAP server")
+    with pytest.raises(ldap.NO_SUCH_OBJECT):
+        with helpers.pool.session(**helpers.pool.binding_args(CONNECTION)):
+            raise error(ldap.NO_SUCH_OBJECT, 'No such object')
+    with helpers.pool.session(**helpers.pool.binding_args(CONNECTION)) as context:
+        assert context is sessions[1]
+    assert sessions[0].names() == ['bind', 'unbind']
+
+def test_session_rebinds_when_credentials_change(sessions):
+    with helpers.pool.session(**helpers.pool.binding_args(CONNECTION)):
+        pass
+    changed = dict(CONNECTION, credentials=dict(CONNECTION['credentials'], password='changed'))
+    with helpers.pool.session(**helpers.pool.binding_args(changed)) as context:
+        assert context is sessions[1] and context.binding[2] == 'changed'
+    assert sessions[0].names() == ['bind', 'unbind']
+
+def test_invalidate_closes_idle_sessions(sessions):
+    with helpers.pool.session(**helpers.pool.binding_args(CONNECTION)):
+        pass
+    helpers.pool.invalidate(CONNECTION['name'])
+    assert sessions[0].names() == ['bind', 'unbind']
+    with helpers.pool.session(**helpers.pool.binding_args(CONNECTION)) as context:
+        assert context is sessions[1]
+
+def test_session_binds_per_request_without_pooling(sessions, monkeypatch):
+    monkeypatch.setitem(helpers.env.name_cache, 'LDAP_POOL_MAX_SIZE', '0')
+    for i in range(2):
+        with helpers.pool.session(**helpers.pool.binding_args(CONNECTION)):
+            pass
+    assert [c.names() for c in sessions] == [['bind', 'unbind']] * 2
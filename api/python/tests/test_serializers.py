@@ -0,0 +1,120 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import json
+import uuid
+from datetime import datetime, timedelta
+import msgpack
+import pytest
+from flask import Flask
+import helpers.json
+import helpers.serializers
+import data.ad
+
+RAW = {
+    'cn': [b'user001'],
+    'displayName': ['Üser 001'.encode('utf-8')],
+    'objectGUID': [uuid.UUID('3a4f8c6e-12b4-4c8e-9f3a-0b6d2c1e5f7a').bytes_le],
+    'objectSid': [bytes.fromhex('010500000000000515000000a065cf7e784b9b5fe77c8770e8030000')],
+    'whenCreated': [b'20210101120000.0Z'],
+    'accountExpires': [b'9223372036854775807'],
+    'lockoutDuration': [b'-18000000000'],
+    'userAccountControl': [b'512'],
+    'member': [b'CN=a,DC=example,DC=com', b'CN=b,DC=example,DC=com'],
+    'thumbnailPhoto': [b'\x89PNG\r\n\x1a\n\x00\xff'],
+    'unicodePwd': [b'secret']
+}
+
+@pytest.fixture(autouse=True)
+def bundled_schema(monkeypatch):
+    monkeypatch.setattr(data.ad, 'connection_codecs', lambda connection: None)
+
+def entries(exclude=frozenset()):
+    return [data.ad.externalize({'dn': 'CN=user001,DC=example,DC=com', 'attributes': RAW}, exclude=exclude), {'when': datetime(2021, 1, 1, 12, 30, 15, 250), 'took': timedelta(seconds=1, microseconds=500), 'raw': b'\x00\x01'}]
+
+def stdlib(o, **kwargs):
+    return json.dumps(o, cls=helpers.json.CustomJSONEncoder, **kwargs)
+
+def test_formatted_values_need_the_encoder():
+    attrs = entries()[0]['attributes']
+    assert isinstance(attrs['whenCreated'], datetime) and isinstance(attrs['objectSid'], str) and isinstance(attrs['thumbnailPhoto'], bytes)
+
+def test_dumps_json_matches_stdlib_encoder():
+    assert json.loads(helpers.serializers.dumps_json(entries())) == json.loads(stdlib(entries()))
+
+def test_dumps_json_formats_datetimes_like_stdlib_encoder():
+    o = {'when': datetime(2021, 1, 1, 12, 30, 15, 250)}
+    assert helpers.serializers.dumps_json(o) == stdlib(o, separators=(',', ':')).encode('utf-8')
+
+def test_dumps_json_without_orjson_matches_stdlib_encoder(monkeypatch):
+    monkeypatch.setattr(helpers.serializers, 'orjson', None)
+    assert helpers.serializers.dumps_json(entries()) == stdlib(entries(), separators=(',', ':')).encode('utf-8')
+    assert helpers.serializers.dumps_json(entries(), pretty=True) == stdlib(entries(), indent=2, sort_keys=True).encode('utf-8')
+
+def test_dumps_json_pretty_matches_stdlib_encoder():
+    pretty = helpers.serializers.dumps_json(entries(), pretty=True).decode('utf-8')
+    assert json.loads(pretty) == json.loads(stdlib(entries()))
+    assert pretty.startswith('[\n  {\n    "attributes": {\n')
+
+def test_dumps_json_excludes_attributes():
+    found = json.loads(helpers.serializers.dumps_json(entries(exclude=frozenset(['unicodepwd', 'thumbnailphoto']))))
+    assert found == json.loads(stdlib(entries(exclude=frozenset(['unicodepwd', 'thumbnailphoto']))))
+    assert set(found[0]['attributes']) == set(RAW) - set(['unicodePwd', 'thumbnailPhoto'])
+
+def encoded(o):
+    # bytes as the json serializers write them
+    if isinstance(o, bytes):
+        return base64.b64encode(o).decode('ascii')
+    elif isinstance(o, dict):
+        return {k: encoded(v) for k, v in o.items()}
+    elif isinstance(o, list):
+        return [encoded(v) for v in o]
+    return o
+
+def test_dumps_msgpack_matches_json_except_bytes():
+    unpacked = msgpack.unpackb(helpers.serializers.dumps_msgpack(entries()), raw=False)
+    assert unpacked[0]['attributes']['thumbnailPhoto'] == RAW['thumbnailPhoto'][0]
+    assert unpacked[1]['raw'] == b'\x00\x01'
+    assert encoded(unpacked) == json.loads(stdlib(entries()))
+
+def test_ndjson_is_one_compact_line_per_object():
+    lines = b''.join(helpers.serializers.ndjson(entries())).decode('utf-8').split('\n')
+    assert lines[-1] == '' and [json.loads(line) for line in lines[:-1]] == json.loads(stdlib(entries()))
+
+@pytest.mark.parametrize('accept,query,mimetype,pretty', [
+    (None, '', 'application/json', False),
+    ('*/*', '', 'application/json', False),
+    ('application/json', '?prettyPrint=true', 'application/json', True),
+    ('application/msgpack', '', 'application/msgpack', False),
+    ('application/x-msgpack', '?prettyPrint=true', 'application/x-msgpack', False),
+    ('application/json;q=0.5, application/msgpack', '', 'application/msgpack', False),
+    ('text/html', '', 'application/json', False)
+])
+def test_negotiate(accept, query, mimetype, pretty):
+    with Flask(__name__).test_request_context('/' + query, headers={'Accept': accept} if accept else {}):
+        serializer = helpers.serializers.negotiate()
+        assert serializer.mimetype == mimetype
+        if mimetype == 'application/json':
+            assert serializer.dumps(entries()) == helpers.serializers.dumps_json(entries(), pretty) + (b'\n' if pretty else b'')
+
+def test_negotiate_without_msgpack(monkeypatch):
+    monkeypatch.setattr(helpers.serializers, 'msgpack', None)
+    with Flask(__name__).test_request_context('/', headers={'Accept': 'application/msgpack'}):
+        assert helpers.serializers.negotiate().mimetype == 'application/json'
+
+@pytest.mark.parametrize('accept,ndjson', [('application/x-ndjson', True), ('application/json', False), ('*/*', False), ('application/x-ndjson;q=0.5, application/json', False)])
+def test_accepts_ndjson(accept, ndjson):
+    with Flask(__name__).test_request_context('/', headers={'Accept': accept}):
+        assert helpers.serializers.accepts_ndjson() == ndjson
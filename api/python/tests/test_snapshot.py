@@ -0,0 +1,64 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pickle
+from functools import partial
+import pytest
+import helpers.ad
+
+def comparable(d):
+    # partials only compare equal to themselves, compare what they apply instead
+    def resolved(f):
+        return (f.func, f.args) if isinstance(f, partial) else f
+    def codecs(table):
+        return {k: tuple(resolved(f) for f in codec) for k, codec in table.items()}
+    return dict(d, codecs=codecs(d['codecs']), standard_codecs=codecs(d['standard_codecs']))
+
+@pytest.fixture(scope='module')
+def built():
+    return comparable(helpers.ad.build_snapshot())
+
+@pytest.fixture
+def path(tmp_path, monkeypatch):
+    # snapshot() loads from a temporary path and forgets what it loaded before and after
+    path = tmp_path / 'ad_schema.pickle'
+    monkeypatch.setattr(helpers.ad, 'SNAPSHOT_PATH', str(path))
+    monkeypatch.setattr(helpers.ad, 'loaded', None)
+    return path
+
+def test_snapshot_round_trip(path, built):
+    helpers.ad.write_snapshot(str(path))
+    with open(path, 'rb') as f:
+        d = pickle.load(f)
+    assert comparable(d) == built
+    assert comparable(helpers.ad.snapshot()) == built
+
+def test_snapshot_codecs_match_compiled(path, built):
+    helpers.ad.write_snapshot(str(path))
+    codecs = helpers.ad.snapshot()['codecs']
+    assert codecs['accountexpires'].formatter is helpers.ad.format_attribute_accountExpires
+    assert codecs['objectguid'] == helpers.ad.compile_codec(helpers.ad.load_schema().attribute_types['objectGUID'], 'objectGUID')
+
+def test_stale_snapshot_is_rebuilt(path, built):
+    with open(path, 'wb') as f:
+        pickle.dump(dict(helpers.ad.build_snapshot(), version=(helpers.ad.SNAPSHOT_VERSION - 1, 'other'), codecs={}), f)
+    assert comparable(helpers.ad.snapshot()) == built
+
+@pytest.mark.parametrize('content', [b'', b'not a pickle'])
+def test_unreadable_snapshot_is_rebuilt(path, built, content):
+    path.write_bytes(content)
+    assert comparable(helpers.ad.snapshot()) == built
+
+def test_missing_snapshot_is_rebuilt(path, built):
+    assert comparable(helpers.ad.snapshot()) == built
@@ -12,12 +12,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from flask import Blueprint, request, jsonify, abort
+from flask import Blueprint, Response, request, abort, stream_with_context
+import itertools
 import data.connections
 import data.ad
+import data.membership
+import data.changes
 import urllib.parse
 import helpers.errors
 import helpers.ad
+import helpers.pool
+import helpers.metrics
+import helpers.json
+import helpers.serializers
+from helpers.serializers import serialize
+import helpers.attributes
 from helpers.ldap import RESULT_KEY_DN, RESULT_KEY_ATTRIBUTES
 from ldap import SCOPE_BASE, SCOPE_SUBTREE, SCOPE_ONELEVEL
 from ldap import NO_SUCH_OBJECT, INVALID_DN_SYNTAX, FILTER_ERROR, OBJECT_CLASS_VIOLATION, ALREADY_EXISTS, LDAPError
@@ -35,32 +44,61 @@ def ldap_error(status_code, e):
     return error(status_code, e.args[0]['desc'])
 
 def error(status_code, message):
-    response = jsonify({
+    response = serialize({
         'message': message
         })
     response.status_code = status_code
     return response
 
 def empty(status_code):
-    response = jsonify({})
+    response = serialize({})
     response.status_code = status_code
     return response
 
+@bp.route('/metrics', methods=['GET'])
+def metrics_get():
+    return serialize(helpers.metrics.snapshot())
+
+MAX_PAGE_SIZE = 1000
+
+def arg_page_size(arg, default=None):
+    if arg is None:
+        return default
+    try:
+        size = int(arg)
+    except ValueError:
+        raise helpers.errors.BadRequestException('pageSize must be an integer')
+    if size < 1:
+        raise helpers.errors.BadRequestException('pageSize must be positive')
+    return min(size, MAX_PAGE_SIZE)
+
 @bp.route('/connections', methods=['GET'])
 def connections_get():
-    return jsonify([mask_pwd(x) for x in data.connections.get_all()])
+    try:
+        page_size = arg_page_size(request.args.get('pageSize'))
+        page_token = request.args.get('pageToken')
+        if page_size is None and page_token is None:
+            return serialize([mask_pwd(x) for x in data.connections.get_all()])
+        (connections, next_page_token) = data.connections.get_page(page_size or MAX_PAGE_SIZE, page_token)
+        response = {'connections': [mask_pwd(x) for x in connections]}
+        if next_page_token:
+            response['nextPageToken'] = next_page_token
+        return serialize(response)
+    except helpers.errors.BadRequestException as e:
+        return error(400, e.message)
 
 @bp.route('/connections', methods=['POST'])
 def connections_post():
     try:
-        return jsonify(mask_pwd(data.connections.create(request.json))), 201
-    except helpers.errors.AlreadyExistsException as e:
+        return serialize(mask_pwd(data.connections.create(request.json)), 201)
+    except helpers.errors.Error as e:
+        # already exists or invalid, e.g. attributeProfiles referring to missing or cyclic profiles
         return error(400, e.message)
 
 @bp.route('/connections/<string:connection>', methods=['GET'])
 def connection_get(connection):
     try:
-        return mask_pwd(data.connections.get(connection))
+        return serialize(mask_pwd(data.connections.get(connection)))
     except helpers.errors.NotFoundException as e:
         return error(404, e.message)
 
@@ -75,7 +113,7 @@ def connection_delete(connection):
 @bp.route('/connections/<string:connection>', methods=['PUT', 'PATCH'])
 def connection_putpatch(connection):
     try:
-        return mask_pwd(data.connections.update(connection, request.json, partial=True if request.method=='PATCH' else False))
+        return serialize(mask_pwd(data.connections.update(connection, request.json, partial=True if request.method=='PATCH' else False)))
     except helpers.errors.NotFoundException as e:
         return error(404, e.message)
     except helpers.errors.Error as e:
@@ -91,20 +129,127 @@ def arg_scope(arg):
     else: # default to subtree
         return SCOPE_SUBTREE
 
-def arg_attributes(arg):
-    return arg.split(',') if arg else None
+def arg_projection(connection, args=None):
+    # (attributes, exclude) from the attributes and profile parameters or the connection's default profile
+    args = request.args if args is None else args
+    return helpers.attributes.projection(args.get('attributes'), args.get('profile'), connection)
 
 @bp.route('/connections/<string:connection>/ldap/<string:base>', methods=['GET'])
 def get_entries(connection, base):
     try:
+        connection = data.connections.get(connection)
+        (attributes, exclude) = arg_projection(connection)
         args = {
-                'connection': data.connections.get(connection),
+                'connection': connection,
                 'base': base,
                 'filter': request.args.get('filter'),
-                'attributes': arg_attributes(request.args.get('attributes')),
-                'scope': arg_scope(request.args.get('scope'))
+                'attributes': attributes,
+                'scope': arg_scope(request.args.get('scope')),
+                'exclude': exclude
             }
-        return jsonify(data.ad.get(**args))
+        page_size = arg_page_size(request.args.get('pageSize'))
+        page_token = request.args.get('pageToken')
+        if not (page_size is None and page_token is None):
+            (entries, next_page_token) = data.ad.get_page(**args, page_size=page_size or MAX_PAGE_SIZE, page_token=page_token)
+            response = {'entries': entries}
+            if next_page_token:
+                response['nextPageToken'] = next_page_token
+            return serialize(response)
+        if helpers.serializers.accepts_ndjson():
+            entries = data.ad.iterate(**args)
+            # fetch the first page before responding so search errors still produce an error status
+            first = next(entries, None)
+            return Response(stream_with_context(helpers.serializers.ndjson(itertools.chain([first] if first else [], entries))), mimetype=helpers.serializers.MIMETYPE_NDJSON)
+        return serialize(data.ad.get(**args))
+    except helpers.pool.PoolExhaustedError as e:
+        return error(503, e.message)
+    except helpers.errors.Error as e:
+        return error(400, e.message)
+    except NO_SUCH_OBJECT as e:
+        return ldap_error(404, e)
+    except LDAPError as e:
+        return ldap_error(400, e)
+
+@bp.route('/connections/<string:connection>/ldap/<string:base>/values/<string:attribute>', methods=['GET'])
+def get_values(connection, base, attribute):
+    # values of a (large) multi-valued attribute of the entry at dn base
+    try:
+        args = {
+                'connection': data.connections.get(connection),
+                'base': base,
+                'attribute': attribute
+            }
+        page_size = arg_page_size(request.args.get('pageSize'))
+        page_token = request.args.get('pageToken')
+        if not (page_size is None and page_token is None):
+            (values, next_page_token) = data.ad.get_values_page(**args, page_size=page_size or MAX_PAGE_SIZE, page_token=page_token)
+            response = {'values': values}
+            if next_page_token:
+                response['nextPageToken'] = next_page_token
+            return serialize(response)
+        values = data.ad.iterate_values(**args)
+        if helpers.serializers.accepts_ndjson():
+            # fetch the first range before responding so search errors still produce an error status
+            first = next(values, None)
+            return Response(stream_with_context(helpers.serializers.ndjson(itertools.chain([first] if first is not None else [], values))), mimetype=helpers.serializers.MIMETYPE_NDJSON)
+        return serialize(list(values))
+    except data.ad.EmptyResultsError as e:
+        return error(404, MESSAGE_UNEXPECTED_RESULT_COUNT)
+    except helpers.pool.PoolExhaustedError as e:
+        return error(503, e.message)
+    except helpers.errors.Error as e:
+        return error(400, e.message)
+    except NO_SUCH_OBJECT as e:
+        return ldap_error(404, e)
+    except LDAPError as e:
+        return ldap_error(400, e)
+
+def membership(connection, base, direction):
+    try:
+        return serialize(data.membership.resolve(data.connections.get(connection), base, direction, request.args.get('method')))
+    except data.ad.EmptyResultsError as e:
+        return error(404, MESSAGE_UNEXPECTED_RESULT_COUNT)
+    except helpers.pool.PoolExhaustedError as e:
+        return error(503, e.message)
+    except helpers.errors.Error as e:
+        return error(400, e.message)
+    except NO_SUCH_OBJECT as e:
+        return ldap_error(404, e)
+    except LDAPError as e:
+        return ldap_error(400, e)
+
+@bp.route('/connections/<string:connection>/ldap/<string:base>/groups', methods=['GET'])
+def get_groups(connection, base):
+    # dns of all groups the entry at dn base is in, directly or through nested groups
+    return membership(connection, base, data.membership.GROUPS)
+
+@bp.route('/connections/<string:connection>/ldap/<string:base>/members', methods=['GET'])
+def get_members(connection, base):
+    # dns of all entries in the group at dn base, directly or through nested groups
+    return membership(connection, base, data.membership.MEMBERS)
+
+@bp.route('/connections/<string:connection>/ldap/<string:base>/changes', methods=['GET'])
+def get_changes(connection, base):
+    # entries created, modified or deleted under dn base since the watermark of a previous call
+    try:
+        connection = data.connections.get(connection)
+        (attributes, exclude) = arg_projection(connection)
+        changes = data.changes.iterate(connection, base,
+                filter=request.args.get('filter'),
+                attributes=attributes,
+                exclude=exclude,
+                watermark=request.args.get('watermark'),
+                method=request.args.get('method'))
+        # fetch the first change before responding so search errors still produce an error status
+        first = next(changes)
+        if helpers.serializers.accepts_ndjson():
+            return Response(stream_with_context(helpers.serializers.ndjson(itertools.chain([first], changes))), mimetype=helpers.serializers.MIMETYPE_NDJSON)
+        records = list(itertools.chain([first], changes))
+        return serialize(dict({'changes': records[:-1]}, **records[-1]))
+    except helpers.pool.PoolExhaustedError as e:
+        return error(503, e.message)
+    except helpers.errors.Error as e:
+        return error(400, e.message)
     except NO_SUCH_OBJECT as e:
         return ldap_error(404, e)
     except LDAPError as e:
@@ -125,6 +270,8 @@ def delete_entries(connection, base):
         return error(404, MESSAGE_UNEXPECTED_RESULT_COUNT)
     except data.ad.NonUniqueResultsError as e:
         return error(400, MESSAGE_UNEXPECTED_RESULT_COUNT)
+    except helpers.pool.PoolExhaustedError as e:
+        return error(503, e.message)
     except helpers.errors.Error as e:
         return error(400, e.message)
     except NO_SUCH_OBJECT as e:
@@ -132,16 +279,25 @@ def delete_entries(connection, base):
     except LDAPError as e:
         return ldap_error(400, e)
 
-def deserialize(d):
+def deserialize_delta(k, v, codecs=None):
+    # {"add": [...], "remove": [...]} patches values of a multi-valued attribute
+    if not v or set(v.keys()) - set(['add', 'remove']):
+        raise ValueError('keys expected: add, remove')
+    return data.ad.ValueDelta(*[helpers.json.deserialize_attribute(k, v[x], codecs) if v.get(x) else [] for x in ('add', 'remove')])
+
+def deserialize(d, codecs=None):
     de = {}
     for k in d.keys():
         try:
-            de[k] = helpers.json.deserialize_attribute(k, d[k])
+            if type(d[k]) is dict:
+                de[k] = deserialize_delta(k, d[k], codecs)
+            else:
+                de[k] = helpers.json.deserialize_attribute(k, d[k], codecs)
         except Exception as e:
             raise ValueError('failed to deserialize attribute "{}". {}'.format(k, str(e)))
     return de
 
-def validate_attributes(d):
+def validate_attributes(d, codecs=None):
     if not type(d) is dict:
         raise ValueError('dictionary expected')
     keys = list(d.keys())
@@ -150,26 +306,42 @@ def validate_attributes(d):
     if len(keys) > 1:
         keys.remove(RESULT_KEY_ATTRIBUTES)
         raise ValueError('unexpected key(s): {}'.format(', '.join(keys)))
-    return deserialize(d[RESULT_KEY_ATTRIBUTES])
+    return deserialize(d[RESULT_KEY_ATTRIBUTES], codecs)
+
+def prefer_minimal():
+    # Prefer: return=minimal (RFC 7240) skips reloading the entry after a write
+    return any(p.split(';')[0].strip().lower() == 'return=minimal' for p in request.headers.get('Prefer', '').split(','))
+
+def minimal():
+    response = Response(status=204)
+    response.headers['Preference-Applied'] = 'return=minimal'
+    return response
 
 @bp.route('/connections/<string:connection>/ldap/<string:base>', methods=['POST'])
 def create_entry(connection, base):
     try:
+        connection = data.connections.get(connection)
+        (attributes, exclude) = arg_projection(connection)
         args = {
-            'connection': data.connections.get(connection),
+            'connection': connection,
             'base': base,
             'filter': request.args.get('filter'),
             'scope': arg_scope(request.args.get('scope')),
-            'data': validate_attributes(request.json),
-            'attributes': arg_attributes(request.args.get('attributes'))
+            'data': validate_attributes(request.json, data.ad.connection_codecs(connection)),
+            'attributes': attributes,
+            'exclude': exclude,
+            'minimal': prefer_minimal()
         }
-        return jsonify([data.ad.create(**args)])
+        entry = data.ad.create(**args)
+        return serialize([entry]) if entry else minimal()
     except ValueError as e:
         return error(400, str(e))
     except data.ad.EmptyResultsError as e:
         return error(404, MESSAGE_UNEXPECTED_RESULT_COUNT)
     except data.ad.NonUniqueResultsError as e:
         return error(400, MESSAGE_UNEXPECTED_RESULT_COUNT)
+    except helpers.pool.PoolExhaustedError as e:
+        return error(503, e.message)
     except helpers.errors.Error as e:
         return error(400, e.message)
     except LDAPError as e:
@@ -178,24 +350,118 @@ def create_entry(connection, base):
 @bp.route('/connections/<string:connection>/ldap/<string:base>', methods=['PUT', 'PATCH'])
 def update_entry(connection, base):
     try:
+        connection = data.connections.get(connection)
+        (attributes, exclude) = arg_projection(connection)
         args = {
-            'connection': data.connections.get(connection),
+            'connection': connection,
             'base': base,
             'filter': request.args.get('filter'),
             'scope': arg_scope(request.args.get('scope')),
-            'data': validate_attributes(request.json),
-            'attributes': arg_attributes(request.args.get('attributes')),
-            'partial': True if request.method == 'PATCH' else False
+            'data': validate_attributes(request.json, data.ad.connection_codecs(connection)),
+            'attributes': attributes,
+            'exclude': exclude,
+            'partial': True if request.method == 'PATCH' else False,
+            'minimal': prefer_minimal()
         }
-        return jsonify([data.ad.update(**args)])
+        entry = data.ad.update(**args)
+        return serialize([entry]) if entry else minimal()
     except ValueError as e:
         return error(400, str(e))
     except data.ad.EmptyResultsError as e:
         return error(404, MESSAGE_UNEXPECTED_RESULT_COUNT)
     except data.ad.NonUniqueResultsError as e:
         return error(400, MESSAGE_UNEXPECTED_RESULT_COUNT)
+    except helpers.pool.PoolExhaustedError as e:
+        return error(503, e.message)
     except helpers.errors.Error as e:
         return error(400, e.message)
+    except NO_SUCH_OBJECT as e:
+        # patching a dn with scope=base skips the search
+        return ldap_error(404, e)
     except LDAPError as e:
         return ldap_error(400, e)
 
+
+MAX_BATCH_SIZE = 100
+BATCH_METHODS = ('create', 'update', 'patch', 'delete')
+
+def batch_operation(connection, context, op):
+    # runs one operation of a batch and returns its result
+    if not type(op) is dict or not op.get('method') in BATCH_METHODS:
+        raise ValueError('method expected: {}'.format(', '.join(BATCH_METHODS)))
+    if not isinstance(op.get('base'), str):
+        raise ValueError('key expected: base')
+    args = {
+        'connection': connection,
+        'base': op['base'],
+        'filter': op.get('filter'),
+        'scope': arg_scope(op.get('scope')),
+        'context': context
+    }
+    if op['method'] == 'delete':
+        data.ad.delete(**args)
+        return {'status': 200}
+    (args['attributes'], args['exclude']) = arg_projection(connection, op)
+    args['data'] = validate_attributes(op.get('body'), data.ad.connection_codecs(connection))
+    args['minimal'] = op.get('return') == 'minimal'
+    if op['method'] == 'create':
+        entry = data.ad.create(**args)
+    else:
+        entry = data.ad.update(**args, partial=op['method'] == 'patch')
+    return {'status': 200, 'entry': entry} if entry else {'status': 204}
+
+def batch_error(e):
+    # result for a failed operation, with the status its single operation route would respond with
+    if isinstance(e, ValueError):
+        return {'status': 400, 'message': str(e)}
+    elif isinstance(e, data.ad.EmptyResultsError):
+        return {'status': 404, 'message': MESSAGE_UNEXPECTED_RESULT_COUNT}
+    elif isinstance(e, data.ad.NonUniqueResultsError):
+        return {'status': 400, 'message': MESSAGE_UNEXPECTED_RESULT_COUNT}
+    elif isinstance(e, helpers.pool.CONNECTION_ERRORS):
+        return {'status': 503, 'message': e.args[0]['desc']}
+    elif isinstance(e, helpers.errors.Error):
+        return {'status': 400, 'message': e.message}
+    elif isinstance(e, NO_SUCH_OBJECT):
+        return {'status': 404, 'message': e.args[0]['desc']}
+    return {'status': 400, 'message': e.args[0]['desc']}
+
+@bp.route('/connections/<string:connection>/ldap:batch', methods=['POST'])
+def batch_entries(connection):
+    try:
+        body = request.json
+        if not type(body) is dict or not type(body.get('operations')) is list:
+            raise ValueError('key expected: operations')
+        operations = body['operations']
+        if len(operations) > MAX_BATCH_SIZE:
+            raise ValueError('at most {} operations per batch'.format(MAX_BATCH_SIZE))
+        stop_on_error = body.get('stopOnError', False) is True
+        connection = data.connections.get(connection)
+        results = []
+        try:
+            # one bound session for all operations, a connection error ends the batch as the session is lost
+            with data.ad.session(connection) as context:
+                for op in operations:
+                    try:
+                        results.append(batch_operation(connection, context, op))
+                    except helpers.pool.CONNECTION_ERRORS:
+                        raise
+                    except (ValueError, helpers.errors.Error, LDAPError) as e:
+                        results.append(batch_error(e))
+                        if stop_on_error:
+                            break
+        except helpers.pool.CONNECTION_ERRORS as e:
+            results.append(batch_error(e))
+        # operations that were not run
+        results += [{'status': 424, 'message': 'not executed'}] * (len(operations) - len(results))
+        return serialize({'results': results})
+    except ValueError as e:
+        return error(400, str(e))
+    except helpers.errors.NotFoundException as e:
+        return error(404, e.message)
+    except helpers.pool.PoolExhaustedError as e:
+        return error(503, e.message)
+    except helpers.errors.Error as e:
+        return error(400, e.message)
+    except LDAPError as e:
+        return ldap_error(400, e)